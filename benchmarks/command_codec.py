@@ -0,0 +1,81 @@
+# Measures how many COM_SET_ALL_VELOCITIES frames per second SerialComms.send can write, against the original
+# send which built the format string, buffer and checksum afresh on every call.
+# Run from the piwarsengine directory with: python -m benchmarks.command_codec
+import os
+import struct
+import tracemalloc
+from serial import Serial
+from time import thread_time_ns, perf_counter_ns
+from comms.serial import SerialComms
+from devices.motor_driver import COM_SET_ALL_VELOCITIES
+from benchmarks.fake_device import FakeDevice
+
+SENDS = 20000
+VELOCITIES = (2000, -1000, 4500)
+
+
+class OriginalComms:
+    # A copy of the original send, kept as the reference to compare against
+    def __init__(self, serial_port):
+        self.__serial = Serial(serial_port, timeout=1)
+
+    def checksum(self, buffer):
+        checksum = 0
+        for i in range(len(buffer) - 1):
+            checksum += buffer[i]
+        return checksum % 0x100
+
+    def send(self, command, *data):
+        buffer = bytearray(command.length + SerialComms.FRAME_BYTES)
+        struct.pack_into(">BB" + command.format + "B", buffer, 0, SerialComms.START_BYTE, ord(command.value), *data, 0)
+        buffer[-1] = self.checksum(buffer)
+        self.__serial.write(buffer)
+
+
+def measure(comms_class):
+    # The fake device has no handlers, so it just drains everything that is sent to it
+    with FakeDevice({}) as device:
+        comms = comms_class(device.port)
+        comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES)
+
+        cpu_start = thread_time_ns()
+        wall_start = perf_counter_ns()
+        for _ in range(SENDS):
+            comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES)
+        cpu_ns = thread_time_ns() - cpu_start
+        wall_ns = perf_counter_ns() - wall_start
+
+    return SENDS / (wall_ns / 1e9), cpu_ns / SENDS
+
+
+def measure_allocated(comms_class):
+    # Nothing reads the other end of this pty, so only the send itself is traced. A few frames fit in its buffer
+    master, slave = os.openpty()
+    try:
+        comms = comms_class(os.ttyname(slave))
+        comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES)
+
+        # The most memory traced during one send. With nothing built per call this is just the argument tuples
+        tracemalloc.start()
+        comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES)
+        tracemalloc.reset_peak()
+        comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak - current
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def main():
+    print(f"{SENDS} sends of COM_SET_ALL_VELOCITIES per run")
+    for name, comms_class in (("original", OriginalComms), ("precompiled", SerialComms)):
+        sends_per_second, cpu_ns = measure(comms_class)
+        peak_bytes = measure_allocated(comms_class)
+        print(f"  {name:12} {sends_per_second:10.0f} sends/s, {cpu_ns / 1000:6.2f} us CPU/send, "
+              f"{peak_bytes:5d} bytes allocated/send")
+
+
+if __name__ == "__main__":
+    main()
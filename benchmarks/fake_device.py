@@ -0,0 +1,127 @@
+# A stand-in for one of the Pico devices, speaking the SerialComms framing on the far side of a pseudo-terminal.
+# Point a SerialComms at FakeDevice.port and it behaves as if a real device was plugged in.
+import os
+import struct
+from select import select
+from threading import Thread
+from time import monotonic, sleep
+from comms.serial import SerialComms, COM_SUBSCRIBE_SEND
+
+
+class FakeDevice:
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, handlers, reply_delay=0.0, streams=None):
+        # handlers maps each request Command to a function taking its data, which returns either None,
+        # or a reply Command and the data to send back with it
+        self.__handlers = {ord(command.value): (command, handler) for command, handler in handlers.items()}
+        self.__reply_delay = reply_delay
+
+        # streams maps each Command the device can push when subscribed to a function returning the data to push
+        self.__streams = {command.code: (command, producer) for command, producer in (streams or {}).items()}
+        self.__subscriptions = {}
+        if self.__streams:
+            self.__handlers[COM_SUBSCRIBE_SEND.code] = (COM_SUBSCRIBE_SEND, self.__subscribe)
+
+        self.__master, self.__slave = os.openpty()
+        self.port = os.ttyname(self.__slave)
+
+        self.__rx_buffer = bytearray()
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        self.__running = True
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __subscribe(self, code, period_ms):
+        if code not in self.__streams:
+            return
+        if period_ms == 0:
+            self.__subscriptions.pop(code, None)
+        else:
+            self.__subscriptions[code] = [period_ms / 1000, monotonic()]
+
+    def __push_streams(self):
+        # Push every subscribed command that is due, returning how long until the next one is
+        now = monotonic()
+        pushes = bytearray()
+        wait = self.POLL_INTERVAL
+        for code, subscription in list(self.__subscriptions.items()):
+            period, due = subscription
+            if due <= now:
+                command, producer = self.__streams[code]
+                pushes += self.encode(command, *producer())
+                subscription[1] = max(due + period, now)
+            wait = min(wait, subscription[1] - now)
+        if pushes:
+            os.write(self.__master, pushes)
+        return max(wait, 0)
+
+    def __run(self):
+        while self.__running:
+            wait = self.__push_streams() if self.__subscriptions else self.POLL_INTERVAL
+            if select([self.__master], [], [], wait)[0]:
+                self.__rx_buffer += os.read(self.__master, 4096)
+
+                # Replies to everything that arrived together go back together after a single delay, like a USB transfer
+                replies = self.__process_received()
+                if replies:
+                    if self.__reply_delay > 0:
+                        sleep(self.__reply_delay)
+                    os.write(self.__master, replies)
+
+    def __process_received(self):
+        buffer = self.__rx_buffer
+        replies = bytearray()
+        while True:
+            # Skip anything that is not the start of a frame
+            start = buffer.find(SerialComms.START_BYTE)
+            if start < 0:
+                buffer.clear()
+                return replies
+            del buffer[:start]
+
+            if len(buffer) < 2:
+                return replies
+
+            if buffer[1] not in self.__handlers:
+                del buffer[:1]
+                continue
+
+            command, handler = self.__handlers[buffer[1]]
+            frame_length = command.length + SerialComms.FRAME_BYTES
+            if len(buffer) < frame_length:
+                return replies
+
+            frame = bytes(buffer[:frame_length])
+            del buffer[:frame_length]
+            if sum(frame[:-1]) % 0x100 != frame[-1]:
+                continue
+
+            data = struct.unpack(">BB" + command.format + "B", frame)[2:-1]
+            reply = handler(*data)
+            if reply is not None:
+                replies += self.encode(*reply)
+
+    @staticmethod
+    def encode(command, *data):
+        frame = bytearray(struct.pack(">BB" + command.format + "B", SerialComms.START_BYTE, ord(command.value), *data, 0))
+        frame[-1] = sum(frame[:-1]) % 0x100
+        return frame
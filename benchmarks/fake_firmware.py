@@ -0,0 +1,145 @@
+# Stand-ins for the Motor Driver, IO Controller and SBUS receiver, each on the far side of a pseudo-terminal.
+# Point the real classes at their .port and they behave as if the hardware was plugged in.
+import os
+from select import select
+from threading import Event, Thread
+from comms.serial import COM_IDENTIFY_SEND, COM_IDENTIFY_RECV, COM_POKE_SEND
+from devices import motor_driver, io_controller
+from devices.motor_driver import MotorDriver
+from devices.io_controller import IOController
+from benchmarks.fake_device import FakeDevice
+from benchmarks.sbus_check_receive import make_frame
+
+
+class FakeMotorDriver(FakeDevice):
+    def __init__(self, reply_delay=0.0):
+        self.velocities = (0, 0, 0)
+        self.encoders = [0, 0, 0, 0]
+
+        ignore = lambda *data: None
+        super().__init__({
+            COM_IDENTIFY_SEND: lambda: (COM_IDENTIFY_RECV, MotorDriver.EXPECTED_ID),
+            COM_POKE_SEND: ignore,
+            motor_driver.COM_SET_FORWARD_VELOCITY: lambda z: self.__set_velocities(z, self.velocities[1],
+                                                                                  self.velocities[2]),
+            motor_driver.COM_SET_RIGHT_VELOCITY: lambda x: self.__set_velocities(self.velocities[0], x,
+                                                                                self.velocities[2]),
+            motor_driver.COM_SET_LINEAR_VELOCITIES: lambda z, x: self.__set_velocities(z, x, self.velocities[2]),
+            motor_driver.COM_SET_ANGULAR_VELOCITY: lambda r: self.__set_velocities(self.velocities[0],
+                                                                                  self.velocities[1], r),
+            motor_driver.COM_SET_ALL_VELOCITIES: self.__set_velocities,
+            motor_driver.COM_STOP_MOVING: lambda: self.__set_velocities(0, 0, 0),
+            motor_driver.COM_SET_MOTION_ORIGIN_TO: ignore,
+            motor_driver.COM_RESET_MOTION_ORIGIN: ignore,
+            motor_driver.COM_READ_VELOCITIES_SEND: lambda: (motor_driver.COM_READ_VELOCITIES_RECV, *self.velocities),
+            motor_driver.COM_READ_ENCODERS_SEND: self.__read_encoders,
+        }, reply_delay, streams={
+            motor_driver.COM_READ_VELOCITIES_RECV: lambda: self.velocities,
+            motor_driver.COM_READ_ENCODERS_RECV: lambda: self.__read_encoders()[1:],
+        })
+
+    def __set_velocities(self, z, x, r):
+        self.velocities = (z, x, r)
+
+    def __read_encoders(self):
+        # The wheels creep forward a little between each reading, wrapping like the firmware's 16 bit counts
+        self.encoders = [(count + 1 + 0x8000) % 0x10000 - 0x8000 for count in self.encoders]
+        return (motor_driver.COM_READ_ENCODERS_RECV, *self.encoders)
+
+
+class FakeIOController(FakeDevice):
+    def __init__(self, reply_delay=0.0, tof_distances=(1000, 1500, 2000, 2500)):
+        # Distances are in the firmware's units, which IOController divides by its TOF_SCALING
+        self.tof_distances = list(tof_distances)
+        self.gripper = io_controller.GRIPPER_CLOSED
+        self.barrel = 0
+        self.leds = {}
+
+        ignore = lambda *data: None
+        super().__init__({
+            COM_IDENTIFY_SEND: lambda: (COM_IDENTIFY_RECV, IOController.EXPECTED_ID),
+            COM_POKE_SEND: ignore,
+            io_controller.COM_READ_TOF_SEND: self.__read_tof,
+            io_controller.COM_SET_LED_SEND: self.__set_led,
+            io_controller.COM_SET_GRIPPER_SEND: self.__set_gripper,
+            io_controller.COM_READ_GRIPPER_SEND: lambda: (io_controller.COM_READ_GRIPPER_RECV, self.gripper),
+            io_controller.COM_READ_BARREL_SEND: lambda: (io_controller.COM_READ_BARREL_RECV, self.barrel),
+            io_controller.COM_POWER_TURRET_SEND: ignore,
+            io_controller.COM_SET_TURRET_TILT_SEND: ignore,
+            io_controller.COM_SET_TURRET_SPEED_SEND: ignore,
+            io_controller.COM_FIRE_TURRET_SEND: ignore,
+        }, reply_delay, streams={
+            io_controller.COM_READ_TOFS_RECV: lambda: [self.__read_tof(index)[1] for index in range(4)],
+        })
+
+    def __read_tof(self, index):
+        # Sensors that are not fitted report the firmware's error value
+        distance = self.tof_distances[index] if index < len(self.tof_distances) else -99
+        return io_controller.COM_READ_TOF_RECV, distance
+
+    def __set_led(self, led, r, g, b):
+        self.leds[led] = (r, g, b)
+
+    def __set_gripper(self, state):
+        self.gripper = state
+
+
+class FakeSBusTransmitter:
+    # Writes SBUS frames into a pseudo-terminal, either at a fixed rate like a real receiver or, with a rate of
+    # None, as fast as they are read
+    DEFAULT_RATE = 1 / 0.007
+
+    def __init__(self, num_channels, rate=DEFAULT_RATE, frames=None):
+        # With frames left as None it keeps going until stopped
+        self.__num_channels = num_channels
+        self.__rate = rate
+        self.__frames = frames
+
+        self.__master, self.__slave = os.openpty()
+        self.port = os.ttyname(self.__slave)
+        self.sent = 0
+
+        self.__stop_event = Event()
+        self.__finished = Event()
+        self.__thread = None
+
+    def start(self):
+        self.__stop_event.clear()
+        self.__finished.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # Wait for all the frames to have been written
+        return self.__finished.wait(timeout)
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __run(self):
+        period = None if self.__rate is None else 1 / self.__rate
+        while not self.__stop_event.is_set() and (self.__frames is None or self.sent < self.__frames):
+            # The channels sweep through their range so every frame is different
+            value = 1000 + self.sent % 1001
+            frame = make_frame([value] * self.__num_channels)
+            view = memoryview(frame)
+            while view and not self.__stop_event.is_set():
+                if select([], [self.__master], [], 0.1)[1]:
+                    view = view[os.write(self.__master, view):]
+            self.sent += 1
+
+            if period is not None:
+                self.__stop_event.wait(period)
+        self.__finished.set()
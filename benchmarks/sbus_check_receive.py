@@ -0,0 +1,131 @@
+# Compares the bulk-read SBusReceiver.check_receive against the original byte-wise state machine.
+# Both read the same generated byte stream through a pseudo-terminal, so the serial syscalls are included.
+# Run from the piwarsengine directory with: python -m benchmarks.sbus_check_receive
+import os
+import random
+import struct
+from select import select
+from serial import Serial
+from threading import Thread
+from time import thread_time_ns, perf_counter_ns
+from comms.sbus import SBusReceiver
+
+NUM_CHANNELS = 14
+NUM_FRAMES = 5000
+WRITE_SIZES = (SBusReceiver.FRAME_LENGTH, 1024)
+IDLE_TIMEOUT = 0.5
+
+
+class ByteWiseReceiver:
+    # A copy of the original per-byte check_receive, kept as the reference to compare against
+    def __init__(self, serial_port, num_channels):
+        self.__serial = Serial(serial_port, SBusReceiver.BAUD_RATE, timeout=1)
+        self.__receiving = False
+        self.__rx_buffer = bytearray(SBusReceiver.FRAME_LENGTH)
+        self.__rx_index = 0
+        self.__channel_format = "<" + "H" * num_channels
+        self.__channel_data = (0,) * num_channels
+
+    def read_channel(self, channel):
+        return self.__channel_data[channel]
+
+    def check_receive(self):
+        newly_received = False
+        while self.__serial.in_waiting > 0:
+            rx_byte = self.__serial.read(1)[0]
+            if not self.__receiving and rx_byte == SBusReceiver.FRAME_START:
+                self.__receiving = True
+                self.__rx_index = 0
+
+            if self.__receiving:
+                self.__rx_buffer[self.__rx_index] = rx_byte
+                self.__rx_index += 1
+                if self.__rx_index >= SBusReceiver.FRAME_LENGTH:
+                    received_checksum = (self.__rx_buffer[-1] << 8) | self.__rx_buffer[-2]
+                    checksum = 0xffff
+                    for i in range(SBusReceiver.FRAME_LENGTH - 2):
+                        checksum -= self.__rx_buffer[i]
+
+                    if checksum == received_checksum:
+                        self.__channel_data = struct.unpack_from(self.__channel_format, self.__rx_buffer, 2)
+                        newly_received = True
+                    self.__receiving = False
+        return newly_received
+
+
+def make_frame(channels, corrupt=False):
+    frame = bytearray(SBusReceiver.FRAME_LENGTH)
+    frame[0] = SBusReceiver.FRAME_START
+    frame[1] = 0x40
+    struct.pack_into("<" + "H" * len(channels), frame, 2, *channels)
+    checksum = 0xffff - sum(frame[:-2])
+    if corrupt:
+        checksum ^= 0x0100
+    struct.pack_into("<H", frame, SBusReceiver.FRAME_LENGTH - 2, checksum)
+    return frame
+
+
+def make_stream(num_frames, seed=0):
+    rng = random.Random(seed)
+    stream = bytearray()
+    for _ in range(num_frames):
+        # Occasionally add line noise or a corrupted frame to exercise resynchronisation
+        if rng.random() < 0.02:
+            stream += bytes(rng.randrange(256) for _ in range(rng.randrange(1, 8)))
+        channels = [rng.randrange(1000, 2001) for _ in range(NUM_CHANNELS)]
+        stream += make_frame(channels, corrupt=rng.random() < 0.02)
+    return stream
+
+
+def write_stream(fd, stream, write_size):
+    for offset in range(0, len(stream), write_size):
+        os.write(fd, stream[offset:offset + write_size])
+
+
+def measure(receiver_class, stream, write_size):
+    master, slave = os.openpty()
+    try:
+        receiver = receiver_class(os.ttyname(slave), NUM_CHANNELS)
+        writer = Thread(target=write_stream, args=(master, stream, write_size))
+        writer.start()
+
+        cpu_ns = 0
+        wall_ns = 0
+        frames = []
+        # Only time the calls made while there is data waiting, so idle polling is not counted
+        while select([slave], [], [], IDLE_TIMEOUT)[0]:
+            cpu_start = thread_time_ns()
+            wall_start = perf_counter_ns()
+            newly_received = receiver.check_receive()
+            cpu_ns += thread_time_ns() - cpu_start
+            wall_ns += perf_counter_ns() - wall_start
+            if newly_received:
+                frames.append(tuple(receiver.read_channel(i) for i in range(NUM_CHANNELS)))
+
+        writer.join()
+        return cpu_ns, wall_ns, frames
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def main():
+    stream = make_stream(NUM_FRAMES)
+    print(f"{NUM_FRAMES} frames, {len(stream)} bytes")
+
+    for write_size in WRITE_SIZES:
+        print(f"\nWrites of {write_size} bytes")
+        results = {}
+        for name, receiver_class in (("byte-wise", ByteWiseReceiver), ("bulk", SBusReceiver)):
+            cpu_ns, wall_ns, frames = measure(receiver_class, stream, write_size)
+            results[name] = frames
+            print(f"  {name:10} {len(stream) / (cpu_ns / 1e9) / 1e6:8.2f} MB/s CPU, "
+                  f"{cpu_ns / NUM_FRAMES / 1000:8.2f} us CPU/frame, "
+                  f"{wall_ns / NUM_FRAMES / 1000:8.2f} us wall/frame")
+
+        # The bulk reader may skip straight to the newest of several frames, but must end on the same one
+        print(f"  final frame matches: {results['byte-wise'][-1:] == results['bulk'][-1:]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Compares the cost of decoding a frame's channels with the compiled decode table against the original function call
+# per channel, and against doing it with NumPy, along with the cost of filtering the sticks too. Every frame goes
+# through the receiver's public check_receive and read_all, so the raw channels line is the cost of receiving a frame
+# without decoding it. Also compares reading every channel with read_all against read_channel once per channel, and
+# checks filters chained after Smoothing and RateLimit against applying them one at a time.
+# Run from the piwarsengine directory with: python -m benchmarks.sbus_decode
+import math
+import os
+import numpy as np
+from select import select
+from timeit import timeit
+from comms.sbus import SBusReceiver, analog_decoder, analog_biased_decoder, binary_decoder, trinary_decoder, \
+    Deadband, Expo, RateLimit, Smoothing
+from benchmarks.sbus_check_receive import make_frame
+
+NUM_CHANNELS = 14
+FRAMES = 20000
+READS = 100000
+DECODERS = [analog_decoder] * 4 + [binary_decoder, analog_biased_decoder, trinary_decoder, binary_decoder] + \
+           [None] * (NUM_CHANNELS - 8)
+RAW = tuple(range(1000, 1000 + 75 * NUM_CHANNELS, 75))
+
+# Typical stick filtering, for the cost of filtering along with decoding
+FILTERS = {channel: (Deadband(0.05), Expo(0.3), Smoothing(0.02)) for channel in range(4)}
+
+# Stateful filters followed by non-linear ones, which must each carry on from their own output rather than the channel's
+CHAINED = {0: (Smoothing(0.1), Expo(1.0)), 1: (RateLimit(1.0), Deadband(0.2)), 2: (Expo(0.5), Smoothing(0.05))}
+CHAINED_FRAMES = 50
+
+
+def original_decode(channel_data):
+    # A copy of the original per-channel decode, kept as the reference to compare against
+    return tuple(data if decoder is None else decoder(data) for data, decoder in zip(channel_data, DECODERS))
+
+
+def numpy_decoder():
+    # The same decoders as NumPy operations over every channel at once
+    affine = np.array([decoder in (analog_decoder, analog_biased_decoder, None) for decoder in DECODERS])
+    centre = np.array([1500 if decoder is analog_decoder else 1000 if decoder is analog_biased_decoder else 0
+                       for decoder in DECODERS], dtype=np.float64)
+    span = np.array([500 if decoder is analog_decoder else 1000 if decoder is analog_biased_decoder else 1
+                     for decoder in DECODERS], dtype=np.float64)
+    high = np.array([1750 if decoder is trinary_decoder else 1500 for decoder in DECODERS], dtype=np.float64)
+    low = np.array([1250 if decoder is trinary_decoder else -1 for decoder in DECODERS], dtype=np.float64)
+
+    def decode(channel_data):
+        raw = np.array(channel_data, dtype=np.float64)
+        return tuple(np.where(affine, (raw - centre) / span, (raw > high) * 1.0 - (raw < low)).tolist())
+    return decode
+
+
+def reference_filter(filters, value, state, elapsed):
+    # The filters applied one at a time, with state holding each one's own output for the last frame
+    for k, channel_filter in enumerate(filters):
+        if isinstance(channel_filter, Deadband):
+            width = channel_filter.width
+            value = 0.0 if -width < value < width else (value - width if value > 0 else value + width) / (1 - width)
+        elif isinstance(channel_filter, Expo):
+            value = value * (1 - channel_filter.amount) + channel_filter.amount * value ** 3
+        elif isinstance(channel_filter, Smoothing):
+            value = state[k] = state[k] + (value - state[k]) / (1 + channel_filter.time_constant / elapsed)
+        elif isinstance(channel_filter, RateLimit):
+            value = state[k] = min(max(value, state[k] - channel_filter.rate * elapsed),
+                                   state[k] + channel_filter.rate * elapsed)
+    return value
+
+
+def check_chained_filters():
+    # Receive frames through filters chained after stateful ones, and compare each against the reference
+    feed = FrameFeed(DECODERS, CHAINED)
+    try:
+        decoded = original_decode(RAW)
+        states = {channel: [0.0] * len(filters) for channel, filters in CHAINED.items()}
+        received_ns = None
+        for _ in range(CHAINED_FRAMES):
+            channels = feed.step()
+            frame = feed.receiver.read_frame()
+            elapsed = math.inf if received_ns is None else (frame.received_ns - received_ns) / 1000000000
+            received_ns = frame.received_ns
+            for channel, filters in CHAINED.items():
+                expected = reference_filter(filters, decoded[channel], states[channel], elapsed)
+                if not math.isclose(channels[channel], expected, rel_tol=1e-9, abs_tol=1e-12):
+                    return False
+        return True
+    finally:
+        feed.close()
+
+
+class FrameFeed:
+    # A receiver on the far side of a pseudo-terminal, with a frame of RAW written in for it to receive at each step
+    def __init__(self, decoders=None, filters=None):
+        self.__master, slave = os.openpty()
+        self.__slave = slave
+        self.receiver = SBusReceiver(os.ttyname(slave), NUM_CHANNELS)
+        if decoders is not None:
+            self.receiver.assign_decode_table(decoders)
+        if filters is not None:
+            self.receiver.assign_filter_table(filters)
+        self.__frame = bytes(make_frame(RAW))
+        self.__fd = self.receiver.fileno()
+
+    def step(self):
+        # Receive one frame through check_receive and return its channels from read_all, as an application would.
+        # The pseudo-terminal passes the frame on in the background, so wait until it can be read
+        os.write(self.__master, self.__frame)
+        select([self.__fd], [], [], 1)
+        self.receiver.check_receive()
+        return self.receiver.read_all()
+
+    def close(self):
+        os.close(self.__master)
+        os.close(self.__slave)
+
+
+def main():
+    print(f"{NUM_CHANNELS} channels, {FRAMES} frames per run, each received with check_receive and read with read_all")
+    raw = FrameFeed()
+    table = FrameFeed(DECODERS)
+    filtered = FrameFeed(DECODERS, FILTERS)
+    try:
+        numpy_decode = numpy_decoder()
+        steps = (("raw channels", raw.step),
+                 ("original", lambda: original_decode(raw.step())),
+                 ("numpy", lambda: numpy_decode(raw.step())),
+                 ("decode table", table.step),
+                 ("with filters", filtered.step))
+        for name, step in steps:
+            seconds = timeit(step, number=FRAMES)
+            print(f"  {name:14} {seconds / FRAMES * 1e6:6.2f} us/frame")
+        print(f"  results match: {original_decode(raw.step()) == table.step()}")
+        print(f"  chained filters match: {check_chained_filters()}")
+
+        receiver = table.receiver
+        seconds = timeit(lambda: [receiver.read_channel(i) for i in range(NUM_CHANNELS)], number=READS)
+        print(f"\n  {'read_channel':14} {seconds / READS * 1e6:6.2f} us for every channel")
+        seconds = timeit(receiver.read_all, number=READS)
+        print(f"  {'read_all':14} {seconds / READS * 1e6:6.2f} us for every channel")
+    finally:
+        for feed in (raw, table, filtered):
+            feed.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Compares the CPU time spent per round trip by the blocking SerialComms.receive against the original spinning one,
+# and against SerialComms given a spin_ns, which blocks until just before a reply is expected and only spins from then.
+# All talk to a FakeDevice over a pseudo-terminal, which takes a little while to reply like a real Pico would. The
+# first few round trips with spin_ns, before it has learned when replies arrive, block the whole time. The fake device
+# shares the machine, and its own wait before replying runs late when the CPU has gone idle, which adds a little to the
+# blocking wall times.
+# Run from the piwarsengine directory with: python -m benchmarks.serial_receive
+import struct
+from serial import Serial
+from time import monotonic_ns, thread_time_ns, perf_counter_ns
+from comms.serial import SerialComms, COM_IDENTIFY_SEND, COM_IDENTIFY_RECV
+from benchmarks.fake_device import FakeDevice
+
+ROUND_TRIPS = 500
+REPLY_DELAYS = (0.0, 0.001, 0.005)
+SPIN_NS = 1000000
+
+
+class SpinningComms:
+    # A copy of the original send and spinning receive, kept as the reference to compare against
+    def __init__(self, serial_port):
+        self.__serial = Serial(serial_port, timeout=1)
+
+    def send(self, command, *data):
+        buffer = bytearray(command.length + SerialComms.FRAME_BYTES)
+        struct.pack_into(">BB" + command.format + "B", buffer, 0, SerialComms.START_BYTE, ord(command.value), *data, 0)
+        buffer[-1] = sum(buffer[:-1]) % 0x100
+        self.__serial.write(buffer)
+
+    def receive(self, command, timeout=SerialComms.DEFAULT_TIMEOUT):
+        end_ms = (monotonic_ns() // 1000000) + int(1000.0 * timeout + 0.5)
+        receive_length = command.length + SerialComms.FRAME_BYTES
+        while self.__serial.in_waiting < receive_length:
+            if end_ms - (monotonic_ns() // 1000000) <= 0:
+                raise TimeoutError("Serial did not reply within the expected time")
+
+        received = self.__serial.read(receive_length)
+        buffer = struct.unpack(">BB" + command.format + "B", received)
+        return buffer[2]
+
+
+def measure(comms_class, reply_delay):
+    handlers = {COM_IDENTIFY_SEND: lambda: (COM_IDENTIFY_RECV, 0x00)}
+    with FakeDevice(handlers, reply_delay) as device:
+        comms = comms_class(device.port)
+
+        cpu_start = thread_time_ns()
+        wall_start = perf_counter_ns()
+        for _ in range(ROUND_TRIPS):
+            comms.send(COM_IDENTIFY_SEND)
+            comms.receive(COM_IDENTIFY_RECV)
+        cpu_ns = thread_time_ns() - cpu_start
+        wall_ns = perf_counter_ns() - wall_start
+
+    return cpu_ns / ROUND_TRIPS, wall_ns / ROUND_TRIPS
+
+
+def main():
+    print(f"{ROUND_TRIPS} identify round trips per run")
+    for reply_delay in REPLY_DELAYS:
+        print(f"\nDevice reply delay of {reply_delay * 1000:.0f} ms")
+        for name, comms_class in (("spinning", SpinningComms), ("blocking", SerialComms),
+                                  ("spin 1 ms", lambda port: SerialComms(port, spin_ns=SPIN_NS))):
+            cpu_ns, wall_ns = measure(comms_class, reply_delay)
+            print(f"  {name:10} {cpu_ns / 1000:8.1f} us CPU/round trip, {wall_ns / 1000:8.1f} us wall/round trip")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Measures the throughput, latency and CPU cost of the serial and SBUS links against fake firmware on pseudo-terminals,
+# and writes the results to a JSON file. Given the results of an earlier run as a baseline, it also reports anything
+# that has got slower by more than the tolerance, and exits with an error if anything has.
+# Run from the piwarsengine directory with: python -m benchmarks.suite [--output results.json] [--baseline old.json]
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import numpy as np
+from select import select
+from threading import Thread
+from time import perf_counter_ns, thread_time_ns, time
+from comms.sbus import SBusReceiver
+from comms.serial import SerialComms
+from devices.motor_driver import MotorDriver, COM_SET_ALL_VELOCITIES, COM_READ_ENCODERS_RECV
+from devices.io_controller import IOController
+from benchmarks.fake_device import FakeDevice
+from benchmarks.fake_firmware import FakeMotorDriver, FakeIOController, FakeSBusTransmitter
+
+OPERATIONS = 5000
+SBUS_CHANNELS = 14
+IDLE_TIMEOUT = 0.5
+DEFAULT_OUTPUT = "benchmark_results.json"
+DEFAULT_TOLERANCE = 0.2
+
+VELOCITIES = (2000, -1000, 4500)
+ENCODERS = (100, -200, 300, -400)
+
+# For each result, whether a bigger number is better, used when comparing against a baseline
+METRICS = {
+    "frames_per_second": True,
+    "p50_us": False,
+    "p99_us": False,
+    "cpu_us_per_op": False,
+}
+
+
+def summarise(latencies_ns, cpu_ns, wall_ns, frames):
+    latencies_us = np.array(latencies_ns) / 1000
+    return {
+        "operations": len(latencies_ns),
+        "frames": frames,
+        "frames_per_second": frames / (wall_ns / 1e9),
+        "p50_us": float(np.percentile(latencies_us, 50)),
+        "p99_us": float(np.percentile(latencies_us, 99)),
+        "cpu_us_per_op": cpu_ns / len(latencies_ns) / 1000,
+    }
+
+
+def time_calls(operation, count):
+    # Times each call on its own for the latency percentiles, and the whole run for the throughput and CPU time
+    latencies_ns = [0] * count
+    cpu_start = thread_time_ns()
+    wall_start = perf_counter_ns()
+    for i in range(count):
+        call_start = perf_counter_ns()
+        operation()
+        latencies_ns[i] = perf_counter_ns() - call_start
+    cpu_ns = thread_time_ns() - cpu_start
+    wall_ns = perf_counter_ns() - wall_start
+    return latencies_ns, cpu_ns, wall_ns
+
+
+def bench_send(count):
+    with FakeMotorDriver() as device:
+        comms = SerialComms(device.port)
+        latencies_ns, cpu_ns, wall_ns = time_calls(lambda: comms.send(COM_SET_ALL_VELOCITIES, *VELOCITIES), count)
+    return summarise(latencies_ns, cpu_ns, wall_ns, count)
+
+
+def bench_receive(count):
+    # A writer thread keeps the port topped up with replies, so only the receiving side is being measured
+    reply = FakeDevice.encode(COM_READ_ENCODERS_RECV, *ENCODERS)
+    master, slave = os.openpty()
+    try:
+        comms = SerialComms(os.ttyname(slave))
+        writer = Thread(target=os.write, args=(master, bytes(reply) * count))
+        writer.start()
+        latencies_ns, cpu_ns, wall_ns = time_calls(lambda: comms.receive(COM_READ_ENCODERS_RECV), count)
+        writer.join()
+    finally:
+        os.close(master)
+        os.close(slave)
+    return summarise(latencies_ns, cpu_ns, wall_ns, count)
+
+
+def bench_identify(count):
+    with FakeMotorDriver() as device:
+        comms = SerialComms(device.port)
+        latencies_ns, cpu_ns, wall_ns = time_calls(comms.identify, count)
+    return summarise(latencies_ns, cpu_ns, wall_ns, count)
+
+
+def bench_read_encoders(count):
+    with FakeMotorDriver() as device:
+        motors = MotorDriver(SerialComms(device.port))
+        latencies_ns, cpu_ns, wall_ns = time_calls(motors.read_encoders, count)
+    return summarise(latencies_ns, cpu_ns, wall_ns, count)
+
+
+def bench_read_tofs(count):
+    # Each operation is four pipelined requests, so counts as four frames
+    with FakeIOController() as device:
+        io = IOController(SerialComms(device.port))
+        latencies_ns, cpu_ns, wall_ns = time_calls(io.read_tofs, count)
+    return summarise(latencies_ns, cpu_ns, wall_ns, count * 4)
+
+
+def bench_check_receive(count):
+    # The transmitter writes frames as fast as they are read. Only the calls made while there is data waiting are
+    # timed, so idle polling is not counted
+    with FakeSBusTransmitter(SBUS_CHANNELS, rate=None, frames=count) as transmitter:
+        receiver = SBusReceiver(transmitter.port, SBUS_CHANNELS)
+        fd = receiver.fileno()
+        latencies_ns = []
+        cpu_ns = 0
+        wall_start = perf_counter_ns()
+        while select([fd], [], [], IDLE_TIMEOUT)[0]:
+            cpu_start = thread_time_ns()
+            call_start = perf_counter_ns()
+            receiver.check_receive()
+            latencies_ns.append(perf_counter_ns() - call_start)
+            cpu_ns += thread_time_ns() - cpu_start
+        # Leave out the idle timeout that ended the run
+        wall_ns = perf_counter_ns() - wall_start - int(IDLE_TIMEOUT * 1e9)
+        frames = transmitter.sent
+    return summarise(latencies_ns, cpu_ns, wall_ns, frames)
+
+
+BENCHMARKS = {
+    "send": bench_send,
+    "receive": bench_receive,
+    "identify": bench_identify,
+    "read_encoders": bench_read_encoders,
+    "read_tofs": bench_read_tofs,
+    "check_receive": bench_check_receive,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # Returns a description of each metric that is worse than the baseline by more than the tolerance
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            if metric not in previous or previous[metric] == 0:
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if (-change if bigger_is_better else change) > tolerance:
+                regressions.append(f"{name} {metric}: {previous[metric]:.1f} -> {result[metric]:.1f} "
+                                   f"({change * 100:+.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the serial and SBUS links against fake firmware")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the JSON results")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="how much worse than the baseline a result can be before it counts as a regression")
+    parser.add_argument("--operations", type=int, default=OPERATIONS, help="operations per benchmark")
+    parser.add_argument("benchmarks", nargs="*", help=f"the benchmarks to run, from {', '.join(BENCHMARKS)}. "
+                                                      f"All of them by default")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        result = results[name] = BENCHMARKS[name](args.operations)
+        print(f"{name:14} {result['frames_per_second']:10.0f} frames/s, p50 {result['p50_us']:8.1f} us, "
+              f"p99 {result['p99_us']:8.1f} us, {result['cpu_us_per_op']:7.1f} us CPU/op")
+
+    with open(args.output, "w") as output_file:
+        json.dump({
+            "timestamp": time(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "operations": args.operations,
+            "results": results,
+        }, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
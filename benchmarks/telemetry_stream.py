@@ -0,0 +1,72 @@
+# Compares polling the Motor Driver's encoders against having it stream them, in link bytes per sample, how long
+# the control loop is held up getting each sample, and how old the sample is when it gets it.
+# Run from the piwarsengine directory with: python -m benchmarks.telemetry_stream
+from time import monotonic_ns, sleep
+from comms.serial import SerialComms
+from devices import MotorDriver
+from benchmarks.fake_firmware import FakeMotorDriver
+
+RATE = 100
+DURATION = 2.0
+REPLY_DELAY = 0.001
+
+
+def link_bytes(comms):
+    counters = comms.stats()["counters"]
+    return counters.get("bytes_in", 0) + counters.get("bytes_out", 0)
+
+
+def measure_polling():
+    # The control loop asks for the encoders each period and waits for the reply
+    with FakeMotorDriver(REPLY_DELAY) as device:
+        comms = SerialComms(device.port)
+        motors = MotorDriver(comms)
+        samples = 0
+        blocked_ns = 0
+        end_ns = monotonic_ns() + int(DURATION * 1e9)
+        while monotonic_ns() < end_ns:
+            start_ns = monotonic_ns()
+            motors.read_encoders()
+            blocked_ns += monotonic_ns() - start_ns
+            samples += 1
+            sleep(1 / RATE)
+
+        # The reading was taken about half way through the round trip
+        return samples, link_bytes(comms), blocked_ns / samples, blocked_ns / samples / 2
+
+
+def measure_streaming():
+    # The Motor Driver pushes the encoders each period, and the control loop just looks at the latest
+    with FakeMotorDriver(REPLY_DELAY) as device:
+        comms = SerialComms(device.port)
+        motors = MotorDriver(comms)
+        motors.stream_encoders(RATE)
+        sleep(0.1)
+        comms.reset_stats()
+
+        looks = 0
+        blocked_ns = 0
+        age_ns = 0
+        end_ns = monotonic_ns() + int(DURATION * 1e9)
+        while monotonic_ns() < end_ns:
+            start_ns = monotonic_ns()
+            _, received_ns = motors.latest_encoders()
+            blocked_ns += monotonic_ns() - start_ns
+            age_ns += start_ns - received_ns
+            looks += 1
+            sleep(1 / RATE)
+        samples = comms.stats()["commands"]["?"]["received"]
+        motors.stop_streams()
+        return samples, link_bytes(comms), blocked_ns / looks, age_ns / looks
+
+
+def main():
+    print(f"Encoders at {RATE} Hz for {DURATION} s, with the device taking {REPLY_DELAY * 1000:.0f} ms to reply")
+    for name, measure in (("polling", measure_polling), ("streaming", measure_streaming)):
+        samples, total_bytes, blocked_ns, age_ns = measure()
+        print(f"  {name:10} {samples:5} samples, {total_bytes / samples:5.1f} link bytes/sample, "
+              f"loop held up {blocked_ns / 1000:7.1f} us/sample, sample age {age_ns / 1e6:5.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+from threading import Lock
+
+
+class AdaptiveTimeout:
+    # Learns how long each reply command usually takes to arrive, so a lost reply can be given up on after a few
+    # milliseconds instead of a whole second. The timeout for a command is the percentile of its recent round trip
+    # latencies times the margin, kept between the floor and the ceiling, in seconds. Until enough latencies have
+    # been seen, the ceiling is used
+    PERCENTILE = 99
+    MARGIN = 3.0
+    FLOOR = 0.01
+    CEILING = 1.0
+
+    # How many of the most recent latencies are kept for each command, how many must be seen before the timeout
+    # is worked out from them, and how many new ones are needed before it is worked out again
+    WINDOW = 256
+    MIN_SAMPLES = 20
+    RECALCULATE_EVERY = 16
+
+    def __init__(self, percentile=PERCENTILE, margin=MARGIN, floor=FLOOR, ceiling=CEILING):
+        self.__percentile = percentile
+        self.__margin = margin
+        self.__floor = floor
+        self.__ceiling = ceiling
+
+        # Each command's latencies as a ring buffer in nanoseconds, the position of the next one, how many have been
+        # seen in total, and its timeout as last worked out
+        self.__commands = {}
+        self.__lock = Lock()
+
+    def record(self, command, latency_ns):
+        with self.__lock:
+            entry = self.__commands.get(command.value)
+            if entry is None:
+                entry = self.__commands[command.value] = [[0] * self.WINDOW, 0, 0, self.__ceiling]
+
+            samples, head, seen, _ = entry
+            samples[head] = latency_ns
+            entry[1] = (head + 1) % self.WINDOW
+            entry[2] = seen = seen + 1
+
+            # Sorting the window is only worth doing every so often, as the percentile barely moves between latencies
+            if seen >= self.MIN_SAMPLES and (seen == self.MIN_SAMPLES or seen % self.RECALCULATE_EVERY == 0):
+                window = sorted(samples[:min(seen, self.WINDOW)])
+                latency = window[min(int(len(window) * self.__percentile / 100), len(window) - 1)] / 1000000000
+                entry[3] = min(max(latency * self.__margin, self.__floor), self.__ceiling)
+
+    def timeout(self, commands):
+        # The timeout in seconds for the replies to one or more commands, which is the longest of theirs. The
+        # latencies of pipelined replies include waiting for the ones ahead of them, so are already long enough to
+        # cover the whole pipeline
+        with self.__lock:
+            return max((self.__commands[command.value][3] if command.value in self.__commands else self.__ceiling
+                        for command in commands), default=self.__ceiling)
+
+    def learned(self, commands):
+        # Whether every one of the commands has a timeout worked out from its latencies, rather than the ceiling
+        with self.__lock:
+            return all(command.value in self.__commands and self.__commands[command.value][2] >= self.MIN_SAMPLES
+                       for command in commands)
+
+    def reset(self):
+        with self.__lock:
+            self.__commands = {}
+
+    def snapshot(self):
+        # The current timeout for each command in seconds, and how many latencies it was learned from
+        with self.__lock:
+            return {value: {"timeout": entry[3], "samples": entry[2]} for value, entry in self.__commands.items()}
@@ -0,0 +1,250 @@
+import asyncio
+import os
+from serial import Serial
+from time import monotonic_ns
+from comms.adaptive_timeout import AdaptiveTimeout
+from comms.link_stats import LinkStats
+from comms.priority_lock import AsyncPriorityLock
+from comms.serial import Command, CorruptedReplyError, SerialComms, COM_POKE_SEND, COM_IDENTIFY_SEND, COM_IDENTIFY_RECV
+from comms.traffic_log import RX, TX
+
+
+class AsyncSerialComms:
+    READ_SIZE = 4096
+
+    DEFAULT_TIMEOUT = SerialComms.DEFAULT_TIMEOUT
+    TIMEOUT_RETRIES = SerialComms.TIMEOUT_RETRIES
+
+    SAFETY_PRIORITY = SerialComms.SAFETY_PRIORITY
+    SETPOINT_PRIORITY = SerialComms.SETPOINT_PRIORITY
+    DEFAULT_PRIORITY = SerialComms.DEFAULT_PRIORITY
+
+    # Nothing is ever subscribed to, so the frame parser only ever looks for the reply being waited for
+    NO_STREAMS = {}
+
+    def __init__(self, serial_port='/dev/ttyACM0', recorder=None, adaptive_timeout=None,
+                 timeout_retries=TIMEOUT_RETRIES):
+        # The port is opened non-blocking, with the event loop telling us when it can be read or written
+        self.__serial = Serial(serial_port, timeout=0)
+        self.__fd = self.__serial.fileno()
+        self.__loop = None
+
+        # Optionally log everything sent and received, to be replayed later
+        self.__recorder = recorder
+        self.__recorder_port = recorder.port(serial_port) if recorder is not None else None
+
+        # Everything received is buffered as it arrives, and replies are picked out of it by the same frame parser
+        # SerialComms uses while subscribed, which skips over noise and anything that isn't the reply being waited for
+        self.__rx_buffer = bytearray()
+        self.__rx_event = asyncio.Event()
+
+        # Held for the duration of each request/reply pair, so coroutines sharing the device don't interleave. Each
+        # request command can be given a priority, which the reply to it shares
+        self.__lock = AsyncPriorityLock()
+        self.__priorities = {}
+
+        # The same always-on stats and learned reply timeouts as SerialComms
+        self.__stats = LinkStats()
+        self.__adaptive_timeout = adaptive_timeout if adaptive_timeout is not None \
+            else AdaptiveTimeout(ceiling=self.DEFAULT_TIMEOUT)
+        self.__timeout_retries = timeout_retries
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.__loop is not None and not self.__loop.is_closed():
+            self.__loop.remove_reader(self.__fd)
+            self.__loop = None
+
+        if self.__serial.isOpen():
+            self.__serial.close()
+
+    def stats(self):
+        # The same as SerialComms.stats
+        stats = self.__stats.snapshot()
+        stats["reply_timeouts"] = self.__adaptive_timeout.snapshot()
+        stats["queue_wait"] = self.__lock.waits()
+        return stats
+
+    def reset_stats(self):
+        self.__stats.reset()
+        self.__lock.reset_waits()
+
+    def set_priority(self, command: Command, priority):
+        # Requests of command jump ahead of any with a lower priority that are waiting for the link
+        self.__priorities[command.code] = priority
+
+    def __start_reading(self):
+        # The reader is added the first time the port is used, as that is when we know which loop is running
+        if self.__loop is None:
+            self.__loop = asyncio.get_running_loop()
+            self.__loop.add_reader(self.__fd, self.__on_readable)
+
+    def __on_readable(self):
+        try:
+            data = os.read(self.__fd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            return
+
+        self.__rx_buffer += data
+        self.__stats.count("bytes_in", len(data))
+        if self.__recorder is not None:
+            self.__recorder.record(self.__recorder_port, RX, data)
+        self.__rx_event.set()
+
+    async def __wait_writable(self):
+        writable = self.__loop.create_future()
+        self.__loop.add_writer(self.__fd, writable.set_result, None)
+        try:
+            await writable
+        finally:
+            self.__loop.remove_writer(self.__fd)
+
+    async def __write(self, buffer):
+        self.__start_reading()
+        self.__stats.count("bytes_out", len(buffer))
+        if self.__recorder is not None:
+            self.__recorder.record(self.__recorder_port, TX, buffer)
+
+        buffer = memoryview(buffer)
+        while buffer:
+            try:
+                buffer = buffer[os.write(self.__fd, buffer):]
+            except BlockingIOError:
+                await self.__wait_writable()
+
+    async def __send_all(self, requests):
+        await self.__write(b"".join(SerialComms.encode(*request) for request in requests))
+        for request in requests:
+            self.__stats.count_command(request[0], "sent")
+
+    def __discard_received(self):
+        # Nothing that arrived before a request is sent can be the reply to it, such as a reply that turned up after
+        # its own request timed out, so it is thrown away rather than taken for the reply to this one
+        self.__on_readable()
+        if self.__rx_buffer:
+            self.__stats.count("skipped_bytes", len(self.__rx_buffer))
+            self.__rx_buffer.clear()
+
+    async def send(self, command: Command, *data):
+        async with self.__lock.prioritised(self.__priorities.get(command.code, self.DEFAULT_PRIORITY)):
+            await self.__send_all(((command, *data),))
+
+    async def send_all(self, requests):
+        # Each request is a tuple of the command followed by its data. All are written out in a single burst
+        async with self.__lock.prioritised(self.__priority(request[0] for request in requests)):
+            await self.__send_all(requests)
+
+    async def __receive(self, command: Command, sent_ns=None):
+        # A corrupted reply raises ValueError, so the replies behind it are still taken for the right requests
+        while True:
+            found, values, _ = SerialComms.parse_frames(self.__rx_buffer, self.NO_STREAMS, command, self.__stats,
+                                                        corrupted_replies=True)
+            if found:
+                if values is None:
+                    raise ValueError(f"Corrupted {command.value} reply")
+                if sent_ns is not None:
+                    latency_ns = monotonic_ns() - sent_ns
+                    self.__stats.record_latency(command, latency_ns)
+                    self.__adaptive_timeout.record(command, latency_ns)
+                return values
+
+            self.__rx_event.clear()
+            await self.__rx_event.wait()
+
+    async def __receive_each(self, commands, timeout, sent_ns=None):
+        # Receive a reply for each command in order, with the timeout covering all of them. With no timeout, it is
+        # learned from how long replies of these commands usually take. The same as SerialComms.__receive_each,
+        # returning the replies with None for each corrupted or missing one, and the positions of each
+        replies = []
+        corrupted = []
+
+        async def receive_each():
+            for i, command in enumerate(commands):
+                try:
+                    replies.append(await self.__receive(command, sent_ns))
+                except ValueError:
+                    replies.append(None)
+                    corrupted.append(i)
+
+        self.__start_reading()
+        try:
+            await asyncio.wait_for(receive_each(), self.__adaptive_timeout.timeout(commands) if timeout is None
+                                   else timeout)
+        except asyncio.TimeoutError:
+            self.__stats.count("timeouts")
+        missing = list(range(len(replies), len(commands)))
+        return replies + [None] * len(missing), corrupted, missing
+
+    async def receive(self, command: Command, timeout=None):
+        # Any partial reply stays buffered if the timeout is reached, as it would have in the port
+        async with self.__lock:
+            replies, corrupted, missing = await self.__receive_each((command,), timeout)
+        if missing:
+            raise TimeoutError("Serial did not reply within the expected time")
+        if corrupted:
+            raise ValueError(f"Corrupted {command.value} reply")
+        return replies[0]
+
+    async def receive_all(self, commands, timeout=None):
+        async with self.__lock:
+            replies, corrupted, missing = await self.__receive_each(commands, timeout)
+        if missing:
+            raise TimeoutError("Serial did not reply within the expected time")
+        if corrupted:
+            raise CorruptedReplyError(f"{len(corrupted)} of {len(commands)} replies were corrupted", replies)
+        return replies
+
+    async def query(self, send_command: Command, receive_command: Command, *data, timeout=None, retries=0):
+        # Send a request and wait for its reply, without another coroutine getting in between. A corrupted reply is
+        # asked for again up to retries times. With no timeout given, it is learned from how long replies of this
+        # command usually take, and once it has been, a reply that doesn't arrive in time is asked for again up to
+        # timeout_retries times
+        replies = await self.pipeline(((send_command, *data),), (receive_command,), timeout, retries)
+        return replies[0]
+
+    async def pipeline(self, requests, replies, timeout=None, retries=0):
+        # Send several requests at once and then collect their replies, so they share a single round trip. Only the
+        # requests whose replies were corrupted or didn't arrive are sent again, in the same way as for query
+        timeout_retries = self.__timeout_retries if timeout is None and self.__adaptive_timeout.learned(replies) else 0
+        async with self.__lock.prioritised(self.__priority(request[0] for request in requests)):
+            self.__start_reading()
+            results = [None] * len(replies)
+            pending = list(range(len(replies)))
+            while True:
+                commands = [replies[i] for i in pending]
+                self.__discard_received()
+                sent_ns = monotonic_ns()
+                await self.__send_all([requests[i] for i in pending])
+                received, corrupted, missing = await self.__receive_each(commands, timeout, sent_ns)
+                for i, reply in zip(pending, received):
+                    results[i] = reply
+
+                if missing:
+                    if timeout_retries == 0:
+                        raise TimeoutError("Serial did not reply within the expected time")
+                    timeout_retries -= 1
+                elif corrupted:
+                    if retries == 0:
+                        raise CorruptedReplyError(f"{len(corrupted)} of {len(replies)} replies were corrupted",
+                                                  results)
+                    retries -= 1
+                else:
+                    return results
+
+                # The corrupted replies all come before any that are missing, so the order is kept
+                pending = [pending[i] for i in corrupted + missing]
+                self.__stats.count("retries", len(pending))
+
+    def __priority(self, commands):
+        return max((self.__priorities.get(command.code, self.DEFAULT_PRIORITY) for command in commands),
+                   default=self.DEFAULT_PRIORITY)
+
+    async def poke(self):
+        await self.send(COM_POKE_SEND)
+
+    async def identify(self, timeout=DEFAULT_TIMEOUT):
+        return await self.query(COM_IDENTIFY_SEND, COM_IDENTIFY_RECV, timeout=timeout)
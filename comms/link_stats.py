@@ -0,0 +1,167 @@
+import json
+from threading import Event, Lock, Thread
+from time import monotonic_ns
+
+
+class LatencyHistogram:
+    # Bucket i counts latencies under 2**i microseconds that didn't fit in the bucket before, so recording one is
+    # just a bit_length. The last bucket takes everything from about 4 seconds up
+    BUCKETS = 24
+
+    def __init__(self):
+        self.__buckets = [0] * self.BUCKETS
+        self.__count = 0
+        self.__total_ns = 0
+        self.__min_ns = None
+        self.__max_ns = None
+
+    def record(self, latency_ns):
+        self.__buckets[min((latency_ns // 1000).bit_length(), self.BUCKETS - 1)] += 1
+        self.__count += 1
+        self.__total_ns += latency_ns
+        if self.__min_ns is None or latency_ns < self.__min_ns:
+            self.__min_ns = latency_ns
+        if self.__max_ns is None or latency_ns > self.__max_ns:
+            self.__max_ns = latency_ns
+
+    def percentile(self, percent):
+        # An estimate in microseconds, rounded up to the top of the bucket the percentile falls in
+        if self.__count == 0:
+            return None
+
+        target = self.__count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.__buckets):
+            seen += count
+            if seen >= target:
+                return min(2 ** i, self.__max_ns / 1000)
+        return self.__max_ns / 1000
+
+    def snapshot(self):
+        if self.__count == 0:
+            return {"count": 0}
+
+        return {
+            "count": self.__count,
+            "mean_us": self.__total_ns / self.__count / 1000,
+            "min_us": self.__min_ns / 1000,
+            "max_us": self.__max_ns / 1000,
+            "p50_us": self.percentile(50),
+            "p99_us": self.percentile(99),
+            # Keyed by the top of each bucket in microseconds, leaving out the empty ones
+            "buckets": {2 ** i: count for i, count in enumerate(self.__buckets) if count},
+        }
+
+
+class LinkStats:
+    # Good frames are counted over windows of at least this long to work out the frame rate
+    RATE_WINDOW = 1.0
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__counters = {}
+            self.__commands = {}
+            self.__latencies = {}
+            self.__last_good_ns = None
+            self.__window_start_ns = None
+            self.__window_frames = 0
+            self.__rate = None
+
+    def count(self, name, amount=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def count_command(self, command, direction):
+        # Counts a frame of the given command going in the given direction, "sent" or "received"
+        with self.__lock:
+            counts = self.__commands.get(command.value)
+            if counts is None:
+                counts = self.__commands[command.value] = {"sent": 0, "received": 0}
+            counts[direction] += 1
+
+    def count_sent(self, command, length):
+        # Counts a frame of the given command and its bytes going out, together under one hold of the lock
+        with self.__lock:
+            counts = self.__commands.get(command.value)
+            if counts is None:
+                counts = self.__commands[command.value] = {"sent": 0, "received": 0}
+            counts["sent"] += 1
+            self.__counters["bytes_out"] = self.__counters.get("bytes_out", 0) + length
+
+    def record_latency(self, command, latency_ns):
+        # The time from sending a request to receiving the given reply command
+        with self.__lock:
+            histogram = self.__latencies.get(command.value)
+            if histogram is None:
+                histogram = self.__latencies[command.value] = LatencyHistogram()
+            histogram.record(latency_ns)
+
+    def good(self, frames=1):
+        # Marks the arrival of good frames, for the frame rate and time since the last good frame
+        now_ns = monotonic_ns()
+        with self.__lock:
+            self.__last_good_ns = now_ns
+            if self.__window_start_ns is None:
+                self.__window_start_ns = now_ns
+                return
+
+            self.__window_frames += frames
+            elapsed_ns = now_ns - self.__window_start_ns
+            if elapsed_ns >= self.RATE_WINDOW * 1000000000:
+                self.__rate = self.__window_frames * 1000000000 / elapsed_ns
+                self.__window_start_ns = now_ns
+                self.__window_frames = 0
+
+    def snapshot(self):
+        # A copy of everything counted so far, which is safe to keep and pass around
+        with self.__lock:
+            commands = {value: dict(counts) for value, counts in self.__commands.items()}
+            for value, histogram in self.__latencies.items():
+                commands.setdefault(value, {"sent": 0, "received": 0})["round_trip"] = histogram.snapshot()
+
+            return {
+                "counters": dict(self.__counters),
+                "commands": commands,
+                "frame_rate": self.__rate,
+                "since_last_good": None if self.__last_good_ns is None
+                else (monotonic_ns() - self.__last_good_ns) / 1000000000,
+            }
+
+
+class StatsDumper:
+    # Periodically takes the stats() of each named source and passes them to output, which prints them as JSON
+    # by default
+    def __init__(self, sources, period=5.0, output=None):
+        self.__sources = dict(sources)
+        self.__period = period
+        self.__output = output if output is not None else lambda stats: print(json.dumps(stats))
+
+        self.__stop_event = Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def dump(self):
+        self.__output({name: source.stats() for name, source in self.__sources.items()})
+
+    def __run(self):
+        while not self.__stop_event.wait(self.__period):
+            self.dump()
@@ -0,0 +1,227 @@
+import asyncio
+from heapq import heapify, heappop, heappush
+from itertools import count
+from threading import Condition, Lock, get_ident
+from time import monotonic_ns
+from comms.link_stats import LatencyHistogram
+
+
+class PriorityLock:
+    # A reentrant lock that, whenever it is released with threads waiting, is handed straight to the one with the
+    # highest priority, or of those the one that has been waiting longest. Taking and releasing it when nobody is
+    # waiting never touches the guard, so costs a non-blocking try and a release of a plain Lock. A thread taking
+    # it in the moment between a release and the handoff gets it first, and hands it on when it lets go. How many
+    # times it was taken and how long any waits were is kept by priority
+    DEFAULT_PRIORITY = 0
+
+    def __init__(self):
+        # Held by whichever thread owns this lock. The guard protects the rest, and is what waiting threads wait on
+        self.__mutex = Lock()
+        self.__guard = Lock()
+        self.__condition = Condition(self.__guard)
+        self.__owner = None
+        self.__depth = 0
+
+        # A heap of (-priority, ticket) for each waiting thread, so the first is the next to be handed the lock,
+        # along with the ticket of the one it has been handed to
+        self.__waiting = []
+        self.__tickets = count()
+        self.__handed_to = None
+
+        # A one item list counting acquires for each priority. Priorities are only ever added under the guard, so
+        # waits() can go through them while the owner counts its acquire without the guard
+        self.__acquired = {}
+        self.__waits = {}
+        self.__holds = {}
+
+    def acquire(self, priority=DEFAULT_PRIORITY):
+        me = get_ident()
+        if self.__owner == me:
+            self.__depth += 1
+            return
+
+        if not self.__mutex.acquire(False):
+            self.__wait(priority)
+
+        self.__owner = me
+        self.__depth = 1
+        acquired = self.__acquired.get(priority)
+        if acquired is None:
+            with self.__guard:
+                acquired = self.__acquired.setdefault(priority, [0])
+        acquired[0] += 1
+
+    def __wait(self, priority):
+        start_ns = monotonic_ns()
+        with self.__guard:
+            # Trying again only after joining the queue means an owner letting go either leaves the mutex free for
+            # this try, or finds the queue not empty and hands the lock over
+            ticket = next(self.__tickets)
+            entry = (-priority, ticket)
+            heappush(self.__waiting, entry)
+            if self.__mutex.acquire(False):
+                self.__waiting.remove(entry)
+                heapify(self.__waiting)
+                return
+
+            while self.__handed_to != ticket:
+                self.__condition.wait()
+            self.__handed_to = None
+
+            histogram = self.__waits.get(priority)
+            if histogram is None:
+                histogram = self.__waits[priority] = LatencyHistogram()
+            histogram.record(monotonic_ns() - start_ns)
+
+    def release(self):
+        if self.__owner != get_ident():
+            raise RuntimeError("cannot release un-acquired lock")
+
+        self.__depth -= 1
+        if self.__depth > 0:
+            return
+
+        self.__owner = None
+        self.__mutex.release()
+        if self.__waiting:
+            self.__hand_over()
+
+    def __hand_over(self):
+        with self.__guard:
+            # Whoever has taken the mutex since it was let go hands it over in turn when they release it
+            if self.__waiting and self.__mutex.acquire(False):
+                self.__handed_to = heappop(self.__waiting)[1]
+                self.__condition.notify_all()
+
+    def prioritised(self, priority):
+        # For use in a with statement, taking the lock at the given priority
+        hold = self.__holds.get(priority)
+        if hold is None:
+            hold = self.__holds[priority] = PriorityHold(self, priority)
+        return hold
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def waits(self):
+        # For each priority, how many times the lock was taken, and how long it took when it had to be waited for
+        with self.__guard:
+            return {priority: {"acquired": acquired[0], "waited": self.__waits[priority].snapshot()
+                               if priority in self.__waits else {"count": 0}}
+                    for priority, acquired in sorted(self.__acquired.items())}
+
+    def reset_waits(self):
+        with self.__guard:
+            self.__acquired = {}
+            self.__waits = {}
+
+
+class PriorityHold:
+    def __init__(self, lock: PriorityLock, priority):
+        self.__lock = lock
+        self.__priority = priority
+
+    def __enter__(self):
+        self.__lock.acquire(self.__priority)
+
+    def __exit__(self, *args):
+        self.__lock.release()
+
+
+class AsyncPriorityLock:
+    # The same as PriorityLock, for coroutines sharing one event loop. They only switch at an await, so nothing needs
+    # guarding, and the lock is handed straight to the waiting coroutine with the highest priority, or of those the
+    # one that has been waiting longest. Unlike PriorityLock it isn't reentrant
+    DEFAULT_PRIORITY = PriorityLock.DEFAULT_PRIORITY
+
+    def __init__(self):
+        self.__locked = False
+
+        # A heap of (-priority, ticket, future) for each waiting coroutine, whose future is set to hand it the lock
+        self.__waiting = []
+        self.__tickets = count()
+
+        self.__acquired = {}
+        self.__waits = {}
+        self.__holds = {}
+
+    async def acquire(self, priority=DEFAULT_PRIORITY):
+        if self.__locked:
+            await self.__wait(priority)
+
+        self.__locked = True
+        self.__acquired[priority] = self.__acquired.get(priority, 0) + 1
+
+    async def __wait(self, priority):
+        start_ns = monotonic_ns()
+        future = asyncio.get_running_loop().create_future()
+        entry = (-priority, next(self.__tickets), future)
+        heappush(self.__waiting, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # It was handed over just as the wait was cancelled, so pass it on
+                self.release()
+            elif entry in self.__waiting:
+                self.__waiting.remove(entry)
+                heapify(self.__waiting)
+            raise
+
+        histogram = self.__waits.get(priority)
+        if histogram is None:
+            histogram = self.__waits[priority] = LatencyHistogram()
+        histogram.record(monotonic_ns() - start_ns)
+
+    def release(self):
+        if not self.__locked:
+            raise RuntimeError("cannot release un-acquired lock")
+
+        # Hand the lock over without unlocking it, so nobody can take it in between. Cancelled waits are skipped
+        while self.__waiting:
+            future = heappop(self.__waiting)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.__locked = False
+
+    def locked(self):
+        return self.__locked
+
+    def prioritised(self, priority):
+        # For use in an async with statement, taking the lock at the given priority
+        hold = self.__holds.get(priority)
+        if hold is None:
+            hold = self.__holds[priority] = AsyncPriorityHold(self, priority)
+        return hold
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *args):
+        self.release()
+
+    def waits(self):
+        # For each priority, how many times the lock was taken, and how long it took when it had to be waited for
+        return {priority: {"acquired": acquired, "waited": self.__waits[priority].snapshot()
+                           if priority in self.__waits else {"count": 0}}
+                for priority, acquired in sorted(self.__acquired.items())}
+
+    def reset_waits(self):
+        self.__acquired = {}
+        self.__waits = {}
+
+
+class AsyncPriorityHold:
+    def __init__(self, lock: AsyncPriorityLock, priority):
+        self.__lock = lock
+        self.__priority = priority
+
+    async def __aenter__(self):
+        await self.__lock.acquire(self.__priority)
+
+    async def __aexit__(self, *args):
+        self.__lock.release()
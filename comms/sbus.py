@@ -1,6 +1,33 @@
+import asyncio
+import math
 import struct
+from collections import namedtuple
+from select import select
 from serial import Serial
+from threading import Condition, Lock, Thread
 from time import monotonic_ns
+from comms.link_stats import LinkStats
+from comms.traffic_log import RX
+
+# An immutable snapshot of the decoded channel values, along with when the frame they came from was received
+SBusFrame = namedtuple("SBusFrame", ("channels", "received_ns", "sequence"))
+
+# Declarative channel decoders, which the receiver compiles together into one expression evaluated once per frame.
+# Affine maps centre to 0 and centre +/- span to +/-1, with anything within deadband of 0 reported as 0.
+# Threshold gives 1 above level, otherwise 0. TriState gives 1 above high, -1 below low, otherwise 0
+Affine = namedtuple("Affine", ("centre", "span", "deadband"), defaults=(0.0,))
+Threshold = namedtuple("Threshold", ("level",))
+TriState = namedtuple("TriState", ("low", "high"))
+
+# Declarative channel filters, applied in order to a channel's decoded value and compiled in along with the decoders.
+# Deadband reports anything within width of 0 as 0, rescaling the rest so it still reaches +/-1 without a jump.
+# Expo softens the response around the centre, from 0 for linear to 1 for fully cubic. Smoothing is a low-pass
+# filter with the given time constant in seconds. RateLimit stops the value changing faster than rate per second.
+# Smoothing and RateLimit start again from the first frame received after the connection was lost
+Deadband = namedtuple("Deadband", ("width",))
+Expo = namedtuple("Expo", ("amount",))
+Smoothing = namedtuple("Smoothing", ("time_constant",))
+RateLimit = namedtuple("RateLimit", ("rate",))
 
 
 class SBusReceiver():
@@ -10,15 +37,19 @@ class SBusReceiver():
     MAX_CHANNELS = 14
     DEFAULT_COMMS_TIMEOUT = 1.0
 
-    def __init__(self, serial_port, num_channels, no_comms_timeout=DEFAULT_COMMS_TIMEOUT):
+    def __init__(self, serial_port, num_channels, no_comms_timeout=DEFAULT_COMMS_TIMEOUT, recorder=None):
         self.__serial = Serial(serial_port, self.BAUD_RATE, timeout=1)
+
+        # Optionally log everything received, to be replayed later
+        self.__recorder = recorder
+        self.__recorder_port = recorder.port(serial_port) if recorder is not None else None
         self.__no_comms_timeout_ms = int(no_comms_timeout * 1000)
         self.__last_received_ms = 0
         self.__timeout_reached = True       # Set as true initially so the timeout callback does not get called immediately
 
-        self.__receiving = False
-        self.__rx_buffer = bytearray(self.FRAME_LENGTH)
-        self.__rx_index = 0
+        # Holds any received bytes that have not yet been processed, which will always begin at the start of a frame
+        self.__rx_buffer = bytearray()
+        self.__frame_start = bytes((self.FRAME_START,))
 
         if num_channels < 1 or num_channels > self.MAX_CHANNELS:
             raise ValueError(f"num_channels out of range. Expected 1 to {self.MAX_CHANNELS}")
@@ -26,7 +57,30 @@ class SBusReceiver():
         self.__num_channels = num_channels
         self.__channel_format = "<" + "H" * self.__num_channels
         self.__channel_decoders = [None] * self.__num_channels
-        self.__channel_data = [0] * self.__num_channels
+        self.__channel_filters = [()] * self.__num_channels
+        self.__decode = self.__compile_decoders(self.__channel_decoders, self.__channel_filters)
+        self.__channel_data = (0,) * self.__num_channels
+
+        # Each Smoothing and RateLimit filter's own output for the latest frame, which it carries on from next frame.
+        # Published along with the frame, as a filter's output isn't the channel's when other filters follow it
+        self.__filter_state = ()
+
+        # The latest frame is published under this condition, so the reader thread can wake up anyone waiting on it
+        self.__condition = Condition()
+        self.__frame = SBusFrame(self.__channel_data, 0, 0)
+        self.__consumed_sequence = 0
+
+        self.__reader_thread = None
+        self.__reader_running = False
+
+        # Functions to call when a channel's value changes or crosses a level, by channel, and when the connection
+        # is gained or lost. They are replaced rather than changed in place, so the frame parser never needs the lock
+        self.__handlers_lock = Lock()
+        self.__channel_handlers = {}
+        self.__connection_handlers = ()
+
+        # Always-on counts of bytes, frames and errors, along with the frame rate and time since the last good frame
+        self.__stats = LinkStats()
 
         # Clear the receive buffer
         while self.__serial.in_waiting > 0:
@@ -38,77 +92,424 @@ class SBusReceiver():
     def num_channels(self):
         return self.__num_channels
 
-    def read_channel(self, channel):
-        if channel < 0 or channel >= self.__num_channels:
-            raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
+    def stats(self):
+        return self.__stats.snapshot()
 
-        data = self.__channel_data[channel]
-        if self.__channel_decoders[channel] is not None:
-            data = self.__channel_decoders[channel](data)
+    def reset_stats(self):
+        self.__stats.reset()
 
-        return data
+    def fileno(self):
+        # Lets an event loop watch the port and call check_receive only when data has arrived
+        return self.__serial.fileno()
 
-    def assign_channel_decoder(self, channel, decoder_func):
+    def read_channel(self, channel):
         if channel < 0 or channel >= self.__num_channels:
             raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
 
-        self.__channel_decoders[channel] = decoder_func
+        return self.__frame.channels[channel]
 
-    def check_receive(self, debug=False):
-        newly_received = False
-
-        while self.__serial.in_waiting > 0:
-            rx_byte = self.__serial.read(1)[0]
+    def read_frame(self):
+        return self.__frame
 
-            # If we're not receiving, check if the byte signifies the start of the frame, and switch to receiving
-            if not self.__receiving and rx_byte == self.FRAME_START:
-                self.__receiving = True
-                self.__rx_index = 0
+    def read_all(self, out=None):
+        # Every decoded channel of the latest frame at once. Pass a preallocated list or NumPy array as out to have
+        # them copied into it, rather than getting the frame's own tuple back
+        channels = self.__frame.channels
+        if out is None:
+            return channels
 
-            if self.__receiving:
-                self.__rx_buffer[self.__rx_index] = rx_byte
-                self.__rx_index += 1
+        out[:self.__num_channels] = channels
+        return out
 
-                # Have enough bytes been received?
-                if self.__rx_index >= self.FRAME_LENGTH:
-                    if debug:
-                        print(self.__rx_buffer)
+    def assign_channel_decoder(self, channel, decoder):
+        # decoder can be an Affine, Threshold or TriState, a function taking the raw value, or None for the raw value
+        if channel < 0 or channel >= self.__num_channels:
+            raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
 
-                    # Extract the checksum value sent with the data
-                    received_checksum = (self.__rx_buffer[self.FRAME_LENGTH - 1] << 8) | self.__rx_buffer[self.FRAME_LENGTH - 2]
+        decoders = list(self.__channel_decoders)
+        decoders[channel] = decoder
+        self.__set_decoders(decoders, self.__channel_filters)
+
+    def assign_decode_table(self, table):
+        # Assign decoders to several channels at once, from a dict of channel to decoder or a list starting at channel 0
+        decoders = list(self.__channel_decoders)
+        for channel, decoder in (table.items() if isinstance(table, dict) else enumerate(table)):
+            if channel < 0 or channel >= self.__num_channels:
+                raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
+            decoders[channel] = decoder
+        self.__set_decoders(decoders, self.__channel_filters)
+
+    def assign_channel_filters(self, channel, filters):
+        # filters is a sequence of Deadband, Expo, Smoothing and RateLimit, applied in order after decoding
+        if channel < 0 or channel >= self.__num_channels:
+            raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
 
-                    # Calculate a checksum value from the received data
-                    checksum = 0xffff
-                    for i in range(self.FRAME_LENGTH - 2):
-                        checksum -= self.__rx_buffer[i]
+        channel_filters = list(self.__channel_filters)
+        channel_filters[channel] = tuple(filters)
+        self.__set_decoders(self.__channel_decoders, channel_filters)
+
+    def assign_filter_table(self, table):
+        # Assign filters to several channels at once, from a dict of channel to filters or a list starting at channel 0
+        channel_filters = list(self.__channel_filters)
+        for channel, filters in (table.items() if isinstance(table, dict) else enumerate(table)):
+            if channel < 0 or channel >= self.__num_channels:
+                raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
+            channel_filters[channel] = tuple(filters)
+        self.__set_decoders(self.__channel_decoders, channel_filters)
+
+    @staticmethod
+    def __compile_decoders(decoders, channel_filters):
+        # Build a single function that decodes a tuple of raw channel values into a tuple of decoded and filtered
+        # ones. For the handful of channels in a frame this is several times quicker than a function call per
+        # channel, and quicker still than NumPy, whose per-call overhead outweighs the arithmetic. The filters that
+        # need them are also passed the state they left after the previous frame and the seconds since it, or
+        # infinity if there isn't one to go on. Returns the channels along with the new state, which has a slot for
+        # each Smoothing and RateLimit filter in turn
+        expressions = []
+        states = []
+        namespace = {"inf": math.inf}
+        for i, (decoder, filters) in enumerate(zip(decoders, channel_filters)):
+            # The built-in decoder functions are swapped for their declarative equivalents
+            decoder = DECLARATIVE_DECODERS.get(decoder, decoder)
+            value = f"r[{i}]"
+            if decoder is None:
+                expressions.append(value)
+            elif isinstance(decoder, Affine):
+                expression = f"({value} - {float(decoder.centre)!r}) / {float(decoder.span)!r}"
+                if decoder.deadband:
+                    deadband = float(decoder.deadband)
+                    expression = f"(0.0 if {-deadband!r} < (x{i} := {expression}) < {deadband!r} else x{i})"
+                expressions.append(expression)
+            elif isinstance(decoder, Threshold):
+                expressions.append(f"(1 if {value} > {float(decoder.level)!r} else 0)")
+            elif isinstance(decoder, TriState):
+                expressions.append(f"(1 if {value} > {float(decoder.high)!r} else "
+                                   f"-1 if {value} < {float(decoder.low)!r} else 0)")
+            elif callable(decoder):
+                namespace[f"f{i}"] = decoder
+                expressions.append(f"f{i}({value})")
+            else:
+                raise TypeError(f"Unsupported decoder for channel {i}: {decoder!r}")
+
+            for k, channel_filter in enumerate(filters):
+                expression = SBusReceiver.__compile_filter(channel_filter, expressions[i], f"v{i}_{k}",
+                                                           f"s[{len(states)}]")
+                if isinstance(channel_filter, (Smoothing, RateLimit)):
+                    expression = f"(s{i}_{k} := {expression})"
+                    states.append(f"s{i}_{k}, ")
+                expressions[i] = expression
+
+        # Starting afresh, the previous state is never used, but it still has to be there to be looked up
+        namespace["fresh"] = (0.0,) * len(states)
+        return eval(f"lambda r, s=fresh, d=inf: (({', '.join(expressions)},), ({''.join(states)}))", namespace)
+
+    @staticmethod
+    def __compile_filter(channel_filter, expression, value, previous):
+        # Wrap a channel's expression in a filter, assigning it to value where it is first used so it is only
+        # evaluated once. Smoothing and RateLimit carry on from previous, their own output for the last frame
+        if isinstance(channel_filter, Deadband):
+            width = float(channel_filter.width)
+            return f"(0.0 if {-width!r} < ({value} := {expression}) < {width!r} else " \
+                   f"({value} - {width!r} if {value} > 0 else {value} + {width!r}) / {1 - width!r})"
+        if isinstance(channel_filter, Expo):
+            amount = float(channel_filter.amount)
+            return f"(({value} := {expression}) * {1 - amount!r} + {amount!r} * {value} * {value} * {value})"
+        if isinstance(channel_filter, Smoothing):
+            return f"({previous} + (({value} := {expression}) - {previous}) / " \
+                   f"(1 + {float(channel_filter.time_constant)!r} / d))"
+        if isinstance(channel_filter, RateLimit):
+            rate = float(channel_filter.rate)
+            return f"min(max(({value} := {expression}), {previous} - {rate!r} * d), {previous} + {rate!r} * d)"
+        raise TypeError(f"Unsupported filter: {channel_filter!r}")
+
+    def __set_decoders(self, decoders, channel_filters):
+        decode = self.__compile_decoders(decoders, channel_filters)
+
+        # Re-decode the latest frame so the new decoders apply straight away, with the filters starting afresh
+        with self.__condition:
+            self.__channel_decoders = decoders
+            self.__channel_filters = channel_filters
+            self.__decode = decode
+            frame = self.__frame
+            channels, self.__filter_state = self.__decode(self.__channel_data)
+            self.__frame = SBusFrame(channels, frame.received_ns, frame.sequence)
+
+    def start(self, debug=False):
+        if self.__reader_thread is not None:
+            return
+
+        # From here on the reader thread owns the serial port
+        self.__reader_running = True
+        self.__reader_thread = Thread(target=self.__read_loop, args=(debug,), daemon=True)
+        self.__reader_thread.start()
+
+    def stop(self):
+        if self.__reader_thread is None:
+            return
+
+        self.__reader_running = False
+        self.__reader_thread.join()
+        self.__reader_thread = None
+
+    def wait_for_frame(self, timeout=None):
+        if self.__reader_thread is None:
+            raise RuntimeError("wait_for_frame requires the reader thread. Call start() first")
+
+        # Wait for a frame that has not already been returned by this or check_receive
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__frame.sequence != self.__consumed_sequence, timeout):
+                return None
+            self.__consumed_sequence = self.__frame.sequence
+            return self.__frame
+
+    def wait_until_connected(self, timeout=None):
+        if self.__reader_thread is None:
+            raise RuntimeError("wait_until_connected requires the reader thread. Call start() first")
+
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__timeout_reached, timeout)
+
+    def subscribe_channel(self, channel, handler, level=None):
+        # Call handler with the channel, its new value and its previous value whenever a frame changes its decoded
+        # value, or with a level, only when it goes from one side of the level to the other. Handlers are called
+        # from the reader thread, or from check_receive without one. On the first frame after connecting, each is
+        # called with a previous value of None so it can pick up where the channel starts
+        if channel < 0 or channel >= self.__num_channels:
+            raise ValueError(f"channel out of range. Expected 0 to {self.__num_channels - 1}")
 
-                    if checksum == received_checksum:
-                        if debug:
-                            if self.__timeout_reached:
-                                print("Comms established!")
+        with self.__handlers_lock:
+            handlers = dict(self.__channel_handlers)
+            handlers[channel] = handlers.get(channel, ()) + ((level, handler),)
+            self.__channel_handlers = handlers
+
+    def unsubscribe_channel(self, channel, handler):
+        with self.__handlers_lock:
+            handlers = dict(self.__channel_handlers)
+            remaining = tuple(entry for entry in handlers.get(channel, ()) if entry[1] != handler)
+            if remaining:
+                handlers[channel] = remaining
+            else:
+                handlers.pop(channel, None)
+            self.__channel_handlers = handlers
+
+    def subscribe_connection(self, handler):
+        # Call handler with True when the connection is gained and False as soon as it is lost
+        with self.__handlers_lock:
+            self.__connection_handlers += (handler,)
+
+    def unsubscribe_connection(self, handler):
+        with self.__handlers_lock:
+            self.__connection_handlers = tuple(entry for entry in self.__connection_handlers if entry != handler)
+
+    async def wait_for_change(self, channel, level=None, timeout=None):
+        # Wait in an event loop for the channel to change or cross level as for subscribe_channel, returning its new
+        # value, or None on timeout. Frames must be received either by the reader thread or by check_receive
+        return await self.__wait_for_event(lambda handler: self.subscribe_channel(channel, handler, level),
+                                           lambda handler: self.unsubscribe_channel(channel, handler),
+                                           lambda channel, value, previous: previous is not None, 1, timeout)
+
+    async def wait_for_connection(self, connected=True, timeout=None):
+        # Wait in an event loop for the connection to be gained, or lost, returning whether it happened in time
+        return await self.__wait_for_event(self.subscribe_connection, self.unsubscribe_connection,
+                                           lambda state: state == connected, 0, timeout,
+                                           lambda: True if self.is_connected() == connected else None) is not None
+
+    @staticmethod
+    async def __wait_for_event(subscribe, unsubscribe, accept, result, timeout, already=lambda: None):
+        # Resolve a future in this event loop with the result'th argument of the first event accepted, from
+        # whichever thread raised it. already is checked once subscribed, so nothing can be missed in between
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(value):
+            if not future.done():
+                future.set_result(value)
+
+        def handler(*args):
+            if accept(*args):
+                loop.call_soon_threadsafe(resolve, args[result])
+
+        subscribe(handler)
+        try:
+            value = already()
+            if value is not None:
+                return value
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            unsubscribe(handler)
 
-                            print("Checksum OK!", end=" ")
+    def check_receive(self, debug=False):
+        # If the reader thread is running, just report whether it has published a frame since the last check
+        if self.__reader_thread is not None:
+            with self.__condition:
+                newly_received = self.__frame.sequence != self.__consumed_sequence
+                self.__consumed_sequence = self.__frame.sequence
+            return newly_received
+
+        # Read everything that is waiting in one go, appending it to any partial frame left over from the last call
+        in_waiting = self.__serial.in_waiting
+        if in_waiting > 0:
+            self.__receive(self.__serial.read(in_waiting))
+
+        return self.__process_received(debug)
+
+    def __read_loop(self, debug):
+        fd = self.__serial.fileno()
+        while self.__reader_running:
+            # Block until data arrives, or until the point the connection would be considered lost
+            if self.__timeout_reached:
+                wait_ms = self.__no_comms_timeout_ms
+            else:
+                wait_ms = self.__last_received_ms + self.__no_comms_timeout_ms + 1 - (monotonic_ns() // 1000000)
+
+            if select([fd], [], [], max(wait_ms, 0) / 1000)[0]:
+                self.__receive(self.__serial.read(max(self.__serial.in_waiting, 1)))
+
+            self.__process_received(debug)
+
+    def __receive(self, data):
+        self.__rx_buffer += data
+        self.__stats.count("bytes_in", len(data))
+
+        if self.__recorder is not None:
+            self.__recorder.record(self.__recorder_port, RX, data)
+
+    def __process_received(self, debug):
+        newly_received = False
+        buffer = self.__rx_buffer
+        latest_frame = -1
+        frame_received = False
+        good_frames = 0
+        bad_frames = 0
+        skipped_bytes = 0
+        index = 0
+        while True:
+            # Skip ahead to the next byte that signifies the start of a frame
+            frame_index = buffer.find(self.__frame_start, index)
+            if frame_index < 0:
+                skipped_bytes += len(buffer) - index
+                index = len(buffer)
+                break
+            skipped_bytes += frame_index - index
+            index = frame_index
+
+            # Have enough bytes been received? If not, keep the partial frame for next time
+            frame_end = index + self.FRAME_LENGTH
+            if frame_end > len(buffer):
+                break
 
-                        self.__channel_data = struct.unpack_from(self.__channel_format, self.__rx_buffer, 2)
-                        newly_received = True
+            if debug:
+                print(buffer[index:frame_end])
+
+            # Extract the checksum value sent with the data
+            received_checksum = (buffer[frame_end - 1] << 8) | buffer[frame_end - 2]
+
+            # Calculate a checksum value from the received data
+            checksum = 0xffff - sum(buffer[index:frame_end - 2])
+
+            if checksum == received_checksum:
+                if debug:
+                    if self.__timeout_reached and not frame_received:
+                        print("Comms established!")
+
+                    print("Checksum OK!", end=" ")
+
+                # Only the newest valid frame gets decoded
+                latest_frame = index
+                newly_received = True
+                good_frames += 1
+            else:
+                if debug:
+                    print("Checksum Error")
+                bad_frames += 1
+
+            self.__last_received_ms = monotonic_ns() // 1000000
+            frame_received = True
+
+            index = frame_end
+
+        if frame_received:
+            connected = not self.__timeout_reached
+
+            # Decode and publish the new frame and connection state together, then wake anyone waiting on either.
+            # Decoding under the condition means new decoders can't be assigned between picking up the decode
+            # function and publishing what it returned, which would otherwise overwrite the frame they re-decoded
+            with self.__condition:
+                if latest_frame >= 0:
+                    self.__channel_data = struct.unpack_from(self.__channel_format, buffer, latest_frame + 2)
+
+                    # The filters carry on from the last frame, unless the connection was lost since
+                    received_ns = monotonic_ns()
+                    previous = self.__frame
+                    fresh = not connected or previous.sequence == 0
+                    if fresh:
+                        channels, self.__filter_state = self.__decode(self.__channel_data)
                     else:
-                        if debug:
-                            print("Checksum Error")
-
-                    self.__last_received_ms = monotonic_ns() // 1000000
-                    self.__timeout_reached = False
-
-                    self.__receiving = False
+                        elapsed = (received_ns - previous.received_ns) / 1000000000
+                        channels, self.__filter_state = self.__decode(self.__channel_data, self.__filter_state,
+                                                                      elapsed)
+                    self.__frame = SBusFrame(channels, received_ns, previous.sequence + 1)
+                self.__timeout_reached = False
+                self.__condition.notify_all()
+
+            # Only once the new state has been published, so handlers see it if they read the receiver
+            if not connected:
+                self.__raise_connection(True)
+            if latest_frame >= 0 and self.__channel_handlers and (fresh or channels != previous.channels):
+                self.__raise_changes(None if fresh else previous.channels, channels)
+
+        # Discard everything that has been processed
+        del buffer[:index]
+
+        if good_frames:
+            # Only the newest of several frames that arrived together is decoded, the rest are counted as dropped
+            self.__stats.count("frames", good_frames)
+            self.__stats.count("dropped_frames", good_frames - 1)
+            self.__stats.good(good_frames)
+        if bad_frames:
+            self.__stats.count("checksum_failures", bad_frames)
+        if skipped_bytes:
+            # Bytes outside of any frame, such as line noise or the tail of a frame that was joined part way through
+            self.__stats.count("skipped_bytes", skipped_bytes)
 
         current_millis = monotonic_ns() // 1000000
         if ((current_millis - self.__last_received_ms) > self.__no_comms_timeout_ms) and not self.__timeout_reached:
             if debug:
                 print("Comms lost!")
 
-            self.__timeout_reached = True
+            with self.__condition:
+                self.__timeout_reached = True
+                self.__condition.notify_all()
+            self.__stats.count("connection_losses")
+            self.__raise_connection(False)
 
         return newly_received
 
+    def __raise_changes(self, previous, channels):
+        # Comparing the whole frame first means a frame where nothing moved costs a single tuple comparison
+        for channel, handlers in self.__channel_handlers.items():
+            value = channels[channel]
+            old = None if previous is None else previous[channel]
+            if old == value:
+                continue
+            for level, handler in handlers:
+                if level is None or old is None or (old > level) != (value > level):
+                    self.__call_handler(handler, channel, value, old)
+
+    def __raise_connection(self, connected):
+        for handler in self.__connection_handlers:
+            self.__call_handler(handler, connected)
+
+    @staticmethod
+    def __call_handler(handler, *args):
+        # A failing handler mustn't take the reader thread down with it
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"SBUS handler {handler!r} raised {e!r}")
+
 
 def analog_decoder(value):
     return (value - 1500) / 500
@@ -126,6 +527,15 @@ def trinary_decoder(value):
     return 1 if value > 1750 else -1 if value < 1250 else 0
 
 
+# What each of the decoder functions above does, so assigning one gets it decoded along with the rest of the frame
+DECLARATIVE_DECODERS = {
+    analog_decoder: Affine(1500, 500),
+    analog_biased_decoder: Affine(1000, 1000),
+    binary_decoder: Threshold(1500),
+    trinary_decoder: TriState(1250, 1750),
+}
+
+
 if __name__ == "__main__":
     serial_port = "/dev/serial0"  # Replace with the actual serial port
     baud_rate = 115200
@@ -133,26 +543,30 @@ if __name__ == "__main__":
     uart = Serial(serial_port, baud_rate)
 
     controller = SBusReceiver(serial_port, 8, 0.1)
-    controller.assign_channel_decoder(0, analog_decoder)  # 1: Right Left/Right
-    controller.assign_channel_decoder(1, analog_decoder)  # 2: Right Up/Down
-    controller.assign_channel_decoder(2, analog_decoder)  # 3: Left Up/Down
-    controller.assign_channel_decoder(3, analog_decoder)  # 4: Left Left/Right
-    controller.assign_channel_decoder(4, binary_decoder)  # 5: SwA
-    controller.assign_channel_decoder(5, analog_biased_decoder)  #: 6 VrA
-    controller.assign_channel_decoder(6, analog_biased_decoder)  #: 7 VrB
-    controller.assign_channel_decoder(7, binary_decoder)  #: 8 SwD
+    controller.assign_decode_table([
+        analog_decoder,  # 1: Right Left/Right
+        analog_decoder,  # 2: Right Up/Down
+        analog_decoder,  # 3: Left Up/Down
+        analog_decoder,  # 4: Left Left/Right
+        binary_decoder,  # 5: SwA
+        analog_biased_decoder,  # 6: VrA
+        analog_biased_decoder,  # 7: VrB
+        binary_decoder,  # 8: SwD
+    ])
+
+    controller.start()
 
     print("Establishing Connection")
 
-    while not controller.is_connected():
-        controller.check_receive()
+    controller.wait_until_connected()
 
     print("Connection Established")
 
     while controller.is_connected():
-        if controller.check_receive():
-            for i in range(controller.num_channels()):
-                print("Ch", i + 1, "=", controller.read_channel(i), end=", ")
+        frame = controller.wait_for_frame(0.1)
+        if frame is not None:
+            for i, value in enumerate(frame.channels):
+                print("Ch", i + 1, "=", value, end=", ")
             print()
 
     print("Connection Lost")
@@ -1,7 +1,14 @@
+import os
 import struct
-from serial import Serial
-from collections import namedtuple
+from select import select
+from serial import Serial, SerialException
+from collections import deque, namedtuple
+from threading import RLock, Thread
 from time import monotonic_ns
+from comms.adaptive_timeout import AdaptiveTimeout
+from comms.link_stats import LinkStats
+from comms.priority_lock import PriorityLock
+from comms.traffic_log import RX, TX
 
 UBYTE = "B"
 SBYTE = "b"
@@ -10,170 +17,740 @@ SSHORT = "h"
 FLOAT = "f"
 
 def format_length(fmt):
-    length = 0
-    for char in fmt:
-        if char in 'cbB?':
-            length += 1  # char, signed/unsigned char, bool
-        elif char in 'hH':
-            length += 2  # short, unsigned short
-        elif char in 'iI':
-            length += 4  # int, unsigned int
-        elif char in 'lL':
-            length += 4 if struct.calcsize('l') == 4 else 8  # long, unsigned long
-        elif char == 'f':
-            length += 4  # float
-        elif char == 'd':
-            length += 8  # double
-        else:
-            raise ValueError(f"Unsupported format character: {char}")
-    return length
+    try:
+        return struct.calcsize(">" + fmt)
+    except struct.error:
+        raise ValueError(f"Unsupported format: {fmt}") from None
 
-Command = namedtuple("Command", ("value", "length", "format"))
+# frame is the precompiled struct for the whole frame, including the start byte, command byte and checksum
+Command = namedtuple("Command", ("value", "length", "format", "code", "frame"))
 
 def make_command(value, fmt=""):
-    return Command(value, format_length(fmt), fmt)
+    return Command(value, format_length(fmt), fmt, ord(value), struct.Struct(">BB" + fmt + "B"))
 
 COM_POKE_SEND = make_command('P')
 COM_IDENTIFY_SEND = make_command('I')
 COM_IDENTIFY_RECV = make_command('I', UBYTE)
 
+# Asks the device to push the given reply command every so many milliseconds without being asked, or to stop with 0
+COM_SUBSCRIBE_SEND = make_command('s', UBYTE + USHORT)
+
+
+class CorruptedReplyError(ValueError):
+    # Raised by receive_all and pipeline when some of the replies were corrupted. replies holds every reply that
+    # arrived intact, with None in place of each corrupted one
+    def __init__(self, message, replies):
+        super().__init__(message)
+        self.replies = replies
+
 
 class SerialComms:
     START_BYTE = 13
     FRAME_BYTES = 3
 
-    WAITING = 0
-    COMMAND_NEXT = 1
-    DATA_NEXT = 2
-    CHECKSUM = 3
-
     DEFAULT_TIMEOUT = 1
+    STREAM_POLL_INTERVAL = 0.1
+
+    # The longest period a stream can be requested at, which COM_SUBSCRIBE_SEND sends as an unsigned short
+    MAX_STREAM_PERIOD_MS = 0xffff
+
+    # How many times a request is sent again when its reply doesn't arrive within the adaptive timeout
+    TIMEOUT_RETRIES = 2
 
-    def __init__(self, serial_port='/dev/ttyACM0'):
+    # Receiving a reply blocks in select until it arrives. Waking up from that is slow though, so callers that would
+    # rather spend CPU time than latency can pass a spin_ns of their own. Receiving then stops blocking SPIN_LEAD_NS
+    # before the reply is expected, going by how soon after a send it has arrived before, and spins on reads for at
+    # most spin_ns from then. Around 1 ms covers the usual jitter of a USB serial link
+    SPIN_LEAD_NS = 500000
+    SPIN_NS = 0
+
+    # When several threads are waiting to use the link, the one whose command has the highest priority goes next.
+    # Anything keeping the robot safe, such as stopping the motors, should use SAFETY_PRIORITY
+    SAFETY_PRIORITY = 100
+    SETPOINT_PRIORITY = 50
+    DEFAULT_PRIORITY = PriorityLock.DEFAULT_PRIORITY
+
+    def __init__(self, serial_port='/dev/ttyACM0', recorder=None, adaptive_timeout=None,
+                 timeout_retries=TIMEOUT_RETRIES, spin_ns=SPIN_NS):
         self.__serial = Serial(serial_port, timeout=1)
-        self.state = self.WAITING
+        self.__fd = self.__serial.fileno()
+
+        # Optionally log everything sent and received, to be replayed later
+        self.__recorder = recorder
+        self.__recorder_port = recorder.port(serial_port) if recorder is not None else None
+
+        # Held for the duration of each request/reply pair, so threads sharing the device don't interleave. Each
+        # request command can be given a priority, which the reply to it shares
+        self.__lock = PriorityLock()
+        self.__priorities = {}
+
+        # Preallocated frame buffers for each frame length, so sending and receiving doesn't allocate any
+        self.__tx_buffers = {}
+        self.__rx_buffers = {}
+
+        # Holds the start of a reply that had not fully arrived when the last receive timed out
+        self.__rx_pending = b""
+
+        # How long to spin for each reply, when the last frame was sent, and for each reply command code roughly the
+        # soonest it arrives after a send
+        self.__spin_ns = spin_ns
+        self.__sent_ns = None
+        self.__arrivals = {}
+
+        # Always-on counts of frames, bytes and errors, along with round trip latencies for each reply command
+        self.__stats = LinkStats()
+
+        # Queries and pipelines without a timeout of their own give up on a reply once it is much later than usual,
+        # and ask again. The replies still owed to requests that timed out, each with when to stop expecting it, so
+        # they aren't taken for the replies to later requests if they turn up after all
+        self.__adaptive_timeout = adaptive_timeout if adaptive_timeout is not None \
+            else AdaptiveTimeout(ceiling=self.DEFAULT_TIMEOUT)
+        self.__timeout_retries = timeout_retries
+        self.__owed = []
+
+        # Commands the device sends without being asked, by command code, each with the functions to pass them to,
+        # and the latest values received for each along with when they arrived
+        self.__streams = {}
+        self.__latest = {}
+
+        # Subscribed frames are parsed under the link lock but only passed to their handlers once it is released, so
+        # a handler can use the link itself. Each waiting frame is queued with its handlers, and the dispatch lock
+        # passes them on one at a time in the order they arrived
+        self.__dispatches = deque()
+        self.__dispatch_lock = RLock()
+
+        # While anything is subscribed, everything received goes through this buffer and the frame parser, so
+        # streamed frames and replies can arrive in any order
+        self.__rx_buffer = bytearray()
+        self.__stream_thread = None
+        self.__stream_running = False
 
     def __del__(self):
         if self.__serial.isOpen():
             self.__serial.close()
 
-    """
-    # This is no longer needed for our use-case as Pi will always initiate the communication
-    def check_receive(self):
-        current_command = None
-        data = []
-        bytes_received = 0
-        checksum_expected = 0
-        while self.__serial.in_waiting > 0:
-            s = self.__serial.read(1)  # Read one byte, although it comes in as a list of one byte
-            print(chr(s[0]), end="")
-            if not s:  # No data left, quit loop
-                # TODO possible problem - timeout of 1s?
+    def stats(self):
+        stats = self.__stats.snapshot()
+        stats["reply_timeouts"] = self.__adaptive_timeout.snapshot()
+        stats["queue_wait"] = self.__lock.waits()
+        return stats
+
+    def reset_stats(self):
+        self.__stats.reset()
+        self.__lock.reset_waits()
+
+    def set_priority(self, command: Command, priority):
+        # Requests of command jump ahead of any with a lower priority that are waiting for the link
+        self.__priorities[command.code] = priority
+
+    def subscribe(self, command: Command, handler=None):
+        # Accept frames of command that the device sends without being asked. Each is decoded and kept as the latest
+        # value for the command, and passed to handler if one is given. Replies of the same command to a query are
+        # passed on in the same way
+        with self.__lock:
+            if not self.__streams:
+                # From now on everything received goes through the parser, starting with any partial reply
+                self.__rx_buffer += self.__rx_pending
+                self.__rx_pending = b""
+
+            handlers = self.__streams.setdefault(command.code, (command, []))[1]
+            if handler is not None:
+                handlers.append(handler)
+
+    def unsubscribe(self, command: Command, handler=None):
+        # Stop passing command to handler, or stop accepting it at all if no handler is given
+        with self.__lock:
+            stream = self.__streams.get(command.code)
+            if stream is None:
                 return
 
-            if self.state == self.WAITING:  # Finished processing last command
-                if s[0] == self.START_BYTE:  # Start byte received
-                    self.state = self.COMMAND_NEXT
-
-            elif self.state == self.COMMAND_NEXT:
-                current_command = None
-                data = []
-                bytes_received = 0
-                checksum_expected = 13
-                if chr(s[0]) in self.COMMANDS.keys():  # If command matters
-                    current_command = chr(s[0])
-                    # print(f"Command {current_command}")
-                    checksum_expected = (checksum_expected + s[0]) % 256  # Calculate checksum on the go
-                    if self.COMMANDS[current_command]['bytes'] > 0:  # If there's data to look at
-                        self.state = self.DATA_NEXT
-                    else:
-                        self.state = self.CHECKSUM
-
-            elif self.state == self.DATA_NEXT:
-                data.append(s[0])  # Shove that data in a list
-                bytes_received += 1
-                checksum_expected = (checksum_expected + s[0]) % 256
-                if bytes_received == self.COMMANDS[current_command]['bytes']:  # Finished receiving data
-                    self.state = self.CHECKSUM
-
-            elif self.state == self.CHECKSUM:
-                if s[0] == checksum_expected:  # Check that checksum
-                    if self.COMMANDS[current_command]['bytes'] > 0:  # If you need to do something with the data
-                        self.COMMANDS[current_command]['command'](data)  # Call the referenced command
-                    else:
-                        self.COMMANDS[current_command]['command']()
-                else:
-                    print("Checksum failed!")
-                self.state = self.WAITING  # Go back to looking for a command
-    """
-    def checksum(self, buffer):
-        checksum = 0
-        for i in range(len(buffer) - 1):
-            checksum += buffer[i]
-        return checksum % 0x100
+            if handler is not None and handler in stream[1]:
+                stream[1].remove(handler)
+            if handler is None or not stream[1]:
+                del self.__streams[command.code]
+                self.__latest.pop(command.code, None)
 
-    def send(self, command: Command, *data):
-        # Create a buffer of the correct length
-        buffer = bytearray(command.length + self.FRAME_BYTES)
+            if not self.__streams:
+                # Go back to reading replies straight from the port, keeping anything not yet parsed
+                self.__rx_pending = bytes(self.__rx_buffer)
+                self.__rx_buffer.clear()
 
-        # Populate the buffer with the required header values and command data
-        struct.pack_into(">BB" + command.format + "B", buffer, 0,  # fmt, buffer, offset
-                         self.START_BYTE,
-                         ord(command.value),
-                         *data,
-                         0)  # where the checksum will go
+    def request_stream(self, command: Command, rate):
+        # Ask the device to push command rate times a second, or to stop pushing it with a rate of 0. The device
+        # firmware must support COM_SUBSCRIBE_SEND for this to have any effect
+        period_ms = int(1000 / rate) if rate > 0 else 0
+        if rate < 0 or (rate > 0 and not 1 <= period_ms <= self.MAX_STREAM_PERIOD_MS):
+            raise ValueError(f"Stream rate must be 0, or between {1000 / self.MAX_STREAM_PERIOD_MS:.4f} and 1000 a "
+                             f"second: {rate}")
+        self.send(COM_SUBSCRIBE_SEND, command.code, period_ms)
 
-        # Calculate the checksum and update the last byte of the buffer
-        buffer[-1] = self.checksum(buffer)
+    def latest(self, command: Command):
+        # The latest values of a subscribed command along with the monotonic_ns time they arrived, or None if none
+        # have arrived yet
+        return self.__latest.get(command.code)
 
-        # Clear out the input buffer in case anything is still lingering from a previous command
-        # self.__serial.reset_input_buffer()  # Removed so we can capture any tracebacks from connected Picos
+    def check_receive(self):
+        # Without blocking, parse whatever has arrived and dispatch any subscribed frames. Returns how many were
+        # dispatched
+        with self.__lock:
+            # Without any subscriptions, anything waiting can only be a reply, so leave it for receive
+            if not self.__streams:
+                return 0
 
-        # Write out the buffer
-        self.__serial.write(buffer)
+            self.__read_available()
+            self.__parse(None)
+        return self.__dispatch()
 
-    def receive(self, command: Command, timeout=DEFAULT_TIMEOUT):
-        # Calculate how long to wait for data
-        ms = int(1000.0 * timeout + 0.5)
-        end_ms = (monotonic_ns() // 1000000) + ms
+    def __dispatch(self):
+        # Pass every queued subscribed frame to its handlers, returning how many frames that was. Only called once the
+        # link lock has been released
+        dispatched = 0
+        with self.__dispatch_lock:
+            while self.__dispatches:
+                handlers, frame_values = self.__dispatches.popleft()
+                for handler in handlers:
+                    handler(frame_values)
+                dispatched += 1
+        return dispatched
 
-        # Wait for data of the expected size to be received
-        receive_length = command.length + self.FRAME_BYTES
-        while self.__serial.in_waiting < receive_length:
-            remaining_ms = end_ms - (monotonic_ns() // 1000000)
+    def start_streaming(self):
+        # Dispatch subscribed frames from a background thread as soon as they arrive, instead of through check_receive
+        if self.__stream_thread is not None:
+            return
 
-            # Has the timeout been reached?
-            if remaining_ms <= 0:
-                raise TimeoutError("Serial did not reply within the expected time")
+        self.__stream_running = True
+        self.__stream_thread = Thread(target=self.__stream_loop, daemon=True)
+        self.__stream_thread.start()
+
+    def stop_streaming(self):
+        if self.__stream_thread is None:
+            return
+
+        self.__stream_running = False
+        self.__stream_thread.join()
+        self.__stream_thread = None
+
+    def __stream_loop(self):
+        fd = self.__fd
+        while self.__stream_running:
+            if select([fd], [], [], self.STREAM_POLL_INTERVAL)[0]:
+                self.check_receive()
+
+    def __read_available(self):
+        # Read everything waiting in the port into the parse buffer, returning how many bytes that was
+        in_waiting = self.__serial.in_waiting
+        if in_waiting == 0:
+            return 0
+
+        data = os.read(self.__fd, in_waiting)
+        self.__rx_buffer += data
+        self.__stats.count("bytes_in", len(data))
+        if self.__recorder is not None:
+            self.__recorder.record(self.__recorder_port, RX, data)
+        return len(data)
+
+    def __parse(self, wanted):
+        # Pull every complete frame of a subscribed or wanted command out of the parse buffer, returning whether one
+        # of the wanted command was found and its values. Subscribed frames are queued for __dispatch
+        found, values, received = self.parse_frames(self.__rx_buffer, self.__streams, wanted, self.__stats)
+
+        received_ns = monotonic_ns()
+        for (command, handlers), frame_values in received:
+            self.__latest[command.code] = (frame_values, received_ns)
+            self.__dispatches.append((tuple(handlers), frame_values))
+
+        return found, values
+
+    @classmethod
+    def parse_frames(cls, buffer, streams, wanted, stats: LinkStats, corrupted_replies=False):
+        # Pull every complete frame out of buffer, resynchronising on the next START_BYTE after anything that isn't a
+        # valid frame of a command in streams, which maps command codes to tuples starting with their Command, or of
+        # the wanted command. Stops early at a frame of the wanted command, returning whether one was found, its
+        # values, and each streamed frame's entry in streams along with its values. Shared with AsyncSerialComms.
+        # With corrupted_replies, which is only for when nothing is streamed, a corrupted frame of the wanted command
+        # is found with values of None rather than skipped, so it isn't replaced by the next reply of the same
+        # command. That is unless a valid one starts inside it, as noise ahead of a reply pushes it back
+        received = []
+        found = False
+        values = None
+        index = 0
+        bad_start = bad_end = None
+        while not found:
+            index = buffer.find(cls.START_BYTE, index)
+            if bad_end is not None and (index < 0 or index >= bad_end):
+                stats.count("checksum_failures")
+                found = True
+                index = bad_end
+                break
+            if index < 0:
+                index = len(buffer)
+                break
+            if index + 1 >= len(buffer):
+                # Whether a bad frame of the wanted command was the reply isn't known until the rest arrives
+                index = index if bad_start is None else bad_start
+                break
+
+            code = buffer[index + 1]
+            stream = streams.get(code)
+            if stream is not None:
+                command = stream[0]
+            elif wanted is not None and wanted.code == code:
+                command = wanted
+            else:
+                stats.count("skipped_bytes")
+                index += 1
+                continue
+
+            frame_end = index + command.frame.size
+            if frame_end > len(buffer):
+                index = index if bad_start is None else bad_start
+                break
+
+            frame = buffer[index:frame_end]
+            if cls.checksum(frame) != frame[-1]:
+                if corrupted_replies and stream is None and bad_end is None:
+                    bad_start, bad_end = index, frame_end
+                else:
+                    stats.count("checksum_failures")
+                index += 1
+                continue
+
+            frame_values = cls.decode(command, frame)
+            stats.count_command(command, "received")
+            stats.good()
+            if stream is not None:
+                received.append((stream, frame_values))
+            if wanted is not None and wanted.code == code:
+                found = True
+                values = frame_values
+                if bad_end is not None:
+                    stats.count("checksum_failures")
+                    stats.count("resynchronised")
+            index = frame_end
+
+        del buffer[:index]
+        return found, values, received
+
+    @classmethod
+    def checksum(cls, buffer):
+        # The sum of every byte but the last, which is where the checksum goes
+        return (sum(buffer) - buffer[-1]) % 0x100
+
+    @classmethod
+    def encode(cls, command: Command, *data):
+        # Create a buffer of the correct length
+        buffer = bytearray(command.frame.size)
+
+        # Populate the buffer with the required header values and command data
+        command.frame.pack_into(buffer, 0,  # buffer, offset
+                                cls.START_BYTE,
+                                command.code,
+                                *data,
+                                0)  # where the checksum will go
+
+        # Calculate the checksum and update the last byte of the buffer
+        buffer[-1] = cls.checksum(buffer)
+        return buffer
 
-        received = self.__serial.read(receive_length)  # Read the expected number of bytes
-        # print(received)
-        expected_checksum = self.checksum(received)
-        received_checksum = received[-1]
-        if received_checksum != expected_checksum:
-            print("\n--------------------------------------------------")
-            print("Recv Len:", end=" ")
-            print(receive_length)
-            print("Recv'd:", end=" ")
-            print(received)
-            print(received.hex())
-            print("In Buffer:", end=" ")
-            read_all = self.__serial.read_all()
-            print(read_all)
-            print(read_all.hex())
-            print("--------------------------------------------------")
-            raise ValueError(f"Checksum mismatch! Expected {expected_checksum}, received {received_checksum}")
-
-        buffer = struct.unpack(">BB" + command.format + "B", received)
+    @classmethod
+    def decode(cls, command: Command, received):
+        # Extract the data from a received frame, whose checksum has already been checked
+        buffer = command.frame.unpack_from(received)
         fmt_len = len(command.format)
         if fmt_len > 0:
             return buffer[2] if fmt_len == 1 else buffer[2:2 + fmt_len]
         else:
             return None
 
+    @staticmethod
+    def __frame_buffer(buffers, length):
+        # Get the buffer for frames of this length, along with a memoryview of it, creating them on first use
+        frame_buffer = buffers.get(length)
+        if frame_buffer is None:
+            buffer = bytearray(length)
+            frame_buffer = buffers[length] = (buffer, memoryview(buffer))
+        return frame_buffer
+
+    def send(self, command: Command, *data):
+        # Taken and released directly rather than through a with statement, as this is sent at the highest rate
+        lock = self.__lock
+        lock.acquire(self.__priorities.get(command.code, self.DEFAULT_PRIORITY))
+        try:
+            if self.__owed:
+                self.__discard_late_replies()
+
+            buffer, view = self.__frame_buffer(self.__tx_buffers, command.frame.size)
+
+            # Populate the buffer with the required header values and command data
+            command.frame.pack_into(buffer, 0,  # buffer, offset
+                                    self.START_BYTE,
+                                    command.code,
+                                    *data,
+                                    0)  # where the checksum will go
+
+            # Calculate the checksum and update the last byte of the buffer. The last byte is zero, so sum it all
+            buffer[-1] = sum(buffer) & 0xff
+
+            # Clear out the input buffer in case anything is still lingering from a previous command
+            # self.__serial.reset_input_buffer()  # Removed so we can capture any tracebacks from connected Picos
+
+            # Write out the buffer
+            self.__write(view)
+            self.__sent_ns = monotonic_ns()
+            self.__stats.count_sent(command, len(view))
+
+            if self.__recorder is not None:
+                self.__recorder.record(self.__recorder_port, TX, view)
+        finally:
+            lock.release()
+
+    def __write(self, view):
+        # The port is non-blocking, so wait for it to become writable if the whole buffer doesn't go in one go
+        fd = self.__fd
+        try:
+            written = os.write(fd, view)
+        except BlockingIOError:
+            written = 0
+
+        while written < len(view):
+            select([], [fd], [], None)
+            try:
+                written += os.write(fd, view[written:])
+            except BlockingIOError:
+                pass
+
+    def send_all(self, requests):
+        # Each request is a tuple of the command followed by its data. All are written out in a single burst
+        buffer = b"".join(self.encode(*request) for request in requests)
+        with self.__lock.prioritised(self.__priority(request[0] for request in requests)):
+            if self.__owed:
+                self.__discard_late_replies()
+
+            self.__write(memoryview(buffer))
+            self.__sent_ns = monotonic_ns()
+            for request in requests:
+                self.__stats.count_command(request[0], "sent")
+            self.__stats.count("bytes_out", len(buffer))
+
+            if self.__recorder is not None:
+                self.__recorder.record(self.__recorder_port, TX, buffer)
+
+    def receive(self, command: Command, timeout=None):
+        # Calculate when to give up waiting for data. With no timeout, it is learned from how long replies of this
+        # command usually take. Any subscribed frames that arrived ahead of the reply are dispatched once the link is
+        # free again
+        try:
+            with self.__lock:
+                return self.__receive_until(command, self.__deadline((command,), timeout))
+        finally:
+            if self.__dispatches:
+                self.__dispatch()
+
+    def receive_all(self, commands, timeout=None):
+        # Receive a reply for each command in order, with the timeout covering all of them
+        with self.__lock:
+            replies, corrupted, missing = self.__receive_each(commands, self.__deadline(commands, timeout))
+        if self.__dispatches:
+            self.__dispatch()
+        if missing:
+            raise TimeoutError("Serial did not reply within the expected time")
+        if corrupted:
+            raise CorruptedReplyError(f"{len(corrupted)} of {len(commands)} replies were corrupted", replies)
+        return replies
+
+    def query(self, send_command: Command, receive_command: Command, *data, timeout=None, retries=0):
+        # Send a request and wait for its reply, without another thread getting in between. A corrupted reply is
+        # asked for again up to retries times. With no timeout given, it is learned from how long replies of this
+        # command usually take, and a reply that doesn't arrive in time is asked for again up to timeout_retries times.
+        # Until it has been learned, the whole DEFAULT_TIMEOUT is waited instead, so the reply isn't asked for again
+        timeout_retries = self.__timeout_retries if timeout is None and \
+            self.__adaptive_timeout.learned((receive_command,)) else 0
+        try:
+            with self.__lock.prioritised(self.__priorities.get(send_command.code, self.DEFAULT_PRIORITY)):
+                while True:
+                    sent_ns = monotonic_ns()
+                    self.send(send_command, *data)
+                    try:
+                        return self.__receive_until(receive_command, self.__deadline((receive_command,), timeout),
+                                                    sent_ns)
+                    except TimeoutError:
+                        self.__owe((receive_command,))
+                        if timeout_retries == 0:
+                            raise
+                        timeout_retries -= 1
+                    except ValueError:
+                        if retries == 0:
+                            raise
+                        retries -= 1
+                    self.__stats.count("retries")
+        finally:
+            if self.__dispatches:
+                self.__dispatch()
+
+    def pipeline(self, requests, replies, timeout=None, retries=0):
+        # Send several requests at once and then collect their replies, so they share a single round trip. Only the
+        # requests whose replies were corrupted or didn't arrive are sent again, in the same way as for query
+        timeout_retries = self.__timeout_retries if timeout is None and self.__adaptive_timeout.learned(replies) else 0
+        try:
+            with self.__lock.prioritised(self.__priority(request[0] for request in requests)):
+                results = [None] * len(replies)
+                pending = list(range(len(replies)))
+                while True:
+                    commands = [replies[i] for i in pending]
+                    sent_ns = monotonic_ns()
+                    self.send_all([requests[i] for i in pending])
+                    received, corrupted, missing = self.__receive_each(commands, self.__deadline(commands, timeout),
+                                                                       sent_ns)
+                    for i, reply in zip(pending, received):
+                        results[i] = reply
+
+                    if missing:
+                        if timeout_retries == 0:
+                            raise TimeoutError("Serial did not reply within the expected time")
+                        timeout_retries -= 1
+                    elif corrupted:
+                        if retries == 0:
+                            raise CorruptedReplyError(f"{len(corrupted)} of {len(replies)} replies were corrupted",
+                                                      results)
+                        retries -= 1
+                    else:
+                        return results
+
+                    # The corrupted replies all come before any that are missing, so the order is kept
+                    pending = [pending[i] for i in corrupted + missing]
+                    self.__stats.count("retries", len(pending))
+        finally:
+            if self.__dispatches:
+                self.__dispatch()
+
+    def __priority(self, commands):
+        return max((self.__priorities.get(command.code, self.DEFAULT_PRIORITY) for command in commands),
+                   default=self.DEFAULT_PRIORITY)
+
+    def __deadline(self, commands, timeout):
+        if timeout is None:
+            timeout = self.__adaptive_timeout.timeout(commands)
+        return monotonic_ns() + int(timeout * 1000000000)
+
+    def __receive_each(self, commands, end_ns, sent_ns=None):
+        # Keep going past a corrupted reply, so the ones behind it are still received rather than left to be
+        # mistaken for the replies to later requests. Returns the replies, with None for each corrupted or missing
+        # one, and the positions of the corrupted ones and of the missing ones. Once one reply has timed out, the
+        # rest are taken to be missing as well
+        replies = []
+        corrupted = []
+        for i, command in enumerate(commands):
+            try:
+                replies.append(self.__receive_until(command, end_ns, sent_ns))
+            except TimeoutError:
+                if sent_ns is not None:
+                    self.__owe(commands[i:])
+                missing = list(range(i, len(commands)))
+                return replies + [None] * len(missing), corrupted, missing
+            except ValueError:
+                replies.append(None)
+                corrupted.append(i)
+        return replies, corrupted, []
+
+    def __owe(self, commands):
+        # The replies to requests that timed out may still turn up. While subscribed, the parser picks them out by
+        # their command code instead
+        if self.__streams:
+            return
+        expires_ns = monotonic_ns() + int(self.DEFAULT_TIMEOUT * 1000000000)
+        self.__owed.extend((command, expires_ns) for command in commands)
+
+    def __discard_late_replies(self):
+        # Anything that arrived before a request is sent can't be the reply to it, so any owed replies waiting in
+        # the port are thrown away. One that turns up after the request was sent is taken as the reply to it if it
+        # is the same command, which is just as good, and then the reply it displaced is thrown away here next time
+        now_ns = monotonic_ns()
+        self.__owed = [(command, expires_ns) for command, expires_ns in self.__owed if expires_ns > now_ns]
+        if not self.__owed or self.__streams:
+            self.__owed = []
+            return
+
+        in_waiting = self.__serial.in_waiting
+        if in_waiting > 0:
+            data = os.read(self.__fd, in_waiting)
+            self.__stats.count("bytes_in", len(data))
+            if self.__recorder is not None:
+                self.__recorder.record(self.__recorder_port, RX, data)
+            self.__rx_pending += data
+
+        while self.__owed and self.__skip_late_reply(self.__rx_pending):
+            pass
+
+    def __skip_late_reply(self, data):
+        # If data starts with the next owed reply, drop it and keep whatever follows it for the next receive
+        command = self.__owed[0][0]
+        frame_size = command.frame.size
+        if len(data) < frame_size or not self.__valid_frame(command, data[:frame_size]):
+            return False
+
+        del self.__owed[0]
+        self.__rx_pending = bytes(data[frame_size:])
+        self.__stats.count("late_replies")
+        return True
+
+    def __receive_until(self, command: Command, end_ns, sent_ns=None):
+        # If sent_ns is given, the time from then until the reply arrives is recorded as its round trip latency
+        if self.__streams:
+            return self.__receive_parsed(command, end_ns, sent_ns)
+
+        receive_length = command.frame.size
+        received, view = self.__frame_buffer(self.__rx_buffers, receive_length)
+
+        # Start with any partial reply left over from a receive that timed out
+        received_length = len(self.__rx_pending)
+        if received_length > 0:
+            received_length = min(received_length, receive_length)
+            view[:received_length] = self.__rx_pending[:received_length]
+            self.__rx_pending = self.__rx_pending[received_length:]
+
+        # Wait for data of the expected size to be received, blocking in select. When spinning, only block until just
+        # before the reply is expected, then spin on reads for a short while before blocking again until the deadline
+        fd = self.__fd
+        spin_start_ns, spin_end_ns = self.__spin_window(command)
+        while received_length < receive_length:
+            now_ns = monotonic_ns()
+            remaining_ns = end_ns - now_ns
+
+            spinning = spin_start_ns <= now_ns < spin_end_ns and remaining_ns > 0
+            if spinning:
+                ready = True
+            else:
+                wait_ns = min(spin_start_ns - now_ns, remaining_ns) if now_ns < spin_start_ns else remaining_ns
+                ready = select([fd], [], [], max(wait_ns, 0) / 1000000000)[0]
+
+            if ready:
+                # Read straight into the frame buffer, only taking up to the expected number of bytes so any
+                # following reply is left in the port
+                try:
+                    count = os.readv(fd, (view[received_length:] if received_length else view,))
+                except BlockingIOError:
+                    continue
+
+                # The port reads nothing rather than failing when there is nothing to read yet, which is only an
+                # error if select said there was
+                if count == 0:
+                    if spinning:
+                        continue
+                    raise SerialException("device reports readiness to read but returned no data")
+                if self.__recorder is not None:
+                    self.__recorder.record(self.__recorder_port, RX, view[received_length:received_length + count])
+                received_length += count
+                self.__stats.count("bytes_in", count)
+                if received_length == receive_length:
+                    self.__arrived(command)
+
+            # Has the timeout been reached? Any partial reply stays buffered, as it would have in the port
+            elif remaining_ns <= 0:
+                self.__rx_pending = bytes(view[:received_length])
+                self.__stats.count("timeouts")
+                raise TimeoutError("Serial did not reply within the expected time")
+
+        if not self.__valid_frame(command, received):
+            # A late reply to an earlier request may have turned up ahead of this one
+            if self.__owed and self.__skip_late_reply(bytes(received) + self.__rx_pending):
+                return self.__receive_until(command, end_ns, sent_ns)
+
+            # Rather than throwing away everything in flight, look for the reply further on in case noise pushed it
+            # back, keeping whatever follows for the next receive
+            self.__stats.count("checksum_failures")
+            received = self.__resynchronise(command, bytes(received), end_ns)
+
+        self.__stats.count_command(command, "received")
+        self.__stats.good()
+        if sent_ns is not None:
+            latency_ns = monotonic_ns() - sent_ns
+            self.__stats.record_latency(command, latency_ns)
+            self.__adaptive_timeout.record(command, latency_ns)
+
+        return self.decode(command, received)
+
+    def __spin_window(self, command: Command):
+        # When to start spinning for this reply and when to give up spinning, which is never when spinning is off or
+        # before one has arrived
+        arrival_ns = self.__arrivals.get(command.code)
+        if self.__spin_ns == 0 or arrival_ns is None or self.__sent_ns is None:
+            return 0, 0
+        start_ns = self.__sent_ns + arrival_ns - self.SPIN_LEAD_NS
+        return start_ns, start_ns + self.__spin_ns
+
+    def __arrived(self, command: Command):
+        # Follows the soonest arrivals straight away but later ones only slowly, so an occasional slow reply doesn't
+        # leave the spinning starting too late
+        if self.__spin_ns == 0 or self.__sent_ns is None:
+            return
+        arrival_ns = monotonic_ns() - self.__sent_ns
+        previous_ns = self.__arrivals.get(command.code)
+        if previous_ns is not None and arrival_ns > previous_ns:
+            arrival_ns = previous_ns + (arrival_ns - previous_ns) // 16
+        self.__arrivals[command.code] = arrival_ns
+
+    def __valid_frame(self, command: Command, frame):
+        return frame[0] == self.START_BYTE and frame[1] == command.code and self.checksum(frame) == frame[-1]
+
+    def __resynchronise(self, command: Command, bad_frame, end_ns):
+        # Noise that adds bytes ahead of a reply pushes it back, so a valid frame starting part way through the bad
+        # one is taken to be the reply. Otherwise the reply itself was corrupted, and whatever came after it is kept
+        # for the following receives, which resynchronise the same way if they need to
+        frame_size = len(bad_frame)
+        data = bad_frame + self.__rx_pending
+        self.__rx_pending = b""
+        fd = self.__fd
+
+        index = data.find(self.START_BYTE, 1)
+        while 0 < index < frame_size:
+            # Wait for the rest of the candidate frame, but only as long as the receive would have anyway
+            while len(data) < index + frame_size and monotonic_ns() < end_ns:
+                if select([fd], [], [], max(end_ns - monotonic_ns(), 0) / 1000000000)[0]:
+                    try:
+                        more = os.read(fd, index + frame_size - len(data))
+                    except BlockingIOError:
+                        continue
+                    if self.__recorder is not None:
+                        self.__recorder.record(self.__recorder_port, RX, more)
+                    self.__stats.count("bytes_in", len(more))
+                    data += more
+            if len(data) < index + frame_size:
+                break
+
+            frame = data[index:index + frame_size]
+            if self.__valid_frame(command, frame):
+                self.__stats.count("resynchronised")
+                self.__rx_pending = data[index + frame_size:]
+                return frame
+
+            index = data.find(self.START_BYTE, index + 1)
+
+        self.__rx_pending = data[frame_size:]
+        raise ValueError(f"Corrupted {command.value} reply: {bad_frame.hex()}")
+
+    def __receive_parsed(self, command: Command, end_ns, sent_ns):
+        # Wait for a reply while subscribed, dispatching any streamed frames that arrive before it. A corrupted reply
+        # is skipped over like any other bad frame, so it ends in a timeout rather than a checksum error
+        fd = self.__fd
+        while True:
+            found, values = self.__parse(command)
+            if found:
+                if sent_ns is not None:
+                    latency_ns = monotonic_ns() - sent_ns
+                    self.__stats.record_latency(command, latency_ns)
+                    self.__adaptive_timeout.record(command, latency_ns)
+                return values
+
+            remaining_ns = end_ns - monotonic_ns()
+            if select([fd], [], [], max(remaining_ns, 0) / 1000000000)[0]:
+                if self.__read_available() == 0:
+                    raise SerialException("device reports readiness to read but returned no data")
+            elif remaining_ns <= 0:
+                self.__stats.count("timeouts")
+                raise TimeoutError("Serial did not reply within the expected time")
+
     def poke(self):
         self.send(COM_POKE_SEND)
 
     def identify(self, timeout=DEFAULT_TIMEOUT):
-        self.send(COM_IDENTIFY_SEND)
-        return self.receive(COM_IDENTIFY_RECV, timeout)
+        return self.query(COM_IDENTIFY_SEND, COM_IDENTIFY_RECV, timeout=timeout)
@@ -0,0 +1,257 @@
+import json
+import sys
+import numpy as np
+from serial import SerialException
+from multiprocessing import parent_process, resource_tracker, shared_memory
+from threading import Event, Thread
+from time import monotonic_ns, sleep
+from comms.sbus import SBusReceiver
+
+# The shared memory starts with a magic value and the length of a JSON list of [name, number of values] for each
+# record, followed by the list itself. The records follow, each a sequence number, a monotonic_ns timestamp and
+# its values as doubles, all 8 byte aligned
+HEADER_MAGIC = b"PWSTATE1"
+HEADER_LENGTH_BYTES = 8
+RECORD_HEADER_VALUES = 2
+
+DEFAULT_NAME = "piwarsengine_state"
+DEFAULT_LAYOUT = {
+    "sbus": SBusReceiver.MAX_CHANNELS,
+    "sbus_connected": 1,
+    "velocities": 3,
+    "encoders": 4,
+    "tofs": 4,
+}
+
+
+class StateBus:
+    # How many times read tries again straight away after catching a record part way through being written, before
+    # sleeping between tries for twice as long each time, up to the longest sleep in seconds
+    READ_SPINS = 4
+    MAX_READ_BACKOFF = 0.001
+
+    # The names of the shared memory this process has created and not yet removed
+    __created = set()
+
+    def __init__(self, name=DEFAULT_NAME, layout=None):
+        # With a layout, creates the shared memory to publish into. Without one, attaches to shared memory that
+        # another process has already created, reading the layout from it
+        if layout is not None:
+            description = json.dumps(list(layout.items())).encode()
+            data_offset = self.__align(len(HEADER_MAGIC) + HEADER_LENGTH_BYTES + len(description))
+            size = data_offset + sum((RECORD_HEADER_VALUES + count) * 8 for count in layout.values())
+
+            self.__memory = shared_memory.SharedMemory(name, create=True, size=size)
+            self.__owner = True
+            StateBus.__created.add(self.__memory.name)
+            buffer = self.__memory.buf
+            buffer[:len(HEADER_MAGIC)] = HEADER_MAGIC
+            buffer[len(HEADER_MAGIC):len(HEADER_MAGIC) + HEADER_LENGTH_BYTES] = len(description).to_bytes(8, "little")
+            buffer[len(HEADER_MAGIC) + HEADER_LENGTH_BYTES:len(HEADER_MAGIC) + HEADER_LENGTH_BYTES + len(description)] \
+                = description
+        else:
+            self.__memory = self.__attach(name)
+            self.__owner = False
+
+            buffer = self.__memory.buf
+            if bytes(buffer[:len(HEADER_MAGIC)]) != HEADER_MAGIC:
+                self.__memory.close()
+                raise ValueError(f"{name} is not a state bus")
+            length = int.from_bytes(buffer[len(HEADER_MAGIC):len(HEADER_MAGIC) + HEADER_LENGTH_BYTES], "little")
+            start = len(HEADER_MAGIC) + HEADER_LENGTH_BYTES
+            layout = dict(json.loads(bytes(buffer[start:start + length])))
+            data_offset = self.__align(start + length)
+
+        # NumPy views straight onto each record's sequence number, timestamp and values in the shared memory
+        self.__records = {}
+        offset = data_offset
+        for record, count in layout.items():
+            self.__records[record] = (np.ndarray((1,), np.uint64, buffer, offset),
+                                      np.ndarray((1,), np.int64, buffer, offset + 8),
+                                      np.ndarray((count,), np.float64, buffer, offset + 16))
+            offset += (RECORD_HEADER_VALUES + count) * 8
+
+    @staticmethod
+    def __attach(name):
+        # Only the creating process should remove the shared memory when it exits, but before Python 3.13 attaching
+        # always registers it to be removed by this process's resource tracker as well. A process started through
+        # multiprocessing shares the tracker of the process tree it belongs to, where the publisher has already
+        # registered it, so registering again changes nothing and unregistering would undo the publisher's, as it
+        # would in the publisher itself. Any other process has a tracker of its own, which just this segment is
+        # unregistered from again
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name, track=False)
+
+        memory = shared_memory.SharedMemory(name)
+        if parent_process() is None and memory.name not in StateBus.__created:
+            resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+    @staticmethod
+    def __align(offset):
+        return (offset + 7) & ~7
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__memory is None:
+            return
+
+        # The views must go before the shared memory can be closed
+        self.__records = {}
+        self.__memory.close()
+        if self.__owner:
+            self.__memory.unlink()
+            StateBus.__created.discard(self.__memory.name)
+        self.__memory = None
+
+    def layout(self):
+        return {record: len(values) for record, (_, _, values) in self.__records.items()}
+
+    def publish(self, record, values, time_ns=None):
+        # Each record must only be published from one thread of one process. The sequence number is odd while the
+        # values are being written, which tells readers to try again
+        sequence, timestamp, data = self.__records[record]
+        sequence[0] += 1
+        data[:len(values)] = values
+        timestamp[0] = monotonic_ns() if time_ns is None else time_ns
+        sequence[0] += 1
+
+    def read(self, record, out=None):
+        # A consistent copy of a record as (values, monotonic_ns time published, times published), or None if it
+        # has never been published. Pass a preallocated array as out to copy the values into it without allocating.
+        # This never takes a lock, only retrying if it catches a record part way through being written, and backing
+        # off so as not to starve the publisher of the CPU while it finishes.
+        # Neither Python nor NumPy give any memory barriers, so this relies on the publisher's writes being seen in
+        # the order they were made, and the copy not being moved before or after the sequence reads. That holds on
+        # x86, and in practice with the interpreter's work between each of them, but ARM is free to reorder them.
+        # A copy taken while the values were changing could then pass the check. Publish values that are still
+        # usable if mixed between two updates, or check them again against view() where that matters
+        sequence, timestamp, data = self.__records[record]
+        if out is None:
+            out = np.empty_like(data)
+
+        attempts = 0
+        while True:
+            before = int(sequence[0])
+            if not before & 1:
+                np.copyto(out, data)
+                time_ns = int(timestamp[0])
+                if int(sequence[0]) == before:
+                    return (out, time_ns, before // 2) if before > 0 else None
+
+            attempts += 1
+            sleep(0 if attempts <= self.READ_SPINS else
+                  min(0.000001 * 2 ** (attempts - self.READ_SPINS), self.MAX_READ_BACKOFF))
+
+    def view(self, record):
+        # A read-only NumPy view straight onto a record's values, with no copying at all. It can change while being
+        # looked at, so compare sequence() from before and after if it needs to be consistent
+        values = self.__records[record][2].view()
+        values.flags.writeable = False
+        return values
+
+    def sequence(self, record):
+        # Twice the number of times the record has been published, plus one while it is being written
+        return int(self.__records[record][0][0])
+
+
+class StatePublisher:
+    DEFAULT_RATE = 50
+
+    # How long to wait before polling the devices again after a poll failed
+    RETRY_DELAY = 0.1
+
+    def __init__(self, bus: StateBus, sbus_receiver=None, motor_driver=None, io_controller=None, rate=DEFAULT_RATE):
+        # Every SBUS frame is published as soon as the receiver's reader thread gets it, so call start() on the
+        # receiver first. Frames are taken with wait_for_frame, so nothing else in this process should wait on them.
+        # The devices are polled rate times a second
+        self.__bus = bus
+        self.__sbus_receiver = sbus_receiver
+        self.__motor_driver = motor_driver
+        self.__io_controller = io_controller
+        self.__period_ns = int(1000000000 / rate)
+
+        # How many device polls have failed, and the error from the last one that did, or from whatever stopped a
+        # thread. The records of a device that can't be polled stop changing, so check these to tell them from stale
+        self.__failures = 0
+        self.__last_error = None
+
+        self.__stop_event = Event()
+        self.__threads = []
+
+    def start(self):
+        if self.__threads:
+            return
+
+        self.__stop_event.clear()
+        if self.__sbus_receiver is not None:
+            self.__threads.append(Thread(target=self.__publish_sbus, daemon=True))
+        if self.__motor_driver is not None or self.__io_controller is not None:
+            self.__threads.append(Thread(target=self.__publish_devices, daemon=True))
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def is_running(self):
+        return bool(self.__threads) and all(thread.is_alive() for thread in self.__threads)
+
+    def failures(self):
+        return self.__failures
+
+    def last_error(self):
+        return self.__last_error
+
+    def __publish_sbus(self):
+        connected = None
+        try:
+            while not self.__stop_event.is_set():
+                frame = self.__sbus_receiver.wait_for_frame(0.1)
+                if frame is not None:
+                    self.__bus.publish("sbus", frame.channels, frame.received_ns)
+
+                if self.__sbus_receiver.is_connected() != connected:
+                    connected = self.__sbus_receiver.is_connected()
+                    self.__bus.publish("sbus_connected", (float(connected),))
+        except Exception as e:
+            # Anything going wrong here stops the publishing, which is_running shows
+            self.__last_error = e
+            raise
+
+    def __publish_devices(self):
+        # Polls are timed against absolute deadlines, so the time taken to read the devices doesn't add up
+        next_poll_ns = monotonic_ns()
+        try:
+            while not self.__stop_event.is_set():
+                try:
+                    if self.__motor_driver is not None:
+                        velocities, encoders = self.__motor_driver.read_state()
+                        time_ns = monotonic_ns()
+                        self.__bus.publish("velocities", velocities, time_ns)
+                        self.__bus.publish("encoders", encoders, time_ns)
+                    if self.__io_controller is not None:
+                        self.__bus.publish("tofs", self.__io_controller.read_tofs())
+                except (TimeoutError, SerialException, OSError, ValueError) as e:
+                    # Keep polling through a lost or corrupted reply, or a link dropping out for a while
+                    self.__failures += 1
+                    self.__last_error = e
+                    if self.__stop_event.wait(self.RETRY_DELAY):
+                        return
+                    next_poll_ns = monotonic_ns()
+                    continue
+
+                next_poll_ns = max(next_poll_ns + self.__period_ns, monotonic_ns())
+                self.__stop_event.wait((next_poll_ns - monotonic_ns()) / 1000000000)
+        except Exception as e:
+            # Anything else stops the polling, which is_running shows
+            self.__last_error = e
+            raise
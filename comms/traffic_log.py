@@ -0,0 +1,204 @@
+import mmap
+import os
+import struct
+import tty
+from select import select
+from threading import Event, Lock, Thread
+from time import monotonic_ns, sleep
+
+# Each record is a header followed by its data. Records name a port once with PORT_NAME, then refer to it by number
+RECORD_HEADER = struct.Struct("<QBBH")  # timestamp_ns, port number, direction, data length
+RX = 0
+TX = 1
+PORT_NAME = 2
+
+# The file starts with a magic value, followed by the offset just past the last complete record
+FILE_MAGIC = b"PWTRAFF1"
+FILE_HEADER = struct.Struct("<8sQ")
+
+
+class TrafficRecorder:
+    DEFAULT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path, size=DEFAULT_SIZE):
+        # The whole log is allocated and mapped up front, so recording a frame is just a copy into memory
+        self.__file = open(path, "w+b")
+        self.__file.truncate(size)
+        self.__map = mmap.mmap(self.__file.fileno(), size)
+        self.__size = size
+        self.__offset = FILE_HEADER.size
+        FILE_HEADER.pack_into(self.__map, 0, FILE_MAGIC, self.__offset)
+
+        self.__ports = {}
+        self.__dropped = 0
+        self.__lock = Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        with self.__lock:
+            if self.__map is None:
+                return
+
+            # Trim off the unused space, now it is no longer needed
+            self.__map.flush()
+            self.__map.close()
+            self.__map = None
+            self.__file.truncate(self.__offset)
+            self.__file.close()
+
+    def dropped(self):
+        # The number of records that didn't fit in the log
+        return self.__dropped
+
+    def port(self, name):
+        # Get the number used to refer to a port, naming it in the log the first time it is seen
+        with self.__lock:
+            number = self.__ports.get(name)
+            if number is None:
+                number = self.__ports[name] = len(self.__ports)
+                self.__append(number, PORT_NAME, name.encode())
+            return number
+
+    def record(self, port, direction, data):
+        with self.__lock:
+            self.__append(port, direction, data)
+
+    def __append(self, port, direction, data):
+        if self.__map is None:
+            return
+
+        length = len(data)
+        start = self.__offset + RECORD_HEADER.size
+        end = start + length
+        if end > self.__size:
+            self.__dropped += 1
+            return
+
+        RECORD_HEADER.pack_into(self.__map, self.__offset, monotonic_ns(), port, direction, length)
+        self.__map[start:end] = data
+
+        # Only move the end marker once the record is complete, so a crash never leaves half a record in the log
+        self.__offset = end
+        FILE_HEADER.pack_into(self.__map, 0, FILE_MAGIC, end)
+
+
+def read_log(path):
+    # Yields (timestamp_ns, port name, direction, data) for each RX or TX record in the log
+    with open(path, "rb") as log_file:
+        log = log_file.read()
+
+    magic, end = FILE_HEADER.unpack_from(log, 0)
+    if magic != FILE_MAGIC:
+        raise ValueError(f"{path} is not a traffic log")
+
+    ports = {}
+    offset = FILE_HEADER.size
+    while offset < end:
+        timestamp_ns, port, direction, length = RECORD_HEADER.unpack_from(log, offset)
+        offset += RECORD_HEADER.size
+        data = log[offset:offset + length]
+        offset += length
+
+        if direction == PORT_NAME:
+            ports[port] = data.decode()
+        else:
+            yield timestamp_ns, ports[port], direction, data
+
+
+class LogReplayer:
+    def __init__(self, path, speed=1.0):
+        # Everything each port received is played back out of a pseudo-terminal standing in for that port. With a
+        # speed of None it is played back as fast as it can be read, otherwise at the recorded times scaled by speed
+        self.__records = [(timestamp_ns, port, data) for timestamp_ns, port, direction, data in read_log(path)
+                          if direction == RX]
+        self.__speed = speed
+
+        self.__ptys = {}
+        for _, port, _ in self.__records:
+            if port not in self.__ptys:
+                master, slave = self.__ptys[port] = os.openpty()
+                os.set_blocking(master, False)
+
+                # Make sure nothing gets translated on the way through, even before the port is opened
+                tty.setraw(slave)
+
+        self.__stop_event = Event()
+        self.__finished = Event()
+        self.__threads = []
+
+    def port(self, name):
+        # The path to open in place of the recorded port
+        return os.ttyname(self.__ptys[name][1])
+
+    def ports(self):
+        return list(self.__ptys)
+
+    def start(self):
+        # Open the replayed ports before starting, as opening a port throws away anything already waiting in it
+        self.__stop_event.clear()
+        self.__finished.clear()
+        self.__threads = [Thread(target=self.__play, daemon=True)]
+        self.__threads += [Thread(target=self.__drain, args=(master,), daemon=True)
+                           for master, _ in self.__ptys.values()]
+        for thread in self.__threads:
+            thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # Wait for everything to have been played back
+        return self.__finished.wait(timeout)
+
+    def stop(self):
+        self.__stop_event.set()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+        for master, slave in self.__ptys.values():
+            os.close(master)
+            os.close(slave)
+        self.__ptys = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __play(self):
+        start_ns = monotonic_ns()
+        first_ns = self.__records[0][0] if self.__records else 0
+        for timestamp_ns, port, data in self.__records:
+            if self.__stop_event.is_set():
+                return
+
+            if self.__speed is not None:
+                delay_ns = (timestamp_ns - first_ns) / self.__speed - (monotonic_ns() - start_ns)
+                if delay_ns > 0 and self.__stop_event.wait(delay_ns / 1000000000):
+                    return
+
+            self.__write(self.__ptys[port][0], data)
+        self.__finished.set()
+
+    def __write(self, master, data):
+        view = memoryview(data)
+        while view and not self.__stop_event.is_set():
+            if select([], [master], [], 0.1)[1]:
+                try:
+                    view = view[os.write(master, view):]
+                except BlockingIOError:
+                    pass
+
+    def __drain(self, master):
+        # Whatever gets sent to the replayed ports is thrown away, so the port never fills up
+        while not self.__stop_event.is_set():
+            if select([master], [], [], 0.1)[0]:
+                try:
+                    os.read(master, 4096)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    # Nothing has the port open at the moment
+                    sleep(0.1)
@@ -0,0 +1,152 @@
+import math
+import numpy as np
+from threading import Event, Thread
+from time import monotonic_ns
+from devices.motor_driver import MotorDriver
+
+
+class MotionProfile:
+    # The velocities to send at each tick of a move, as an N x 3 array of metres per second forward, metres per
+    # second right and degrees per second of turn, in the order set_all_velocities takes them. Each row is the
+    # average velocity over its tick, so the rows add up to exactly the distances asked for, as long as every row is
+    # sent. MotionProfilePlayer won't play one while the motor driver is coalescing, as that could drop rows
+    MAX_SPEED = 0.5                 # metres per second
+    MAX_ACCELERATION = 1.0          # metres per second squared
+    MAX_JERK = 10.0                 # metres per second cubed
+    MAX_TURN_SPEED = 180.0          # degrees per second
+    MAX_TURN_ACCELERATION = 360.0   # degrees per second squared
+    MAX_TURN_JERK = 3600.0          # degrees per second cubed
+
+    DEFAULT_RATE = MotorDriver.DEFAULT_COALESCING_RATE
+
+    def __init__(self, velocities, rate=DEFAULT_RATE):
+        self.velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 3)
+        self.rate = rate
+
+    def __len__(self):
+        return len(self.velocities)
+
+    def duration(self):
+        return len(self.velocities) / self.rate
+
+    def displacement(self):
+        # How far the move goes forward and right in metres, and turns in degrees, in the robot's own frame
+        return tuple((self.velocities.sum(axis=0) / self.rate).tolist())
+
+    @classmethod
+    def trapezoidal(cls, forward=0.0, right=0.0, turn=0.0, max_speed=MAX_SPEED, max_acceleration=MAX_ACCELERATION,
+                    max_turn_speed=MAX_TURN_SPEED, max_turn_acceleration=MAX_TURN_ACCELERATION, rate=DEFAULT_RATE):
+        # Accelerate at a constant rate, cruise, then decelerate to a stop, having gone forward and right the given
+        # metres and turned the given degrees. All three finish together, with the speed limit applying to the
+        # linear speed in whichever direction the robot is going
+        speed, acceleration, _ = cls.__path_limits(forward, right, turn, (max_speed, max_turn_speed),
+                                                   (max_acceleration, max_turn_acceleration))
+        return cls(np.outer(cls.__path_velocities(speed, acceleration, rate), (forward, right, turn)), rate)
+
+    @classmethod
+    def s_curve(cls, forward=0.0, right=0.0, turn=0.0, max_speed=MAX_SPEED, max_acceleration=MAX_ACCELERATION,
+                max_jerk=MAX_JERK, max_turn_speed=MAX_TURN_SPEED, max_turn_acceleration=MAX_TURN_ACCELERATION,
+                max_turn_jerk=MAX_TURN_JERK, rate=DEFAULT_RATE):
+        # As trapezoidal, but with the acceleration ramped up and down so it never jumps. Averaging the trapezoidal
+        # profile over a sliding window as long as the ramps gives exactly that, without changing the distance
+        speed, acceleration, jerk = cls.__path_limits(forward, right, turn, (max_speed, max_turn_speed),
+                                                      (max_acceleration, max_turn_acceleration),
+                                                      (max_jerk, max_turn_jerk))
+        path = cls.__path_velocities(speed, acceleration, rate)
+        window = max(int(round(acceleration / jerk * rate)), 1)
+        path = np.convolve(path, np.full(window, 1 / window))
+        return cls(np.outer(path, (forward, right, turn)), rate)
+
+    @staticmethod
+    def __path_limits(forward, right, turn, speeds, accelerations, jerks=(math.inf, math.inf)):
+        # The move is followed as a path from 0 to 1, whose limits are the tightest of those of the linear and
+        # turning parts of the move
+        linear = math.hypot(forward, right)
+        turn = abs(turn)
+        limits = []
+        for linear_limit, turn_limit in (speeds, accelerations, jerks):
+            limits.append(min(linear_limit / linear if linear > 0 else math.inf,
+                              turn_limit / turn if turn > 0 else math.inf))
+        if math.isinf(limits[0]):
+            raise ValueError("A motion profile needs somewhere to move to")
+        return limits
+
+    @staticmethod
+    def __path_velocities(speed, acceleration, rate):
+        # How far along the path the trapezoidal profile is at the start of each tick, and so the average speed
+        # over each tick. If there isn't room to reach full speed, it only gets as fast as it can
+        speed = min(speed, math.sqrt(acceleration))
+        ramp_time = speed / acceleration
+        cruise_time = 1 / speed - ramp_time
+        total_time = 2 * ramp_time + cruise_time
+
+        times = np.minimum(np.arange(math.ceil(total_time * rate) + 1) / rate, total_time)
+        positions = np.where(times < ramp_time, 0.5 * acceleration * times ** 2,
+                             np.where(times < ramp_time + cruise_time,
+                                      0.5 * speed * ramp_time + speed * (times - ramp_time),
+                                      1 - 0.5 * acceleration * (total_time - times) ** 2))
+        return np.diff(positions) * rate
+
+
+class MotionProfilePlayer:
+    # Sends each tick of a MotionProfile to the motor driver at the profile's rate, then stops. Everything is worked
+    # out in advance, so all each tick does is look up its velocities and send them
+    def __init__(self, motor_driver: MotorDriver):
+        self.__motor_driver = motor_driver
+        self.__abort_event = Event()
+        self.__finished = Event()
+        self.__finished.set()
+        self.__thread = None
+        self.__completed = False
+
+    def start(self, profile: MotionProfile):
+        # Play the profile from a background thread, aborting whatever was already playing. Coalescing would only
+        # send whichever row was pending at each flush, so the robot wouldn't go the distances asked for
+        if self.__motor_driver.is_coalescing():
+            raise RuntimeError("Can't play a motion profile while the motor driver is coalescing setpoints")
+
+        self.abort()
+        self.__abort_event.clear()
+        self.__finished.clear()
+        self.__completed = False
+        self.__thread = Thread(target=self.__run, args=(profile.velocities.tolist(), profile.rate), daemon=True)
+        self.__thread.start()
+
+    def play(self, profile: MotionProfile):
+        # Play the profile to the end, returning whether it got there without being aborted
+        self.start(profile)
+        return self.wait()
+
+    def wait(self, timeout=None):
+        # Wait for the profile to finish, returning whether it played to the end
+        self.__finished.wait(timeout)
+        return self.__completed
+
+    def is_playing(self):
+        return not self.__finished.is_set()
+
+    def abort(self):
+        # Stop the robot straight away, rather than letting it finish the move
+        if self.__thread is None:
+            return
+
+        self.__abort_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def __run(self, ticks, rate):
+        # Ticks are timed against absolute deadlines, so the time taken to send each doesn't add up
+        period_ns = int(1000000000 / rate)
+        next_tick_ns = monotonic_ns()
+        try:
+            for velocities in ticks:
+                self.__motor_driver.set_all_velocities(*velocities)
+
+                next_tick_ns += period_ns
+                if self.__abort_event.wait(max(next_tick_ns - monotonic_ns(), 0) / 1000000000):
+                    return
+
+            self.__completed = True
+        finally:
+            self.__motor_driver.stop_moving()
+            self.__finished.set()
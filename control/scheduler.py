@@ -0,0 +1,149 @@
+from threading import Event, Lock, Thread
+from time import monotonic_ns
+from comms.link_stats import LatencyHistogram
+
+
+class PeriodicTask:
+    def __init__(self, name, function, period_ns, priority, next_ns):
+        self.name = name
+        self.function = function
+        self.period_ns = period_ns
+        self.priority = priority
+        self.next_ns = next_ns
+
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.execution = LatencyHistogram()
+        self.jitter = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            "rate": 1000000000 / self.period_ns,
+            "priority": self.priority,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "execution": self.execution.snapshot(),
+            "jitter": self.jitter.snapshot(),
+        }
+
+
+class Scheduler:
+    # Higher priorities run first when several tasks are due at once. Anything keeping the robot safe, such as
+    # stopping the motors when the SBUS link is lost, should use SAFETY_PRIORITY
+    SAFETY_PRIORITY = 100
+    DEFAULT_PRIORITY = 0
+
+    def __init__(self, overrun_handler=None, error_handler=None):
+        # overrun_handler is called with the task name and how late it ran, in seconds, whenever a task misses its
+        # deadline. error_handler is called with the task name and the exception whenever a task raises one
+        self.__overrun_handler = overrun_handler
+        self.__error_handler = error_handler if error_handler is not None else lambda name, e: print(f"{name}: {e}")
+
+        self.__tasks = {}
+        self.__lock = Lock()
+        self.__wake_event = Event()
+        self.__stop_event = Event()
+        self.__thread = None
+
+    def add_task(self, name, function, rate, priority=DEFAULT_PRIORITY, phase=0.0):
+        # Run function rate times a second, starting phase seconds from now. Offsetting the phases of tasks with
+        # the same rate keeps them from all falling due at once
+        if rate <= 0:
+            raise ValueError("rate must be greater than zero")
+
+        with self.__lock:
+            if name in self.__tasks:
+                raise ValueError(f"A task called {name} already exists")
+            self.__tasks[name] = PeriodicTask(name, function, int(1000000000 / rate), priority,
+                                              monotonic_ns() + int(phase * 1000000000))
+
+        # Let the loop work out its next wake up again, now there is another task to consider
+        self.__wake_event.set()
+
+    def remove_task(self, name):
+        with self.__lock:
+            del self.__tasks[name]
+
+    def tasks(self):
+        with self.__lock:
+            return list(self.__tasks)
+
+    def stats(self):
+        # Execution times, start time jitter, and counts of runs, overruns, skipped periods and errors for each task
+        with self.__lock:
+            return {name: task.snapshot() for name, task in self.__tasks.items()}
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__wake_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def run(self, duration=None):
+        # Run the tasks in this thread until stopped, or for duration seconds
+        end_ns = None if duration is None else monotonic_ns() + int(duration * 1000000000)
+        while not self.__stop_event.is_set():
+            self.__wake_event.clear()
+            task = self.__next_task()
+            now_ns = monotonic_ns()
+            if end_ns is not None and now_ns >= end_ns:
+                return
+
+            # Sleep until the task is due, waking early if a task is added or the scheduler is stopped
+            if task is None or task.next_ns > now_ns:
+                wake_ns = task.next_ns if task is not None else now_ns + 1000000000
+                if end_ns is not None:
+                    wake_ns = min(wake_ns, end_ns)
+                self.__wake_event.wait((wake_ns - now_ns) / 1000000000)
+                continue
+
+            self.__run_task(task, now_ns)
+
+    def __next_task(self):
+        # The task that is due soonest. Of those that are already due, the one with the highest priority
+        with self.__lock:
+            now_ns = monotonic_ns()
+            return min(self.__tasks.values(), default=None,
+                       key=lambda task: (max(task.next_ns, now_ns), -task.priority, task.next_ns))
+
+    def __run_task(self, task, start_ns):
+        deadline_ns = task.next_ns
+        try:
+            task.function()
+        except Exception as e:
+            task.errors += 1
+            self.__error_handler(task.name, e)
+        end_ns = monotonic_ns()
+
+        with self.__lock:
+            task.runs += 1
+            task.execution.record(end_ns - start_ns)
+            task.jitter.record(start_ns - deadline_ns)
+
+            # Deadlines are absolute, so a late run doesn't push back the ones after it. If a whole period or more
+            # has been lost, the missed runs are skipped rather than run back to back to catch up
+            task.next_ns = deadline_ns + task.period_ns
+            if task.next_ns <= end_ns:
+                missed = (end_ns - task.next_ns) // task.period_ns + 1
+                task.next_ns += missed * task.period_ns
+                task.skipped += missed
+                task.overruns += 1
+                late = (end_ns - deadline_ns - task.period_ns) / 1000000000
+            else:
+                late = None
+
+        if late is not None and self.__overrun_handler is not None:
+            self.__overrun_handler(task.name, late)
@@ -1,5 +1,5 @@
-from .motor_driver import MotorDriver
-from .io_controller import IOController
+from .motor_driver import MotorDriver, AsyncMotorDriver
+from .io_controller import IOController, AsyncIOController
 
 DEVICE_ID_LIST = {
     MotorDriver.EXPECTED_ID: MotorDriver.NAME,
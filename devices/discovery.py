@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from serial import SerialException
+from serial.tools import list_ports
+from comms.async_serial import AsyncSerialComms
+from comms.serial import SerialComms
+from devices import MotorDriver, IOController, AsyncMotorDriver, AsyncIOController, DEVICE_ID_LIST
+
+# The path wildcard pattern to search
+PATTERN = '/dev/ttyACM*'
+
+PROBE_TIMEOUT = 0.25
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "piwarsengine", "ports.json")
+
+DEVICE_CLASSES = (MotorDriver, IOController)
+ASYNC_DEVICE_CLASSES = (AsyncMotorDriver, AsyncIOController)
+
+
+def find_serial_ports(pattern=PATTERN):
+    return sorted(glob(pattern))
+
+
+def port_key(port, port_info=None):
+    # Identify a port by its USB serial number where possible, as that stays the same whichever socket it is
+    # plugged into and whatever ttyACM number it gets. Fall back to its USB location, then the device path
+    info = (port_info or {}).get(os.path.realpath(port))
+    if info is not None:
+        if info.serial_number:
+            return f"serial:{info.serial_number}"
+        if info.location:
+            return f"location:{info.location}"
+    return f"device:{port}"
+
+
+def load_port_cache(cache_path=CACHE_PATH):
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_port_cache(cache, cache_path=CACHE_PATH):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as e:
+        print(f"Could not save the port cache to {cache_path}: {e}")
+
+
+def probe_port(port, timeout=PROBE_TIMEOUT, verbose=True):
+    # Returns the identity of the device on the port along with its open SerialComms, or None if nothing answered
+    try:
+        comms = SerialComms(port)
+    except SerialException as e:
+        if verbose:
+            print(f"Error opening serial port {port}: {e}")
+        return None
+
+    if verbose:
+        print(f"Serial port {port} opened successfully.")
+
+    # The port is closed again however identifying it fails, so only the ports of found devices stay open
+    identity = None
+    try:
+        identity = comms.identify(timeout)
+    except (ValueError, TimeoutError):
+        if verbose:
+            print(f"Not a recognised device on {port}")
+    finally:
+        if identity is None:
+            comms.__del__()
+
+    return report_identity(port, identity, comms, verbose)
+
+
+async def async_probe_port(port, timeout=PROBE_TIMEOUT, verbose=True):
+    # The same as probe_port, but with an open AsyncSerialComms
+    try:
+        comms = AsyncSerialComms(port)
+    except SerialException as e:
+        if verbose:
+            print(f"Error opening serial port {port}: {e}")
+        return None
+
+    if verbose:
+        print(f"Serial port {port} opened successfully.")
+
+    identity = None
+    try:
+        identity = await comms.identify(timeout)
+    except (ValueError, TimeoutError):
+        if verbose:
+            print(f"Not a recognised device on {port}")
+    finally:
+        if identity is None:
+            comms.close()
+
+    return report_identity(port, identity, comms, verbose)
+
+
+def report_identity(port, identity, comms, verbose):
+    if identity is None:
+        return None
+
+    if verbose:
+        if identity in DEVICE_ID_LIST:
+            print(f"Found device: {hex(identity)} ({DEVICE_ID_LIST[identity]}) on {port}")
+        else:
+            print(f"Found unknown device: {hex(identity)} on {port}")
+    return identity, comms
+
+
+def create_serial_instances(port_list, timeout=PROBE_TIMEOUT, verbose=True):
+    # Probe every port at the same time, so startup takes as long as the slowest port rather than all of them
+    if not port_list:
+        return {}, {}
+
+    with ThreadPoolExecutor(max_workers=len(port_list)) as executor:
+        results = executor.map(lambda port: probe_port(port, timeout, verbose), port_list)
+        return collect_instances(port_list, results, lambda comms: comms.__del__())
+
+
+async def async_create_serial_instances(port_list, timeout=PROBE_TIMEOUT, verbose=True):
+    # The same as create_serial_instances, with the ports probed together from the running event loop
+    results = await asyncio.gather(*(async_probe_port(port, timeout, verbose) for port in port_list))
+    return collect_instances(port_list, results, lambda comms: comms.close())
+
+
+def collect_instances(port_list, results, close):
+    # Map each identity found to its comms and port, closing any port with a device already found on another
+    serial_instances = {}
+    ports = {}
+    for port, result in zip(port_list, results):
+        if result is not None:
+            identity, comms = result
+            if identity in serial_instances:
+                close(comms)
+                continue
+            serial_instances[identity] = comms
+            ports[identity] = port
+    return serial_instances, ports
+
+
+def discover_devices(pattern=PATTERN, timeout=PROBE_TIMEOUT, cache_path=CACHE_PATH, verbose=True):
+    # Returns a dict mapping MotorDriver and IOController to an instance of each that was found
+    search = PortSearch(pattern, cache_path, verbose)
+    if search.found_nothing():
+        return {}
+
+    # Try the ports that held one of our devices last time first. If they still do, the rest needn't be probed
+    search.add(*create_serial_instances(search.cached_ports(), timeout, verbose))
+    if not search.found_all():
+        search.add(*create_serial_instances(search.remaining_ports(), timeout, verbose))
+    return search.finish(DEVICE_CLASSES)
+
+
+async def async_discover_devices(pattern=PATTERN, timeout=PROBE_TIMEOUT, cache_path=CACHE_PATH, verbose=True):
+    # The same as discover_devices, but returns a dict mapping AsyncMotorDriver and AsyncIOController to an instance
+    # of each that was found. Must be called from the event loop the devices will be used from
+    search = PortSearch(pattern, cache_path, verbose, close=lambda comms: comms.close())
+    if search.found_nothing():
+        return {}
+
+    search.add(*await async_create_serial_instances(search.cached_ports(), timeout, verbose))
+    if not search.found_all():
+        search.add(*await async_create_serial_instances(search.remaining_ports(), timeout, verbose))
+    return search.finish(ASYNC_DEVICE_CLASSES)
+
+
+class PortSearch:
+    # Keeps track of which ports have been probed and what was found on them, so the sync and async discovery share
+    # the port cache handling
+    def __init__(self, pattern, cache_path, verbose, close=lambda comms: comms.__del__()):
+        self.__port_list = find_serial_ports(pattern)
+        self.__cache_path = cache_path
+        self.__close = close
+        self.__instances = {}
+        self.__ports = {}
+        self.__probed_ports = []
+        self.__wanted = {device_class.EXPECTED_ID for device_class in DEVICE_CLASSES}
+
+        if not self.__port_list:
+            if verbose:
+                print(f"No serial ports found matching the pattern '{pattern}'.")
+            return
+
+        port_info = {os.path.realpath(info.device): info for info in list_ports.comports()}
+        self.__keys = {port: port_key(port, port_info) for port in self.__port_list}
+        self.__cache = load_port_cache(cache_path) if cache_path is not None else {}
+
+    def found_nothing(self):
+        return not self.__port_list
+
+    def found_all(self):
+        return self.__wanted.issubset(self.__instances.keys())
+
+    def cached_ports(self):
+        # The ports that held one of our devices last time
+        ports = [port for port in self.__port_list if self.__cache.get(self.__keys[port]) in self.__wanted]
+        self.__probed_ports += ports
+        return ports
+
+    def remaining_ports(self):
+        ports = [port for port in self.__port_list if port not in self.__probed_ports]
+        self.__probed_ports += ports
+        return ports
+
+    def add(self, instances, ports):
+        for identity, comms in instances.items():
+            if identity in self.__instances:
+                self.__close(comms)
+            else:
+                self.__instances[identity] = comms
+                self.__ports[identity] = ports[identity]
+
+    def finish(self, device_classes):
+        # Returns a dict mapping each of device_classes to an instance on the port its device was found on
+        if self.__cache_path is not None:
+            # Forget whatever was cached against the probed ports, as some may now hold something else or nothing
+            for port in self.__probed_ports:
+                self.__cache.pop(self.__keys[port], None)
+            self.__cache.update({self.__keys[port]: identity for identity, port in self.__ports.items()})
+            save_port_cache(self.__cache, self.__cache_path)
+
+        devices = {}
+        for device_class in device_classes:
+            if device_class.EXPECTED_ID in self.__instances:
+                devices[device_class] = device_class(self.__instances.pop(device_class.EXPECTED_ID))
+
+        # Close any ports with unknown devices on them
+        for comms in self.__instances.values():
+            self.__close(comms)
+
+        return devices
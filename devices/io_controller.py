@@ -1,9 +1,17 @@
-from comms.serial import make_command, SerialComms, SSHORT, UBYTE, USHORT
+from comms.serial import make_command, CorruptedReplyError, SerialComms, SSHORT, UBYTE, USHORT
+from comms.async_serial import AsyncSerialComms
+from devices.state_cache import StateCache
+from serial import SerialException
+from threading import Event, Lock, Thread
+from time import monotonic_ns
 
 
 COM_READ_TOF_SEND = make_command('T', UBYTE)
 COM_READ_TOF_RECV = make_command('T', SSHORT)
 
+# Every ToF distance at once, as pushed by the IO Controller when streaming
+COM_READ_TOFS_RECV = make_command('t', SSHORT * 4)
+
 COM_SET_LED_SEND = make_command('L', UBYTE * 4)
 
 COM_SET_GRIPPER_SEND = make_command('G', UBYTE)
@@ -30,9 +38,27 @@ class IOController:
 
     TOF_SCALING = 10.0
 
-    def __init__(self, comms: SerialComms):
+    DEFAULT_STREAM_RATE = 20
+
+    GRIPPER_STATE_TTL = 0.5
+    BARREL_STATE_TTL = 0.2
+
+    def __init__(self, comms: SerialComms, gripper_state_ttl=GRIPPER_STATE_TTL, barrel_state_ttl=BARREL_STATE_TTL,
+                 retries=0):
         self.__comms = comms
 
+        # How many times to ask again for a reply that arrives corrupted, such as from motor noise
+        self.__retries = retries
+
+        # The colour last sent to each LED, so unchanged LEDs don't need sending again. The lock is held while
+        # sending too, so the colours cached always match the order they reached the IO Controller in when an
+        # LEDAnimation and another thread both set LEDs
+        self.__leds = {}
+        self.__leds_lock = Lock()
+
+        # Recent device state, so repeated queries and actuator commands can skip a round trip
+        self.__cache = StateCache({"gripper": gripper_state_ttl, "barrel": barrel_state_ttl})
+
     def __del__(self):
         self.__comms.__del__()
 
@@ -42,49 +68,109 @@ class IOController:
     def identify(self, timeout=SerialComms.DEFAULT_TIMEOUT):
         return self.__comms.identify(timeout)
 
-    def read_tof(self, index=0, timeout=SerialComms.DEFAULT_TIMEOUT):
-        self.__comms.send(COM_READ_TOF_SEND, index)
+    def cache_stats(self):
+        return self.__cache.stats()
 
+    def invalidate_cache(self):
+        self.__cache.invalidate()
+
+    def __query(self, send_command, receive_command, *data, timeout=None):
+        # Don't trust anything cached once the link has had trouble
+        try:
+            return self.__comms.query(send_command, receive_command, *data, timeout=timeout, retries=self.__retries)
+        except (ValueError, TimeoutError):
+            self.__cache.invalidate()
+            raise
+
+    def read_tof(self, index=0, timeout=None):
         # Catch an infrequent checksum error that occurs
         try:
-            return self.__comms.receive(COM_READ_TOF_RECV, timeout) / self.TOF_SCALING
+            return self.__query(COM_READ_TOF_SEND, COM_READ_TOF_RECV, index, timeout=timeout) / self.TOF_SCALING
         except ValueError as e:
             print(e)
             return -99
 
+    def read_tofs(self, indices=(0, 1, 2, 3), timeout=None):
+        # Request all the ToFs at once so they share a single round trip
+        requests = [(COM_READ_TOF_SEND, index) for index in indices]
+
+        # Catch an infrequent checksum error that occurs, keeping the readings that did arrive intact
+        try:
+            readings = self.__comms.pipeline(requests, [COM_READ_TOF_RECV] * len(requests), timeout, self.__retries)
+            return [reading / self.TOF_SCALING for reading in readings]
+        except CorruptedReplyError as e:
+            print(e)
+            self.__cache.invalidate()
+            return [-99 if reading is None else reading / self.TOF_SCALING for reading in e.replies]
+        except TimeoutError:
+            self.__cache.invalidate()
+            raise
+
+    def stream_tofs(self, rate=DEFAULT_STREAM_RATE, handler=None):
+        # Have the IO Controller push all the ToF distances rate times a second rather than waiting to be asked.
+        # Each set is passed to handler if one is given, and the latest is always available from latest_tofs
+        self.__comms.subscribe(COM_READ_TOFS_RECV,
+                               None if handler is None else lambda readings: handler(self.__scale_tofs(readings)))
+        self.__comms.request_stream(COM_READ_TOFS_RECV, rate)
+        self.__comms.start_streaming()
+
+    def stop_tof_stream(self):
+        self.__comms.request_stream(COM_READ_TOFS_RECV, 0)
+        self.__comms.unsubscribe(COM_READ_TOFS_RECV)
+        self.__comms.stop_streaming()
+
+    def latest_tofs(self):
+        # The latest streamed distances and the monotonic_ns time they arrived, or None if none have yet
+        latest = self.__comms.latest(COM_READ_TOFS_RECV)
+        return None if latest is None else (self.__scale_tofs(latest[0]), latest[1])
+
+    def __scale_tofs(self, readings):
+        return [reading / self.TOF_SCALING for reading in readings]
+
     def open_gripper(self):
-        # could also check here if it was in the process of opening so
-        # as not to send open twice
-        if self.gripper_state() == GRIPPER_OPEN:
+        # Don't send open again if the gripper is already open or part way through opening
+        if self.gripper_state() in (GRIPPER_OPEN, GRIPPER_OPENING):
             return
         self.__comms.send(COM_SET_GRIPPER_SEND, GRIPPER_OPEN)
+        self.__cache.set("gripper", GRIPPER_OPENING)
 
     def close_gripper(self):
-        # same again but could check if it was already closing
-        if self.gripper_state() == GRIPPER_CLOSED:
+        # Same again, but for closing
+        if self.gripper_state() in (GRIPPER_CLOSED, GRIPPER_CLOSING):
             return
         self.__comms.send(COM_SET_GRIPPER_SEND, GRIPPER_CLOSED)
+        self.__cache.set("gripper", GRIPPER_CLOSING)
 
     def gripper_state(self):
-        self.__comms.send(COM_READ_GRIPPER_SEND)
+        state = self.__cache.get("gripper")
+        if state is not None:
+            return state
 
         # Catch an infrequent checksum error that occurs
         try:
-            return self.__comms.receive(COM_READ_GRIPPER_RECV)
+            state = self.__query(COM_READ_GRIPPER_SEND, COM_READ_GRIPPER_RECV)
         except ValueError as e:
             print(e)
             return GRIPPER_UNKNOWN
 
+        self.__cache.set("gripper", state)
+        return state
+
     def barrel_state(self):
-        self.__comms.send(COM_READ_BARREL_SEND)
+        state = self.__cache.get("barrel")
+        if state is not None:
+            return state
 
         # Catch an infrequent checksum error that occurs
         try:
-            return self.__comms.receive(COM_READ_BARREL_RECV)
+            state = self.__query(COM_READ_BARREL_SEND, COM_READ_BARREL_RECV)
         except ValueError as e:
             print(e)
             return 0
 
+        self.__cache.set("barrel", state)
+        return state
+
     def power_turret(self, state=0):
         self.__comms.send(COM_POWER_TURRET_SEND, state)
 
@@ -96,7 +182,188 @@ class IOController:
 
     def fire(self):
         # could potentially add a timeout on calling this?
-        return self.__comms.send(COM_FIRE_TURRET_SEND)
+        self.__comms.send(COM_FIRE_TURRET_SEND)
+
+        # Firing changes what is in the barrel, so it will need asking for again
+        self.__cache.invalidate("barrel")
 
     def set_led(self, led, r, g, b):
-        self.__comms.send(COM_SET_LED_SEND, led, int(r), int(g), int(b))
+        colour = (int(r), int(g), int(b))
+        with self.__leds_lock:
+            self.__comms.send(COM_SET_LED_SEND, led, *colour)
+            self.__leds[led] = colour
+
+    def set_leds(self, colours):
+        # Takes an (r, g, b) for each LED, as a sequence or an N x 3 NumPy array
+        if hasattr(colours, "tolist"):
+            colours = colours.tolist()
+
+        # Only send the LEDs that have changed since they were last sent, all in a single write
+        with self.__leds_lock:
+            changed = {}
+            for led, (r, g, b) in enumerate(colours):
+                colour = (int(r), int(g), int(b))
+                if self.__leds.get(led) != colour:
+                    changed[led] = colour
+
+            if changed:
+                self.__comms.send_all([(COM_SET_LED_SEND, led, *colour) for led, colour in changed.items()])
+                self.__leds.update(changed)
+
+    def forget_leds(self):
+        # Makes the next set_leds send every LED, such as after the IO Controller has been reset
+        with self.__leds_lock:
+            self.__leds.clear()
+
+
+class LEDAnimation:
+    # How long to wait before trying again after a frame couldn't be sent
+    RETRY_DELAY = 0.1
+
+    def __init__(self, io_controller: IOController, frames, fps, repeat=True):
+        # Each frame is whatever IOController.set_leds takes, so frames can be a list of those or an F x N x 3 array
+        self.__io_controller = io_controller
+        self.__frames = frames
+        self.__period_ns = int(1000000000 / fps)
+        self.__repeat = repeat
+
+        # Frames that couldn't be sent, and why the last one failed
+        self.__failures = 0
+        self.__last_error = None
+
+        self.__stop_event = Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def failures(self):
+        return self.__failures
+
+    def last_error(self):
+        return self.__last_error
+
+    def __run(self):
+        # Frames are timed against absolute deadlines, so the time taken to send one doesn't delay the rest
+        next_frame_ns = monotonic_ns()
+        try:
+            while True:
+                for frame in self.__frames:
+                    try:
+                        self.__io_controller.set_leds(frame)
+                    except (SerialException, OSError) as e:
+                        # Keep animating through the link dropping out for a while, skipping the frames missed
+                        self.__failures += 1
+                        self.__last_error = e
+                        if self.__stop_event.wait(self.RETRY_DELAY):
+                            return
+                        next_frame_ns = monotonic_ns()
+                        continue
+
+                    next_frame_ns += self.__period_ns
+                    if self.__stop_event.wait(max(next_frame_ns - monotonic_ns(), 0) / 1000000000):
+                        return
+
+                if not self.__repeat:
+                    return
+        except Exception as e:
+            # Anything else stops the animation, which is_running shows
+            self.__last_error = e
+            raise
+
+
+class AsyncIOController:
+    NAME = IOController.NAME
+    EXPECTED_ID = IOController.EXPECTED_ID
+
+    TOF_SCALING = IOController.TOF_SCALING
+
+    def __init__(self, comms: AsyncSerialComms):
+        self.__comms = comms
+
+    def __del__(self):
+        self.__comms.__del__()
+
+    async def poke(self):
+        await self.__comms.poke()
+
+    async def identify(self, timeout=AsyncSerialComms.DEFAULT_TIMEOUT):
+        return await self.__comms.identify(timeout)
+
+    async def read_tof(self, index=0, timeout=None):
+        # Catch an infrequent checksum error that occurs
+        try:
+            reading = await self.__comms.query(COM_READ_TOF_SEND, COM_READ_TOF_RECV, index, timeout=timeout)
+            return reading / self.TOF_SCALING
+        except ValueError as e:
+            print(e)
+            return -99
+
+    async def read_tofs(self, indices=(0, 1, 2, 3), timeout=None):
+        # Request all the ToFs at once so they share a single round trip
+        requests = [(COM_READ_TOF_SEND, index) for index in indices]
+
+        # Catch an infrequent checksum error that occurs, keeping the readings that did arrive intact
+        try:
+            readings = await self.__comms.pipeline(requests, [COM_READ_TOF_RECV] * len(requests), timeout)
+            return [reading / self.TOF_SCALING for reading in readings]
+        except CorruptedReplyError as e:
+            print(e)
+            return [-99 if reading is None else reading / self.TOF_SCALING for reading in e.replies]
+
+    async def open_gripper(self):
+        if await self.gripper_state() == GRIPPER_OPEN:
+            return
+        await self.__comms.send(COM_SET_GRIPPER_SEND, GRIPPER_OPEN)
+
+    async def close_gripper(self):
+        if await self.gripper_state() == GRIPPER_CLOSED:
+            return
+        await self.__comms.send(COM_SET_GRIPPER_SEND, GRIPPER_CLOSED)
+
+    async def gripper_state(self):
+        # Catch an infrequent checksum error that occurs
+        try:
+            return await self.__comms.query(COM_READ_GRIPPER_SEND, COM_READ_GRIPPER_RECV)
+        except ValueError as e:
+            print(e)
+            return GRIPPER_UNKNOWN
+
+    async def barrel_state(self):
+        # Catch an infrequent checksum error that occurs
+        try:
+            return await self.__comms.query(COM_READ_BARREL_SEND, COM_READ_BARREL_RECV)
+        except ValueError as e:
+            print(e)
+            return 0
+
+    async def power_turret(self, state=0):
+        await self.__comms.send(COM_POWER_TURRET_SEND, state)
+
+    async def turret_tilt(self, angle=0):
+        await self.__comms.send(COM_SET_TURRET_TILT_SEND, angle)
+
+    async def turret_speed(self, speed=0):
+        await self.__comms.send(COM_SET_TURRET_SPEED_SEND, speed)
+
+    async def fire(self):
+        await self.__comms.send(COM_FIRE_TURRET_SEND)
+
+    async def set_led(self, led, r, g, b):
+        await self.__comms.send(COM_SET_LED_SEND, led, int(r), int(g), int(b))
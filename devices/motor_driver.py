@@ -1,4 +1,7 @@
 from comms.serial import make_command, SerialComms, SSHORT
+from comms.async_serial import AsyncSerialComms
+from threading import Event, Lock, Thread
+from time import monotonic_ns
 
 COM_SET_FORWARD_VELOCITY = make_command('#', SSHORT)
 COM_SET_RIGHT_VELOCITY = make_command('&', SSHORT)
@@ -25,37 +28,114 @@ class MotorDriver:
     DEGREES_SCALING = 50
     ENCODER_SCALING = 60
 
+    DEFAULT_COALESCING_RATE = 50
+    DEFAULT_STREAM_RATE = 50
+
     def __init__(self, comms: SerialComms):
         self.__comms = comms
 
+        # Setpoints and stopping go ahead of any reads other threads have waiting for the link
+        for command in (COM_SET_FORWARD_VELOCITY, COM_SET_RIGHT_VELOCITY, COM_SET_LINEAR_VELOCITIES,
+                        COM_SET_ANGULAR_VELOCITY, COM_SET_ALL_VELOCITIES):
+            comms.set_priority(command, SerialComms.SETPOINT_PRIORITY)
+        comms.set_priority(COM_STOP_MOVING, SerialComms.SAFETY_PRIORITY)
+
+        # When coalescing, set_all_velocities only updates the pending setpoint, which a flusher thread sends at a
+        # fixed rate. The last setpoint sent is remembered so repeats of it can be skipped
+        self.__setpoint_lock = Lock()
+        self.__pending_setpoint = None
+        self.__sent_setpoint = None
+        self.__coalescing_stop = Event()
+        self.__coalescing_thread = None
+
     def __del__(self):
+        self.stop_coalescing()
         self.__comms.__del__()
 
     def set_forward_velocity(self, metres_per_second):
-        self.__comms.send(COM_SET_FORWARD_VELOCITY,
-                          int(metres_per_second * self.METRES_SCALING))
+        with self.__setpoint_lock:
+            self.__sent_setpoint = None
+            self.__comms.send(COM_SET_FORWARD_VELOCITY,
+                              int(metres_per_second * self.METRES_SCALING))
 
     def set_right_velocity(self, metres_per_second):
-        self.__comms.send(COM_SET_RIGHT_VELOCITY,
-                          int(metres_per_second * self.METRES_SCALING))
+        with self.__setpoint_lock:
+            self.__sent_setpoint = None
+            self.__comms.send(COM_SET_RIGHT_VELOCITY,
+                              int(metres_per_second * self.METRES_SCALING))
 
     def set_linear_velocities(self, metres_per_second_forward, metres_per_second_right):
-        self.__comms.send(COM_SET_LINEAR_VELOCITIES,
-                          int(metres_per_second_forward * self.METRES_SCALING),
-                          int(metres_per_second_right * self.METRES_SCALING))
+        with self.__setpoint_lock:
+            self.__sent_setpoint = None
+            self.__comms.send(COM_SET_LINEAR_VELOCITIES,
+                              int(metres_per_second_forward * self.METRES_SCALING),
+                              int(metres_per_second_right * self.METRES_SCALING))
 
     def set_angular_velocity(self, degrees_per_second):
-        self.__comms.send(COM_SET_ANGULAR_VELOCITY,
-                          int(degrees_per_second * self.DEGREES_SCALING))
+        with self.__setpoint_lock:
+            self.__sent_setpoint = None
+            self.__comms.send(COM_SET_ANGULAR_VELOCITY,
+                              int(degrees_per_second * self.DEGREES_SCALING))
 
     def set_all_velocities(self, metres_per_second_forward, metres_per_second_right, degrees_per_second):
-        self.__comms.send(COM_SET_ALL_VELOCITIES,
-                          int(metres_per_second_forward * self.METRES_SCALING),
-                          int(metres_per_second_right * self.METRES_SCALING),
-                          int(degrees_per_second * self.DEGREES_SCALING))
+        setpoint = (int(metres_per_second_forward * self.METRES_SCALING),
+                    int(metres_per_second_right * self.METRES_SCALING),
+                    int(degrees_per_second * self.DEGREES_SCALING))
+
+        with self.__setpoint_lock:
+            if self.__coalescing_thread is not None:
+                # Last write wins. The flusher sends whatever is pending when it next runs
+                self.__pending_setpoint = setpoint
+            else:
+                self.__comms.send(COM_SET_ALL_VELOCITIES, *setpoint)
+                self.__sent_setpoint = setpoint
 
     def stop_moving(self):
-        self.__comms.send(COM_STOP_MOVING)
+        # Always sent straight away, throwing away any setpoint that has not been sent yet
+        with self.__setpoint_lock:
+            self.__pending_setpoint = None
+            self.__comms.send(COM_STOP_MOVING)
+            self.__sent_setpoint = (0, 0, 0)
+
+    def start_coalescing(self, rate=DEFAULT_COALESCING_RATE):
+        if self.__coalescing_thread is not None:
+            return
+
+        self.__coalescing_stop.clear()
+        self.__coalescing_thread = Thread(target=self.__flush_loop, args=(int(1000000000 / rate),), daemon=True)
+        self.__coalescing_thread.start()
+
+    def is_coalescing(self):
+        return self.__coalescing_thread is not None
+
+    def stop_coalescing(self):
+        if self.__coalescing_thread is None:
+            return
+
+        self.__coalescing_stop.set()
+        self.__coalescing_thread.join()
+
+        # Go back to sending setpoints directly, making sure the last one written isn't lost
+        with self.__setpoint_lock:
+            self.__coalescing_thread = None
+        self.flush()
+
+    def flush(self):
+        # Send the pending setpoint, unless it is the same as the one that was last sent
+        with self.__setpoint_lock:
+            setpoint = self.__pending_setpoint
+            self.__pending_setpoint = None
+            if setpoint is not None and setpoint != self.__sent_setpoint:
+                self.__comms.send(COM_SET_ALL_VELOCITIES, *setpoint)
+                self.__sent_setpoint = setpoint
+
+    def __flush_loop(self, period_ns):
+        # Flushes are timed against absolute deadlines, so at most one setpoint is sent each period. If a flush runs
+        # late the next one is pushed back rather than sent early to catch up
+        next_flush_ns = monotonic_ns()
+        while not self.__coalescing_stop.wait(max(next_flush_ns - monotonic_ns(), 0) / 1000000000):
+            self.flush()
+            next_flush_ns = max(next_flush_ns + period_ns, monotonic_ns())
 
     def set_motion_origin_to(self, right, forward):
         self.__comms.send(COM_SET_MOTION_ORIGIN_TO,
@@ -71,12 +151,129 @@ class MotorDriver:
     def identify(self, timeout=SerialComms.DEFAULT_TIMEOUT):
         return self.__comms.identify(timeout)
 
-    def read_velocities(self, timeout=SerialComms.DEFAULT_TIMEOUT):
-        self.__comms.send(COM_READ_VELOCITIES_SEND)
-        z, x, r = self.__comms.receive(COM_READ_VELOCITIES_RECV, timeout)
+    def __velocities(self, z, x, r):
         return z / self.METRES_SCALING, x / self.METRES_SCALING, r / self.DEGREES_SCALING
 
-    def read_encoders(self, timeout=SerialComms.DEFAULT_TIMEOUT):
-        self.__comms.send(COM_READ_ENCODERS_SEND)
-        a, b, c, d = self.__comms.receive(COM_READ_ENCODERS_RECV, timeout)
+    def __encoders(self, a, b, c, d):
         return a / self.ENCODER_SCALING, b / self.ENCODER_SCALING, c / self.ENCODER_SCALING, d / self.ENCODER_SCALING
+
+    def read_velocities(self, timeout=None):
+        return self.__velocities(*self.__comms.query(COM_READ_VELOCITIES_SEND, COM_READ_VELOCITIES_RECV,
+                                                     timeout=timeout))
+
+    def read_encoders(self, timeout=None):
+        return self.__encoders(*self.__comms.query(COM_READ_ENCODERS_SEND, COM_READ_ENCODERS_RECV, timeout=timeout))
+
+    def read_state(self, timeout=None):
+        # Read both the velocities and the encoders in a single round trip
+        velocities, encoders = self.__comms.pipeline(((COM_READ_VELOCITIES_SEND,), (COM_READ_ENCODERS_SEND,)),
+                                                     (COM_READ_VELOCITIES_RECV, COM_READ_ENCODERS_RECV),
+                                                     timeout)
+        return self.__velocities(*velocities), self.__encoders(*encoders)
+
+    def stream_velocities(self, rate=DEFAULT_STREAM_RATE, handler=None):
+        # Have the motor driver push its velocities rate times a second rather than waiting to be asked. Each set is
+        # passed to handler if one is given, and the latest is always available from latest_velocities
+        self.__stream(COM_READ_VELOCITIES_RECV, rate, handler, self.__velocities)
+
+    def stream_encoders(self, rate=DEFAULT_STREAM_RATE, handler=None):
+        # As stream_velocities, for the encoders
+        self.__stream(COM_READ_ENCODERS_RECV, rate, handler, self.__encoders)
+
+    def stop_streams(self):
+        for command in (COM_READ_VELOCITIES_RECV, COM_READ_ENCODERS_RECV):
+            self.__comms.request_stream(command, 0)
+            self.__comms.unsubscribe(command)
+        self.__comms.stop_streaming()
+
+    def latest_velocities(self):
+        # The latest streamed velocities and the monotonic_ns time they arrived, or None if none have yet
+        latest = self.__comms.latest(COM_READ_VELOCITIES_RECV)
+        return None if latest is None else (self.__velocities(*latest[0]), latest[1])
+
+    def latest_encoders(self):
+        latest = self.__comms.latest(COM_READ_ENCODERS_RECV)
+        return None if latest is None else (self.__encoders(*latest[0]), latest[1])
+
+    def __stream(self, command, rate, handler, scale):
+        self.__comms.subscribe(command, None if handler is None else lambda values: handler(scale(*values)))
+        self.__comms.request_stream(command, rate)
+        self.__comms.start_streaming()
+
+
+class AsyncMotorDriver:
+    NAME = MotorDriver.NAME
+    EXPECTED_ID = MotorDriver.EXPECTED_ID
+
+    METRES_SCALING = MotorDriver.METRES_SCALING
+    DEGREES_SCALING = MotorDriver.DEGREES_SCALING
+    ENCODER_SCALING = MotorDriver.ENCODER_SCALING
+
+    def __init__(self, comms: AsyncSerialComms):
+        self.__comms = comms
+
+        # The same priorities as MotorDriver, so setpoints and stopping go ahead of reads other tasks have waiting
+        for command in (COM_SET_FORWARD_VELOCITY, COM_SET_RIGHT_VELOCITY, COM_SET_LINEAR_VELOCITIES,
+                        COM_SET_ANGULAR_VELOCITY, COM_SET_ALL_VELOCITIES):
+            comms.set_priority(command, AsyncSerialComms.SETPOINT_PRIORITY)
+        comms.set_priority(COM_STOP_MOVING, AsyncSerialComms.SAFETY_PRIORITY)
+
+    def __del__(self):
+        self.__comms.__del__()
+
+    async def set_forward_velocity(self, metres_per_second):
+        await self.__comms.send(COM_SET_FORWARD_VELOCITY,
+                                int(metres_per_second * self.METRES_SCALING))
+
+    async def set_right_velocity(self, metres_per_second):
+        await self.__comms.send(COM_SET_RIGHT_VELOCITY,
+                                int(metres_per_second * self.METRES_SCALING))
+
+    async def set_linear_velocities(self, metres_per_second_forward, metres_per_second_right):
+        await self.__comms.send(COM_SET_LINEAR_VELOCITIES,
+                                int(metres_per_second_forward * self.METRES_SCALING),
+                                int(metres_per_second_right * self.METRES_SCALING))
+
+    async def set_angular_velocity(self, degrees_per_second):
+        await self.__comms.send(COM_SET_ANGULAR_VELOCITY,
+                                int(degrees_per_second * self.DEGREES_SCALING))
+
+    async def set_all_velocities(self, metres_per_second_forward, metres_per_second_right, degrees_per_second):
+        await self.__comms.send(COM_SET_ALL_VELOCITIES,
+                                int(metres_per_second_forward * self.METRES_SCALING),
+                                int(metres_per_second_right * self.METRES_SCALING),
+                                int(degrees_per_second * self.DEGREES_SCALING))
+
+    async def stop_moving(self):
+        await self.__comms.send(COM_STOP_MOVING)
+
+    async def set_motion_origin_to(self, right, forward):
+        await self.__comms.send(COM_SET_MOTION_ORIGIN_TO,
+                                int(right * self.METRES_SCALING),
+                                int(forward * self.METRES_SCALING))
+
+    async def reset_motion_origin(self):
+        await self.__comms.send(COM_RESET_MOTION_ORIGIN)
+
+    async def poke(self):
+        await self.__comms.poke()
+
+    async def identify(self, timeout=AsyncSerialComms.DEFAULT_TIMEOUT):
+        return await self.__comms.identify(timeout)
+
+    async def read_velocities(self, timeout=None):
+        z, x, r = await self.__comms.query(COM_READ_VELOCITIES_SEND, COM_READ_VELOCITIES_RECV, timeout=timeout)
+        return z / self.METRES_SCALING, x / self.METRES_SCALING, r / self.DEGREES_SCALING
+
+    async def read_encoders(self, timeout=None):
+        a, b, c, d = await self.__comms.query(COM_READ_ENCODERS_SEND, COM_READ_ENCODERS_RECV, timeout=timeout)
+        return a / self.ENCODER_SCALING, b / self.ENCODER_SCALING, c / self.ENCODER_SCALING, d / self.ENCODER_SCALING
+
+    async def read_state(self, timeout=None):
+        # Read both the velocities and the encoders in a single round trip
+        (z, x, r), (a, b, c, d) = await self.__comms.pipeline(((COM_READ_VELOCITIES_SEND,), (COM_READ_ENCODERS_SEND,)),
+                                                              (COM_READ_VELOCITIES_RECV, COM_READ_ENCODERS_RECV),
+                                                              timeout)
+        return ((z / self.METRES_SCALING, x / self.METRES_SCALING, r / self.DEGREES_SCALING),
+                (a / self.ENCODER_SCALING, b / self.ENCODER_SCALING,
+                 c / self.ENCODER_SCALING, d / self.ENCODER_SCALING))
@@ -0,0 +1,183 @@
+import math
+import numpy as np
+from serial import SerialException
+from threading import Event, Lock, Thread
+from time import monotonic_ns
+from devices.motor_driver import MotorDriver
+
+
+class Odometry:
+    # The encoders are taken to be front left, front right, rear left and rear right, each counting up as its wheel
+    # drives the robot forward, in the wheel revolutions that MotorDriver.read_encoders reports
+    WHEEL_RADIUS = 0.04         # metres
+    HALF_LENGTH = 0.1           # metres from the centre of the robot to the front and rear axles
+    HALF_WIDTH = 0.1            # metres from the centre of the robot to the left and right wheels
+    RADIANS_PER_UNIT = 2 * math.pi
+
+    DEFAULT_RATE = 50
+    DEFAULT_HISTORY = 512
+
+    # How long to wait before reading again after a reading failed
+    RETRY_DELAY = 0.1
+
+    # The firmware's counts are 16 bits, so the scaled readings wrap around every this many units
+    ENCODER_WRAP = 0x10000 / MotorDriver.ENCODER_SCALING
+
+    def __init__(self, motor_driver: MotorDriver, wheel_radius=WHEEL_RADIUS, half_length=HALF_LENGTH,
+                 half_width=HALF_WIDTH, rate=DEFAULT_RATE, history=DEFAULT_HISTORY):
+        self.__motor_driver = motor_driver
+        self.__period_ns = int(1000000000 / rate)
+
+        # Mecanum forward kinematics, turning how far each wheel has turned into how far the robot has moved
+        # forward, to the left and anticlockwise, in its own frame
+        r = wheel_radius * self.RADIANS_PER_UNIT
+        self.__kinematics = np.array([
+            [1, 1, 1, 1],
+            [-1, 1, 1, -1],
+            [-1 / (half_length + half_width), 1 / (half_length + half_width),
+             -1 / (half_length + half_width), 1 / (half_length + half_width)],
+        ]) * (r / 4)
+
+        # A ring buffer of poses, along with when each was worked out. The heading is kept unwrapped here, so
+        # neighbouring poses can be interpolated between
+        self.__history = history
+        self.__times_ns = np.zeros(history, dtype=np.int64)
+        self.__poses = np.zeros((history, 3))
+        self.__head = 0
+        self.__count = 0
+
+        self.__pose = np.zeros(3)
+        self.__last_encoders = None
+        self.__lock = Lock()
+
+        # How many readings have failed, and the error from the last one that did, or from whatever stopped the thread
+        self.__failures = 0
+        self.__last_error = None
+
+        self.__stop_event = Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def failures(self):
+        return self.__failures
+
+    def last_error(self):
+        return self.__last_error
+
+    def __run(self):
+        # Samples are timed against absolute deadlines, so the time taken to read the encoders doesn't add up
+        next_sample_ns = monotonic_ns()
+        try:
+            while not self.__stop_event.is_set():
+                try:
+                    self.update()
+                except (TimeoutError, SerialException, OSError, ValueError) as e:
+                    # Keep sampling through a lost or corrupted reading, or the link dropping out for a while. The
+                    # next good reading picks up the whole movement since the last one
+                    self.__failures += 1
+                    self.__last_error = e
+                    if self.__stop_event.wait(self.RETRY_DELAY):
+                        return
+                    next_sample_ns = monotonic_ns()
+                    continue
+
+                next_sample_ns = max(next_sample_ns + self.__period_ns, monotonic_ns())
+                self.__stop_event.wait((next_sample_ns - monotonic_ns()) / 1000000000)
+        except Exception as e:
+            # Anything else stops the sampling, which is_running shows
+            self.__last_error = e
+            raise
+
+    def update(self, encoders=None, time_ns=None):
+        # Integrate the movement since the last update. Without encoders they are read from the motor driver, which
+        # lets this be called from a Scheduler task instead of running the sampling thread
+        if encoders is None:
+            start_ns = monotonic_ns()
+            encoders = self.__motor_driver.read_encoders()
+            # The reading was taken somewhere during the round trip, so call it the middle of it
+            time_ns = (start_ns + monotonic_ns()) // 2
+        elif time_ns is None:
+            time_ns = monotonic_ns()
+
+        encoders = np.array(encoders, dtype=np.float64)
+        with self.__lock:
+            if self.__last_encoders is not None:
+                # Take the shortest way round in case an encoder count has wrapped
+                deltas = (encoders - self.__last_encoders + self.ENCODER_WRAP / 2) % self.ENCODER_WRAP - \
+                         self.ENCODER_WRAP / 2
+                forward, left, turn = self.__kinematics @ deltas
+
+                # Move along the heading half way through the turn, which is far more accurate than the heading at
+                # either end when turning and driving at the same time
+                heading = self.__pose[2] + turn / 2
+                cos_heading = math.cos(heading)
+                sin_heading = math.sin(heading)
+                self.__pose[0] += forward * cos_heading - left * sin_heading
+                self.__pose[1] += forward * sin_heading + left * cos_heading
+                self.__pose[2] += turn
+
+            self.__last_encoders = encoders
+            self.__store(time_ns)
+
+    def __store(self, time_ns):
+        self.__times_ns[self.__head] = time_ns
+        self.__poses[self.__head] = self.__pose
+        self.__head = (self.__head + 1) % self.__history
+        self.__count = min(self.__count + 1, self.__history)
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        # Set the current pose, in metres and radians, clearing the history of previous poses
+        with self.__lock:
+            self.__pose[:] = (x, y, heading)
+            self.__head = 0
+            self.__count = 0
+
+    @staticmethod
+    def __wrapped(pose):
+        x, y, heading = pose.tolist()
+        return x, y, math.remainder(heading, 2 * math.pi)
+
+    def pose(self):
+        # The latest (x, y, heading) in metres and radians, with the heading between -pi and pi
+        with self.__lock:
+            return self.__wrapped(self.__pose)
+
+    def history(self, window=None):
+        # The most recent poses, oldest first, as an array of times and an N x 3 array of unwrapped poses
+        with self.__lock:
+            count = self.__count if window is None else min(window, self.__count)
+            positions = (self.__head - count + np.arange(count)) % self.__history
+            return self.__times_ns[positions], self.__poses[positions]
+
+    def pose_at(self, time_ns):
+        # The pose at the given monotonic_ns time, interpolated between the poses either side of it. Returns None if
+        # the time is from before the oldest pose in the history, and the latest pose if it is after that
+        times_ns, poses = self.history()
+        if len(times_ns) == 0 or time_ns < times_ns[0]:
+            return None
+
+        index = int(np.searchsorted(times_ns, time_ns, side="right"))
+        if index >= len(times_ns):
+            return self.__wrapped(poses[-1])
+
+        start_ns = times_ns[index - 1]
+        fraction = (time_ns - start_ns) / (times_ns[index] - start_ns) if times_ns[index] > start_ns else 0.0
+        return self.__wrapped(poses[index - 1] + (poses[index] - poses[index - 1]) * fraction)
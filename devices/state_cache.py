@@ -0,0 +1,38 @@
+from threading import Lock
+from time import monotonic_ns
+
+
+class StateCache:
+    def __init__(self, ttls):
+        # ttls maps each field name to how long, in seconds, a value for it can be trusted
+        self.__ttls_ns = {field: int(ttl * 1000000000) for field, ttl in ttls.items()}
+        self.__values = {}
+        self.__hits = dict.fromkeys(ttls, 0)
+        self.__misses = dict.fromkeys(ttls, 0)
+        self.__lock = Lock()
+
+    def get(self, field, default=None):
+        with self.__lock:
+            entry = self.__values.get(field)
+            if entry is not None and monotonic_ns() < entry[1]:
+                self.__hits[field] += 1
+                return entry[0]
+
+            self.__misses[field] += 1
+            return default
+
+    def set(self, field, value):
+        with self.__lock:
+            self.__values[field] = (value, monotonic_ns() + self.__ttls_ns[field])
+
+    def invalidate(self, field=None):
+        with self.__lock:
+            if field is None:
+                self.__values.clear()
+            else:
+                self.__values.pop(field, None)
+
+    def stats(self):
+        # The number of hits and misses for each field, to help with tuning the TTLs
+        with self.__lock:
+            return {field: (self.__hits[field], self.__misses[field]) for field in self.__ttls_ns}
@@ -0,0 +1,141 @@
+import numpy as np
+from serial import SerialException
+from threading import Event, Lock, Thread
+from time import monotonic_ns
+from devices.io_controller import IOController
+
+
+class ToFSampler:
+    DEFAULT_INDICES = (0, 1, 2, 3)
+    DEFAULT_HISTORY = 32
+    DEFAULT_OUTLIER_THRESHOLD = 3.0
+
+    # How long to wait before reading again after a read fails, so a link that has dropped out isn't hammered
+    RETRY_DELAY = 0.1
+
+    def __init__(self, io_controller: IOController, indices=DEFAULT_INDICES, history=DEFAULT_HISTORY, period=0.0):
+        # With a period of zero the sensors are read as fast as the link allows
+        self.__io_controller = io_controller
+        self.__indices = tuple(indices)
+        self.__slots = {index: slot for slot, index in enumerate(self.__indices)}
+        self.__period_ns = int(period * 1000000000)
+
+        # A ring buffer of readings for each sensor, along with when each was taken
+        self.__history = history
+        self.__distances = np.full((len(self.__indices), history), np.nan)
+        self.__times_ns = np.zeros((len(self.__indices), history), dtype=np.int64)
+        self.__heads = np.zeros(len(self.__indices), dtype=np.int64)
+        self.__counts = np.zeros(len(self.__indices), dtype=np.int64)
+        self.__lock = Lock()
+
+        # How many reads have failed, and the error from the last one that did, or from whatever stopped the thread
+        self.__failures = 0
+        self.__last_error = None
+
+        self.__stop_event = Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def is_running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def failures(self):
+        return self.__failures
+
+    def last_error(self):
+        return self.__last_error
+
+    def __run(self):
+        next_sample_ns = monotonic_ns()
+        try:
+            while not self.__stop_event.is_set():
+                try:
+                    distances = self.__io_controller.read_tofs(self.__indices)
+                except (TimeoutError, SerialException, OSError, ValueError) as e:
+                    # Keep sampling through a lost or corrupted reply, or the link dropping out for a while
+                    self.__failures += 1
+                    self.__last_error = e
+                    if self.__stop_event.wait(self.RETRY_DELAY):
+                        return
+                    next_sample_ns = monotonic_ns()
+                    continue
+
+                self.__store(monotonic_ns(), distances)
+
+                if self.__period_ns > 0:
+                    next_sample_ns = max(next_sample_ns + self.__period_ns, monotonic_ns())
+                    self.__stop_event.wait((next_sample_ns - monotonic_ns()) / 1000000000)
+        except Exception as e:
+            # Anything else stops the sampling, which is_running shows
+            self.__last_error = e
+            raise
+
+    def __store(self, time_ns, distances):
+        with self.__lock:
+            for slot, distance in enumerate(distances):
+                # Error values such as -99 from a checksum failure never make it into the history
+                if distance < 0:
+                    continue
+
+                head = self.__heads[slot]
+                self.__distances[slot, head] = distance
+                self.__times_ns[slot, head] = time_ns
+                self.__heads[slot] = (head + 1) % self.__history
+                self.__counts[slot] = min(self.__counts[slot] + 1, self.__history)
+
+    def readings(self, index, window=None):
+        # The most recent readings for a sensor, oldest first, as a pair of arrays of times and distances
+        slot = self.__slots[index]
+        with self.__lock:
+            count = self.__counts[slot] if window is None else min(window, self.__counts[slot])
+            positions = (self.__heads[slot] - count + np.arange(count)) % self.__history
+            return self.__times_ns[slot, positions], self.__distances[slot, positions]
+
+    def latest(self, index):
+        # The most recent distance, or None if there have been no good readings yet
+        slot = self.__slots[index]
+        with self.__lock:
+            if self.__counts[slot] == 0:
+                return None
+            return float(self.__distances[slot, self.__heads[slot] - 1])
+
+    def age(self, index):
+        # How long ago, in seconds, the most recent reading was taken, or None if there hasn't been one
+        slot = self.__slots[index]
+        with self.__lock:
+            if self.__counts[slot] == 0:
+                return None
+            return (monotonic_ns() - int(self.__times_ns[slot, self.__heads[slot] - 1])) / 1000000000
+
+    def median(self, index, window=None):
+        _, distances = self.readings(index, window)
+        return float(np.median(distances)) if len(distances) > 0 else None
+
+    def filtered(self, index, window=None, threshold=DEFAULT_OUTLIER_THRESHOLD):
+        # The mean of the recent readings, leaving out any further than threshold median absolute deviations
+        # from the median
+        _, distances = self.readings(index, window)
+        if len(distances) == 0:
+            return None
+
+        median = np.median(distances)
+        deviations = np.abs(distances - median)
+        mad = np.median(deviations)
+        if mad == 0:
+            return float(median)
+        return float(np.mean(distances[deviations <= threshold * mad]))
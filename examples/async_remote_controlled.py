@@ -0,0 +1,94 @@
+import asyncio
+from comms.sbus import SBusReceiver, analog_decoder, analog_biased_decoder, binary_decoder
+from devices import AsyncMotorDriver, AsyncIOController
+from devices.discovery import async_discover_devices
+
+SBUS_PORT = "/dev/serial0"
+SBUS_CHANNELS = 8
+SBUS_TIMEOUT = 0.1
+
+FORWARD_CHANNEL = 2
+RIGHT_CHANNEL = 3
+TURN_CHANNEL = 0
+SPEED_CHANNEL = 5
+EN_CHANNEL = 4
+
+LIN_SCALE = 1.0
+ANG_SCALE = 180.0
+
+TELEMETRY_PERIOD = 0.1
+TOF_PERIOD = 0.1
+TOF_INDICES = (0, 1, 2, 3)
+
+# The path wildcard pattern to search
+PATTERN = '/dev/ttyACM*'
+
+
+async def drive(controller, motor_driver):
+    # Wake up whenever SBUS data arrives, or often enough to notice the connection being lost
+    frame_ready = asyncio.Event()
+    asyncio.get_running_loop().add_reader(controller.fileno(), frame_ready.set)
+
+    while True:
+        try:
+            await asyncio.wait_for(frame_ready.wait(), SBUS_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        frame_ready.clear()
+
+        if controller.check_receive():
+            # All the channels of the frame come decoded together
+            channels = controller.read_all()
+            enable = not channels[EN_CHANNEL]
+            if enable:
+                max_speed = channels[SPEED_CHANNEL]
+                forward_vel = channels[FORWARD_CHANNEL] * LIN_SCALE * max_speed
+                right_vel = channels[RIGHT_CHANNEL] * LIN_SCALE * max_speed
+                turn_vel = channels[TURN_CHANNEL] * ANG_SCALE * max_speed
+                await motor_driver.set_all_velocities(forward_vel, right_vel, turn_vel)
+            else:
+                await motor_driver.stop_moving()
+
+        elif not controller.is_connected():
+            await motor_driver.stop_moving()
+
+
+async def print_telemetry(motor_driver):
+    while True:
+        print("Velocities and Encoders", *await motor_driver.read_state())
+        await asyncio.sleep(TELEMETRY_PERIOD)
+
+
+async def print_tofs(io_controller):
+    while True:
+        print("ToFs", await io_controller.read_tofs(TOF_INDICES))
+        await asyncio.sleep(TOF_PERIOD)
+
+
+async def main():
+    # Find the devices, with any port that doesn't identify as one closed again
+    devices = await async_discover_devices(PATTERN)
+    motor_driver = devices.get(AsyncMotorDriver)
+    io_controller = devices.get(AsyncIOController)
+
+    if motor_driver is None:
+        print("No Motor Driver found")
+        return
+
+    controller = SBusReceiver(SBUS_PORT, SBUS_CHANNELS, SBUS_TIMEOUT)
+
+    controller.assign_channel_decoder(FORWARD_CHANNEL, analog_decoder)  # Forward/Backward
+    controller.assign_channel_decoder(RIGHT_CHANNEL, analog_decoder)  # Right/Left
+    controller.assign_channel_decoder(TURN_CHANNEL, analog_decoder)
+    controller.assign_channel_decoder(EN_CHANNEL, binary_decoder)
+    controller.assign_channel_decoder(SPEED_CHANNEL, analog_biased_decoder)
+
+    # All the devices are serviced from this one loop, with each one's I/O overlapping the others
+    tasks = [drive(controller, motor_driver), print_telemetry(motor_driver)]
+    if io_controller is not None:
+        tasks.append(print_tofs(io_controller))
+
+    await asyncio.gather(*tasks)
+
+
+asyncio.run(main())
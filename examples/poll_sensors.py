@@ -1,55 +1,25 @@
 import time
-from serial import SerialException
-from glob import glob
-from comms.serial import SerialComms
-from devices import IOController, DEVICE_ID_LIST
+from devices import IOController
+from devices.discovery import discover_devices
+from devices.tof_sampler import ToFSampler
 
 # The path wildcard pattern to search
 PATTERN = '/dev/ttyACM*'
 
-io_controller = None
+TOF_INDICES = (0, 1, 2, 3)
 
-
-def find_serial_ports(pattern):
-    return glob(pattern)
-
-def create_serial_instances(port_list):
-    serial_instances = {}
-    for port in port_list:
-        try:
-            comms = SerialComms(port)
-            print(f"Serial port {port} opened successfully.")
-            try:
-                identity = comms.identify()
-                if identity in DEVICE_ID_LIST:
-                    print(f"Found device: {hex(identity)} ({DEVICE_ID_LIST[identity]})")
-                else:
-                    print(f"Found unknown device: {hex(identity)}")
-                serial_instances[identity] = comms
-            except ValueError:
-                print("Not a recognised device")
-
-        except SerialException as e:
-            print(f"Error opening serial port {port}: {e}")
-    return serial_instances
-
-
-# Find serial ports matching the pattern
-port_list = find_serial_ports(PATTERN)
-
-if not port_list:
-    print(f"No serial ports found matching the pattern '{PATTERN}'.")
-else:
-    # Create instances for each serial port
-    instances = create_serial_instances(port_list)
-
-    if IOController.EXPECTED_ID in instances.keys():
-        io_controller = IOController(instances[IOController.EXPECTED_ID])
+# Probe all the serial ports matching the pattern at once, trying the ones our devices were on last time first
+devices = discover_devices(PATTERN)
+io_controller = devices.get(IOController)
 
 
 if io_controller is not None:
+    # Sample the ToFs in the background, so reading them here never waits on the serial port
+    sampler = ToFSampler(io_controller, TOF_INDICES)
+    sampler.start()
+
     while True:
         print("Read ToFs", end=" ")
-        print(io_controller.read_tof())
+        print([sampler.filtered(index) for index in TOF_INDICES])
         time.sleep(0.5)
 
@@ -1,50 +1,13 @@
 import time
-from serial import SerialException
-from glob import glob
-from comms.serial import SerialComms
-from devices import IOController, DEVICE_ID_LIST
+from devices import IOController
+from devices.discovery import discover_devices
 
 # The path wildcard pattern to search
 PATTERN = '/dev/ttyACM*'
 
-io_controller = None
-
-
-def find_serial_ports(pattern):
-    return glob(pattern)
-
-def create_serial_instances(port_list):
-    serial_instances = {}
-    for port in port_list:
-        try:
-            comms = SerialComms(port)
-            print(f"Serial port {port} opened successfully.")
-            try:
-                identity = comms.identify()
-                if identity in DEVICE_ID_LIST:
-                    print(f"Found device: {hex(identity)} ({DEVICE_ID_LIST[identity]})")
-                else:
-                    print(f"Found unknown device: {hex(identity)}")
-                serial_instances[identity] = comms
-            except ValueError:
-                print("Not a recognised device")
-
-        except SerialException as e:
-            print(f"Error opening serial port {port}: {e}")
-    return serial_instances
-
-
-# Find serial ports matching the pattern
-port_list = find_serial_ports(PATTERN)
-
-if not port_list:
-    print(f"No serial ports found matching the pattern '{PATTERN}'.")
-else:
-    # Create instances for each serial port
-    instances = create_serial_instances(port_list)
-
-    if IOController.EXPECTED_ID in instances.keys():
-        io_controller = IOController(instances[IOController.EXPECTED_ID])
+# Probe all the serial ports matching the pattern at once, trying the ones our devices were on last time first
+devices = discover_devices(PATTERN)
+io_controller = devices.get(IOController)
 
 
 # Define the color ranges for each LED segment
@@ -68,12 +31,9 @@ if io_controller is not None:
         # Determine which LED segment corresponds to the input value
         segment_index = min(int(cm / ((max_cm + 1) / 6)), 5)
 
-        # Set LEDs based on the segment index and color
-        for led in range(6):
-            if led <= segment_index:
-                io_controller.set_led(led, *color_segments[segment_index])
-            else:
-                io_controller.set_led(led, 0, 0, 0)
+        # Set LEDs based on the segment index and color. Only the LEDs that change get sent, in a single write
+        io_controller.set_leds([color_segments[segment_index] if led <= segment_index else (0, 0, 0)
+                                for led in range(6)])
 
         time.sleep(0.1)
 
@@ -0,0 +1,32 @@
+from control.motion_profile import MotionProfile, MotionProfilePlayer
+from devices import MotorDriver
+from devices.discovery import discover_devices
+
+# The length of each side of the square in metres
+SIDE = 0.5
+
+# The path wildcard pattern to search
+PATTERN = '/dev/ttyACM*'
+
+devices = discover_devices(PATTERN)
+motor_driver = devices.get(MotorDriver)
+
+
+if motor_driver is not None:
+    # Work out every move before setting off, so driving them is just sending the velocities for each tick
+    moves = [
+        MotionProfile.s_curve(forward=SIDE),
+        MotionProfile.s_curve(right=SIDE),
+        MotionProfile.s_curve(forward=-SIDE),
+        MotionProfile.s_curve(right=-SIDE),
+        MotionProfile.s_curve(turn=360),
+    ]
+
+    player = MotionProfilePlayer(motor_driver)
+    try:
+        for move in moves:
+            print(f"Moving {move.displacement()} over {move.duration():.2f} s")
+            player.play(move)
+    finally:
+        # Ctrl+C stops the robot where it is
+        player.abort()
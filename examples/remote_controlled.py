@@ -1,8 +1,6 @@
-from serial import SerialException
-from glob import glob
-from comms.serial import SerialComms
-from comms.sbus import SBusReceiver, analog_decoder, analog_biased_decoder, binary_decoder
-from devices import MotorDriver, DEVICE_ID_LIST
+from comms.sbus import SBusReceiver, analog_decoder, analog_biased_decoder, binary_decoder, Deadband, Expo
+from devices import MotorDriver
+from devices.discovery import discover_devices
 
 SBUS_PORT = "/dev/serial0"
 SBUS_CHANNELS = 8
@@ -17,47 +15,17 @@ EN_CHANNEL = 4
 LIN_SCALE = 1.0
 ANG_SCALE = 180.0
 
+# Stick noise around the centre reads as exactly zero, so a centred stick doesn't keep sending new velocities.
+# Expo gives finer control near the centre
+STICK_DEADBAND = 0.05
+STICK_EXPO = 0.3
+
 # The path wildcard pattern to search
 PATTERN = '/dev/ttyACM*'
 
-motor_driver = None
-
-
-def find_serial_ports(pattern):
-    return glob(pattern)
-
-def create_serial_instances(port_list):
-    serial_instances = {}
-    for port in port_list:
-        try:
-            comms = SerialComms(port)
-            print(f"Serial port {port} opened successfully.")
-            try:
-                identity = comms.identify()
-                if identity in DEVICE_ID_LIST:
-                    print(f"Found device: {hex(identity)} ({DEVICE_ID_LIST[identity]})")
-                else:
-                    print(f"Found unknown device: {hex(identity)}")
-                serial_instances[identity] = comms
-            except ValueError:
-                print("Not a recognised device")
-
-        except SerialException as e:
-            print(f"Error opening serial port {port}: {e}")
-    return serial_instances
-
-
-# Find serial ports matching the pattern
-port_list = find_serial_ports(PATTERN)
-
-if not port_list:
-    print(f"No serial ports found matching the pattern '{PATTERN}'.")
-else:
-    # Create instances for each serial port
-    instances = create_serial_instances(port_list)
-
-    if MotorDriver.EXPECTED_ID in instances.keys():
-        motor_driver = MotorDriver(instances[MotorDriver.EXPECTED_ID])
+# Probe all the serial ports matching the pattern at once, trying the ones our devices were on last time first
+devices = discover_devices(PATTERN)
+motor_driver = devices.get(MotorDriver)
 
 
 if motor_driver is not None:
@@ -69,26 +37,44 @@ if motor_driver is not None:
     controller.assign_channel_decoder(EN_CHANNEL, binary_decoder)
     controller.assign_channel_decoder(SPEED_CHANNEL, analog_biased_decoder)
 
+    # Filtered once per frame along with the decoding, rather than on every read
+    stick_filters = (Deadband(STICK_DEADBAND), Expo(STICK_EXPO))
+    controller.assign_filter_table({
+        FORWARD_CHANNEL: stick_filters,
+        RIGHT_CHANNEL: stick_filters,
+        TURN_CHANNEL: stick_filters,
+    })
+
+    # Stop as soon as the controller is lost, rather than whenever the loop next gets round to checking
+    controller.subscribe_connection(lambda connected: connected or motor_driver.stop_moving())
+
+    # Receive in the background so the control loop is not spent reading the serial port
+    controller.start()
+
+    # Only send the latest velocities at a fixed rate, skipping any that are the same as last time
+    motor_driver.start_coalescing()
+
     print("Establishing Connection")
 
-    while not controller.is_connected():
-        controller.check_receive()
+    controller.wait_until_connected()
 
     print("Connection Established")
 
     while controller.is_connected():
         if controller.check_receive():
-            enable = not controller.read_channel(EN_CHANNEL)
+            # All the channels of the frame come decoded together
+            channels = controller.read_all()
+            enable = not channels[EN_CHANNEL]
             if enable:
-                max_speed = controller.read_channel(SPEED_CHANNEL)
-                forward_vel = controller.read_channel(FORWARD_CHANNEL) * LIN_SCALE * max_speed
-                right_vel = controller.read_channel(RIGHT_CHANNEL) * LIN_SCALE * max_speed
-                turn_vel = controller.read_channel(TURN_CHANNEL) * ANG_SCALE * max_speed
+                max_speed = channels[SPEED_CHANNEL]
+                forward_vel = channels[FORWARD_CHANNEL] * LIN_SCALE * max_speed
+                right_vel = channels[RIGHT_CHANNEL] * LIN_SCALE * max_speed
+                turn_vel = channels[TURN_CHANNEL] * ANG_SCALE * max_speed
                 motor_driver.set_all_velocities(forward_vel, right_vel, turn_vel)
             else:
                 motor_driver.stop_moving()
 
         print("Read Velocities and Encoders", end=" ")
-        print(motor_driver.read_velocities(), motor_driver.read_encoders())
+        print(*motor_driver.read_state())
 
     print("Connection Lost")
@@ -0,0 +1,114 @@
+from comms.sbus import SBusReceiver, analog_decoder, analog_biased_decoder, binary_decoder
+from control.scheduler import Scheduler
+from devices import MotorDriver, IOController
+from devices.discovery import discover_devices
+
+SBUS_PORT = "/dev/serial0"
+SBUS_CHANNELS = 8
+SBUS_TIMEOUT = 0.1
+
+FORWARD_CHANNEL = 2
+RIGHT_CHANNEL = 3
+TURN_CHANNEL = 0
+SPEED_CHANNEL = 5
+EN_CHANNEL = 4
+
+LIN_SCALE = 1.0
+ANG_SCALE = 180.0
+
+# How often each part of the control loop runs, in Hz
+SBUS_RATE = 100
+ENCODER_RATE = 50
+TOF_RATE = 10
+STATS_RATE = 0.2
+
+# Distances at or beyond this many cm show as fully green
+MAX_CM = 30
+
+# The path wildcard pattern to search
+PATTERN = '/dev/ttyACM*'
+
+devices = discover_devices(PATTERN)
+motor_driver = devices.get(MotorDriver)
+io_controller = devices.get(IOController)
+
+
+def check_connection():
+    # Runs ahead of everything else, so the robot stops as soon as the controller is lost. The stop is only sent
+    # when the connection goes, rather than every time round while it stays lost
+    global was_connected
+    connected = controller.is_connected()
+    if was_connected and not connected:
+        motor_driver.stop_moving()
+    was_connected = connected
+
+
+def drive():
+    if controller.check_receive() and controller.is_connected():
+        channels = controller.read_all()
+        enable = not channels[EN_CHANNEL]
+        if enable:
+            max_speed = channels[SPEED_CHANNEL]
+            forward_vel = channels[FORWARD_CHANNEL] * LIN_SCALE * max_speed
+            right_vel = channels[RIGHT_CHANNEL] * LIN_SCALE * max_speed
+            turn_vel = channels[TURN_CHANNEL] * ANG_SCALE * max_speed
+            motor_driver.set_all_velocities(forward_vel, right_vel, turn_vel)
+        else:
+            motor_driver.stop_moving()
+
+
+def read_encoders():
+    global state
+    state = motor_driver.read_state()
+
+
+def show_distances():
+    # Each LED goes from green to red as whatever is in front of its sensor gets closer
+    distances = io_controller.read_tofs()
+    colours = []
+    for distance in distances:
+        closeness = min(max(1.0 - distance / MAX_CM, 0.0), 1.0) if distance >= 0 else 0.0
+        colours.append((int(255 * closeness), int(255 * (1.0 - closeness)), 0))
+    io_controller.set_leds(colours)
+
+
+def print_stats():
+    print("Velocities and Encoders", *state)
+    for name, stats in scheduler.stats().items():
+        print(f"  {name:16} {stats['runs']:6} runs, {stats['overruns']:4} overruns, "
+              f"p99 jitter {stats['jitter'].get('p99_us', 0):8.0f} us, "
+              f"p99 execution {stats['execution'].get('p99_us', 0):8.0f} us")
+
+
+def report_overrun(name, late):
+    print(f"{name} overran by {late * 1000:.1f} ms")
+
+
+if motor_driver is not None:
+    controller = SBusReceiver(SBUS_PORT, SBUS_CHANNELS, SBUS_TIMEOUT)
+    controller.assign_decode_table({
+        FORWARD_CHANNEL: analog_decoder,  # Forward/Backward
+        RIGHT_CHANNEL: analog_decoder,  # Right/Left
+        TURN_CHANNEL: analog_decoder,
+        EN_CHANNEL: binary_decoder,
+        SPEED_CHANNEL: analog_biased_decoder,
+    })
+    state = None
+
+    # Starting as if connected means a stop is sent once if the controller isn't there to begin with
+    was_connected = True
+
+    scheduler = Scheduler(overrun_handler=report_overrun)
+    scheduler.add_task("check_connection", check_connection, SBUS_RATE, Scheduler.SAFETY_PRIORITY)
+    scheduler.add_task("drive", drive, SBUS_RATE)
+    scheduler.add_task("read_encoders", read_encoders, ENCODER_RATE)
+    if io_controller is not None:
+        scheduler.add_task("show_distances", show_distances, TOF_RATE)
+    scheduler.add_task("print_stats", print_stats, STATS_RATE, phase=1 / STATS_RATE)
+
+    try:
+        scheduler.run()
+    finally:
+        motor_driver.stop_moving()
+        if io_controller is not None:
+            io_controller.set_leds([(0, 0, 0)] * 4)
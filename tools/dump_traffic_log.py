@@ -0,0 +1,14 @@
+import sys
+
+# Remember to add piwarsengine to the PYTHONPATH for the below imports to work
+from comms.traffic_log import read_log, RX
+
+if len(sys.argv) != 2:
+    print(f"Usage: {sys.argv[0]} <traffic log>")
+    sys.exit(1)
+
+first_ns = None
+for timestamp_ns, port, direction, data in read_log(sys.argv[1]):
+    if first_ns is None:
+        first_ns = timestamp_ns
+    print(f"{(timestamp_ns - first_ns) / 1e9:12.6f} {port} {'RX' if direction == RX else 'TX'} {data.hex(' ')}")
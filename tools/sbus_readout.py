@@ -8,27 +8,32 @@ TIMEOUT = 0.1
 # Create the SBusReceiver class to receive data from our controller
 controller = SBusReceiver(PORT, CHANNELS, TIMEOUT)
 
-# Assign decoder functions to each of the channels
-controller.assign_channel_decoder(0, analog_decoder)
-controller.assign_channel_decoder(1, analog_decoder)
-controller.assign_channel_decoder(2, analog_decoder)
-controller.assign_channel_decoder(3, analog_decoder)
-controller.assign_channel_decoder(4, binary_decoder)
-controller.assign_channel_decoder(5, analog_biased_decoder)
-controller.assign_channel_decoder(6, trinary_decoder)
-controller.assign_channel_decoder(7, binary_decoder)
+# Assign decoders to each of the channels, which are all decoded together once per frame
+controller.assign_decode_table([
+    analog_decoder,
+    analog_decoder,
+    analog_decoder,
+    analog_decoder,
+    binary_decoder,
+    analog_biased_decoder,
+    trinary_decoder,
+    binary_decoder,
+])
+
+# Receive in the background so waiting for frames does not spin the CPU
+controller.start()
 
 print("Establishing Connection")
 
-while not controller.is_connected():
-    controller.check_receive()
+controller.wait_until_connected()
 
 print("Connection Established")
 
 while controller.is_connected():
-    if controller.check_receive():
-        for i in range(controller.num_channels()):
-            print("Ch", i + 1, "=", controller.read_channel(i), end=", ")
+    frame = controller.wait_for_frame(TIMEOUT)
+    if frame is not None:
+        for i, value in enumerate(frame.channels):
+            print("Ch", i + 1, "=", value, end=", ")
         print()
 
 print("Connection Lost")
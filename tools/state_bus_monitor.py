@@ -0,0 +1,25 @@
+import sys
+import time
+
+# Remember to add piwarsengine to the PYTHONPATH for the below imports to work
+from comms.state_bus import StateBus, DEFAULT_NAME
+
+# Attaches to the state bus published by another process, such as the control loop, and prints every record in it.
+# Reading never holds up the publisher
+name = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_NAME
+bus = StateBus(name)
+
+try:
+    while True:
+        now_ns = time.monotonic_ns()
+        for record in bus.layout():
+            latest = bus.read(record)
+            if latest is None:
+                print(f"{record:16} never published")
+            else:
+                values, time_ns, count = latest
+                print(f"{record:16} {(now_ns - time_ns) / 1e6:8.1f} ms old, #{count:<8} {values.round(3).tolist()}")
+        print()
+        time.sleep(0.5)
+finally:
+    bus.close()